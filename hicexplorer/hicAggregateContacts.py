@@ -1,6 +1,7 @@
 from __future__ import division
 
 import argparse
+import multiprocessing
 import numpy as np
 
 from future.utils import iteritems
@@ -10,6 +11,7 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 import matplotlib.cm as cm
+from scipy.sparse import coo_matrix
 from hicmatrix import HiCMatrix as hm
 import hicexplorer.utilities
 from .utilities import toString
@@ -76,6 +78,19 @@ def parse_arguments(args=None):
                            choices=['mean', 'median'],
                            default='median')
 
+    parserOpt.add_argument('--reservoirSize',
+                           help='If no clustering is done, the submatrices are not kept but aggregated while they '
+                           'are computed. The mean is computed from all submatrices, while the median and the '
+                           'diagnostic heatmap are computed from a random sample of at most this number of '
+                           'submatrices per chromosome. If there are not more submatrices, the median is exact.',
+                           type=int,
+                           default=5000)
+
+    parserOpt.add_argument('--numberOfProcessors', '-p',
+                           help='Number of processors to use. The chromosomes are processed in parallel.',
+                           type=int,
+                           default=1)
+
     parserOpt.add_argument("--help", "-h", action="help", help="show this help message and exit")
 
     parserOut = parser.add_argument_group('Output options')
@@ -130,6 +145,31 @@ def parse_arguments(args=None):
                              choices=['full', 'center', 'diagonal'],
                              default='full')
 
+    parserClust.add_argument('--pcaComponents',
+                             help='If given, the values of each submatrix used for the clustering are reduced to '
+                             'this number of principal components, computed with a randomized singular value '
+                             'decomposition. This makes the clustering of many large submatrices much faster.',
+                             type=int)
+
+    parserClust.add_argument('--kmeansBatchSize',
+                             help='If given, mini-batch k-means with batches of this number of submatrices is used '
+                             'instead of k-means. Mini-batch k-means is much faster for tens of thousands of '
+                             'submatrices per chromosome, for example with a batch size of 1000.',
+                             type=int)
+
+    parserClust.add_argument('--hclustCentroids',
+                             help='If given, the submatrices are first clustered with mini-batch k-means into this '
+                             'number of clusters (for example 500) and the hierarchical clustering is computed on '
+                             'their centroids. Each submatrix gets the cluster of its centroid. This avoids the '
+                             'memory and time needed by the hierarchical clustering of all submatrices.',
+                             type=int)
+
+    parserClust.add_argument('--seed',
+                             help='Seed of the random numbers used by --pcaComponents, --kmeansBatchSize and '
+                             '--hclustCentroids, to get reproducible clusters.',
+                             type=int,
+                             default=0)
+
     parserPlot = parser.add_argument_group('Plotting options')
 
     parserPlot.add_argument('--chromosomes', '-C',
@@ -221,17 +261,131 @@ def get_outlier_indices(data, max_deviation=200):
     return outliers
 
 
-def cluster_matrices(submatrices_dict, k, method='kmeans', how='full'):
+def get_nearest_centroids(pData, pCentroids, pChunkSize=10000):
+    """
+    Returns, for each row of pData, the index of the nearest centroid
+    (euclidean distance) and the squared distance to it.
+
+    >>> get_nearest_centroids(np.array([[0., 0.], [4., 5.], [1., 0.]]), np.array([[0., 0.], [4., 4.]]))
+    (array([0, 1, 0]), array([0., 1., 1.]))
+    """
+    labels = np.zeros(len(pData), dtype=int)
+    distances = np.zeros(len(pData))
+    centroid_norm = (pCentroids ** 2).sum(axis=1)
+    for start in range(0, len(pData), pChunkSize):
+        data = pData[start:start + pChunkSize]
+        squared_distance = (data ** 2).sum(axis=1)[:, np.newaxis] - 2 * data.dot(pCentroids.T) + centroid_norm
+        labels[start:start + pChunkSize] = np.argmin(squared_distance, axis=1)
+        distances[start:start + pChunkSize] = np.maximum(
+            squared_distance[np.arange(len(data)), labels[start:start + pChunkSize]], 0)
+    return labels, distances
+
+
+def minibatch_kmeans(pData, pK, pBatchSize=1000, pIterations=100, pRandomState=None):
+    """
+    Mini-batch k-means (Sculley, 2010, "Web-scale k-means clustering"). The
+    centroids are initialized with k-means++ on a sample of the data and each
+    iteration moves them towards the mean of their rows in a random batch of
+    pBatchSize rows, with a learning rate that decreases with the number of
+    rows each centroid has seen.
+
+    Returns
+    -------
+    centroids and the label of each row
+
+    >>> data = np.vstack([np.zeros((50, 2)), np.full((50, 2), 10.)])
+    >>> centroids, labels = minibatch_kmeans(data, 2, 20, 10, np.random.RandomState(0))
+    >>> np.sort(centroids[:, 0])
+    array([ 0., 10.])
+    >>> len(set(labels[:50])), len(set(labels[50:])), labels[0] != labels[-1]
+    (1, 1, True)
+    """
+    random_state = pRandomState if pRandomState is not None else np.random.RandomState(0)
+    num_rows = len(pData)
+
+    # k-means++ initialization
+    sample = pData[random_state.choice(num_rows, min(num_rows, max(pBatchSize, 3 * pK)), replace=False)]
+    centroids = [sample[random_state.randint(len(sample))]]
+    distances = get_nearest_centroids(sample, np.array(centroids))[1]
+    for _ in range(1, pK):
+        if distances.sum() > 0:
+            new_centroid = sample[random_state.choice(len(sample), p=distances / distances.sum())]
+        else:
+            new_centroid = sample[random_state.randint(len(sample))]
+        centroids.append(new_centroid)
+        distances = np.minimum(distances, ((sample - new_centroid) ** 2).sum(axis=1))
+    centroids = np.array(centroids, dtype=float)
+
+    counts = np.zeros(pK)
+    for _ in range(pIterations):
+        batch = pData[random_state.randint(0, num_rows, min(pBatchSize, num_rows))]
+        labels = get_nearest_centroids(batch, centroids)[0]
+        batch_counts = np.bincount(labels, minlength=pK)
+        batch_sums = coo_matrix((np.ones(len(labels)), (labels, np.arange(len(labels)))),
+                                shape=(pK, len(labels))).tocsr().dot(batch)
+        counts += batch_counts
+        updated = batch_counts > 0
+        centroids[updated] += (batch_sums[updated] - batch_counts[updated, np.newaxis] * centroids[updated]) / \
+            counts[updated, np.newaxis]
+
+    return centroids, get_nearest_centroids(pData, centroids)[0]
+
+
+def randomized_pca(pData, pComponents, pSampleSize=10000, pOversamples=10, pPowerIterations=4,
+                   pRandomState=None):
+    """
+    Projects the rows of pData onto their first pComponents principal
+    components. The components are computed with a randomized singular value
+    decomposition (Halko et al., 2011, "Finding structure with randomness")
+    of a random sample of at most pSampleSize rows, which is centered
+    implicitly, without copying it.
+
+    >>> data = np.random.RandomState(0).normal(size=(200, 3)) * [10, 1, 0.1]
+    >>> scores = randomized_pca(data, 2)
+    >>> scores.shape, np.allclose(np.abs(scores[:, 0]), np.abs(data[:, 0] - data[:, 0].mean()), atol=0.5)
+    ((200, 2), True)
+    """
+    random_state = pRandomState if pRandomState is not None else np.random.RandomState(0)
+    if len(pData) > pSampleSize:
+        sample = pData[np.sort(random_state.choice(len(pData), pSampleSize, replace=False))]
+    else:
+        sample = pData
+    mean = sample.mean(axis=0)
+
+    def multiply(pMatrix, pRows=sample):
+        # (pRows - mean) * pMatrix
+        return pRows.dot(pMatrix) - mean.dot(pMatrix)
+
+    def multiply_transposed(pMatrix):
+        # (sample - mean).T * pMatrix
+        return sample.T.dot(pMatrix) - np.outer(mean, pMatrix.sum(axis=0))
+
+    size = min(pComponents + pOversamples, min(sample.shape))
+    basis = np.linalg.qr(multiply(random_state.normal(size=(sample.shape[1], size))))[0]
+    for _ in range(pPowerIterations):
+        basis = np.linalg.qr(multiply_transposed(basis))[0]
+        basis = np.linalg.qr(multiply(basis))[0]
+    _, _, components = np.linalg.svd(multiply_transposed(basis).T, full_matrices=False)
+    return multiply(components[:pComponents].T, pData)
+
+
+def cluster_matrices(submatrices_dict, k, method='kmeans', how='full', pca_components=None,
+                     batch_size=None, num_centroids=None, seed=0):
     """
     clusters the submatrices per chromosome
 
 
     Parameters
     ----------
-    submatrices_dict key: chrom name, values, a list of submatrices
+    submatrices_dict key: chrom name, values, an array or list of submatrices
     k number of clusters
     method either kmeans or hierarchical
     how how to cluster. Options are 'full', 'center' and 'diagonal'. More info in the argparse options
+    pca_components if given, the submatrices are clustered by their first principal components
+    batch_size if given, mini-batch k-means with batches of this size is used instead of k-means
+    num_centroids if given, the hierarchical clustering is computed on this number of
+                  mini-batch k-means centroids instead of on all submatrices
+    seed seed of the random numbers of the principal components and of the mini-batch k-means
 
     Returns
     -------
@@ -242,30 +396,23 @@ def cluster_matrices(submatrices_dict, k, method='kmeans', how='full'):
     clustered_dict = {}
     for chrom in submatrices_dict:
         log.info("Length of entry: {}".format(len(submatrices_dict[chrom])))
-        submat_vectors = []
-        shape = submatrices_dict[chrom][0].shape
-        center_bin = (shape[0] + 1) // 2
-        for submatrix in submatrices_dict[chrom]:
-            if how == 'diagonal':
-                # take from each matrix the diagonal
-                submat_vectors.append(submatrix.diagonal())
-            elif how == 'center':
-                # take the mean of a  smaller submatrix of 3 x 3 centered on the submatrix
-                submat_vectors.append(
-                    submatrix[center_bin - 2:center_bin + 1, center_bin - 2:center_bin + 1].reshape((1, 9)).mean())
-            else:
-                # Transform list of submatrices in an array of shape:
-                # shape = (num_submatrices, submatrix.shape[0] * submatrix.shape[1]
-                # In other words, each submatrix is converted into a row of the matrix
-                submat_vectors.append(submatrix.reshape((1, shape[0] * shape[1])))
-
-        matrix = np.vstack(submat_vectors)
+        submatrices = np.asarray(submatrices_dict[chrom])
+        num_submatrices, size = submatrices.shape[:2]
+        center_bin = (size + 1) // 2
         if how == 'diagonal':
-            assert matrix.shape == (len(submatrices_dict[chrom]), shape[0])
+            # take from each matrix the diagonal
+            matrix = np.diagonal(submatrices, axis1=1, axis2=2).copy()
+            assert matrix.shape == (num_submatrices, size)
         elif how == 'center':
-            assert matrix.shape == (len(submatrices_dict[chrom]), 1)
+            # take the mean of a  smaller submatrix of 3 x 3 centered on the submatrix
+            matrix = submatrices[:, center_bin - 2:center_bin + 1, center_bin - 2:center_bin + 1].reshape(
+                (num_submatrices, 9)).mean(axis=1)[:, np.newaxis]
+            assert matrix.shape == (num_submatrices, 1)
         else:
-            assert matrix.shape == (len(submatrices_dict[chrom]), shape[0] * shape[1])
+            # Transform the submatrices in an array of shape:
+            # shape = (num_submatrices, submatrix.shape[0] * submatrix.shape[1]
+            # In other words, each submatrix is converted into a row of the matrix
+            matrix = submatrices.reshape((num_submatrices, size * size)).copy()
 
         # remove outliers
         out_ind = get_outlier_indices(matrix, max_deviation=2)
@@ -281,19 +428,38 @@ def cluster_matrices(submatrices_dict, k, method='kmeans', how='full'):
             log.warning("For clustering nan values have to be replaced by zeros.")
             matrix[np.isnan(matrix)] = 0
 
+        random_state = np.random.RandomState(seed)
+        if pca_components is not None and pca_components < matrix.shape[1]:
+            log.info("Reducing the {} values of each submatrix to {} principal components.".
+                     format(matrix.shape[1], pca_components))
+            matrix = randomized_pca(matrix, pca_components, pRandomState=random_state)
+
         if method == 'kmeans':
-            from scipy.cluster.vq import vq, kmeans
+            if batch_size is not None:
+                _, cluster_labels = minibatch_kmeans(matrix, k, pBatchSize=batch_size, pRandomState=random_state)
+            else:
+                from scipy.cluster.vq import vq, kmeans
 
-            centroids, _ = kmeans(matrix, k)
-            # order the centroids in an attempt to
-            # get the same cluster order
-            cluster_labels, _ = vq(matrix, centroids)
+                centroids, _ = kmeans(matrix, k)
+                # order the centroids in an attempt to
+                # get the same cluster order
+                cluster_labels, _ = vq(matrix, centroids)
 
         if method == 'hierarchical':
             # normally too slow for large data sets
             from scipy.cluster.hierarchy import fcluster, linkage
-            Z = linkage(matrix, method='ward', metric='euclidean')
-            cluster_labels = fcluster(Z, k, criterion='maxclust')
+            if num_centroids is not None and num_centroids < len(matrix):
+                # Ward linkage of the centroids of a mini-batch k-means clustering,
+                # each submatrix gets the cluster of its centroid
+                centroids, centroid_labels = minibatch_kmeans(matrix, num_centroids,
+                                                              pBatchSize=batch_size or 1000,
+                                                              pRandomState=random_state)
+                used_centroids, centroid_labels = np.unique(centroid_labels, return_inverse=True)
+                Z = linkage(centroids[used_centroids], method='ward', metric='euclidean')
+                cluster_labels = fcluster(Z, k, criterion='maxclust')[centroid_labels]
+            else:
+                Z = linkage(matrix, method='ward', metric='euclidean')
+                cluster_labels = fcluster(Z, k, criterion='maxclust')
             # hierarchical clustering labels from 1 .. k
             # while k-means labels 0 .. k -1
             # Thus, for consistency, we subtract 1
@@ -308,36 +474,25 @@ def cluster_matrices(submatrices_dict, k, method='kmeans', how='full'):
     return clustered_dict
 
 
-def plot_aggregated_contacts(chrom_matrix, chrom_contact_position, cluster_ids, num_clusters, M_half, args):
+def plot_aggregated_contacts(chrom_aggregator, cluster_ids, num_clusters, M_half, args):
 
-    num_chromosomes = len(chrom_matrix)
+    num_chromosomes = len(chrom_aggregator)
 
     fig = plt.figure(figsize=(5.5 * num_chromosomes, 5.5 * num_clusters + 0.5))
     gs = gridspec.GridSpec(num_clusters + 1, num_chromosomes,
-                           width_ratios=[10] * len(chrom_matrix),
+                           width_ratios=[10] * len(chrom_aggregator),
                            height_ratios=[10] * num_clusters + [0.6])
 
     gs.update(wspace=0.01, hspace=0.2)
     chrom_avg = {}
-    chrom_cluster_len = {}
-    for idx, chrom in enumerate(chrom_matrix):
+    for idx, chrom in enumerate(chrom_aggregator):
         chrom_avg[chrom] = []
-        chrom_cluster_len[chrom] = []
-        for cluster_number, cluster_indices in enumerate(cluster_ids[chrom]):
-            # compute median values
-            if num_clusters == 1:
-                # this means no clustering
-                submatrices = np.array(chrom_matrix[chrom])
-            else:
-                submatrices = np.array([chrom_matrix[chrom][x] for x in cluster_indices])
-
-            chrom_cluster_len[chrom].append(len(cluster_ids))
-
+        for cluster_number, aggregator in enumerate(chrom_aggregator[chrom]):
             if args.avgType == 'median':
-                _median = np.median(submatrices, axis=0)
+                _median = aggregator.median()
                 if _median.sum() == 0 or np.isnan(_median.sum()):
                     # test if the mean matrix is not zero
-                    if np.mean(submatrices, axis=0).sum() != 0:
+                    if aggregator.mean().sum() != 0:
                         log.info("The median of the matrices is zero. Consider using "
                                  "the mean instead.")
                     else:
@@ -345,15 +500,16 @@ def plot_aggregated_contacts(chrom_matrix, chrom_contact_position, cluster_ids,
                                  "zeros or nans.")
                 chrom_avg[chrom].append(_median)
             else:
-                chrom_avg[chrom].append(np.mean(submatrices, axis=0))
+                chrom_avg[chrom].append(aggregator.mean())
 
-            log.info("Mean aggregate matrix values: {}".format(chrom_avg[chrom][cluster_number].mean()))
+            log.info("Mean aggregate matrix values: {} (mean standard deviation: {})".
+                     format(chrom_avg[chrom][cluster_number].mean(), aggregator.std().mean()))
 
     vmin, vmax = (args.vMin, args.vMax)
     cmap = cm.get_cmap(args.colorMap)
 
     log.debug("vmax: {}, vmin: {}".format(vmax, vmin))
-    for idx, chrom in enumerate(chrom_matrix):
+    for idx, chrom in enumerate(chrom_aggregator):
         for cluster_number, cluster_indices in enumerate(cluster_ids[chrom]):
             log.info("total pairs considered for {}, cluster_{}: {}".format(chrom, cluster_number + 1,
                                                                             len(cluster_indices)))
@@ -492,8 +648,251 @@ def plot_diagnostic_heatmaps(chrom_diagonals, cluster_ids, M_half, args):
     plt.close()
 
 
+def get_bin_ids(pBinStarts, pBinEnds, pIntervals, pChromSize):
+    """
+    Maps each interval to the bin that contains its start, like
+    hiCMatrix.getRegionBinRange does for each single interval, using the sorted
+    bin starts of a chromosome. Intervals that end after the chromosome or whose
+    start or end is not in a bin get -1.
+
+    >>> starts = np.array([0, 10, 20])
+    >>> ends = np.array([10, 20, 30])
+    >>> get_bin_ids(starts, ends, [(5, 6), (10, 25), (25, 30), (29, 31)], 30)
+    array([ 0,  1, -1, -1])
+    """
+    intervals = np.array(pIntervals, dtype=np.int64).reshape(-1, 2)
+    bin_ids = []
+    for position in [intervals[:, 0], intervals[:, 1]]:
+        bin_id = np.searchsorted(pBinStarts, position, side='right') - 1
+        in_bin = (bin_id >= 0) & (position < pBinEnds[np.maximum(bin_id, 0)])
+        bin_ids.append(np.where(in_bin, bin_id, -1))
+    return np.where((bin_ids[1] >= 0) & (intervals[:, 1] <= pChromSize), bin_ids[0], -1)
+
+
+def get_window_pairs(pBinIds, pBinIds2, pMinDistance, pMaxDistance):
+    """
+    Finds the pairs of intervals of the two lists whose bins are between
+    pMinDistance and pMaxDistance bins apart. For each interval of the first
+    list, the intervals of the second list in range are found with a binary
+    search in the sorted bins of the second list. Only the first pair of each
+    pair of bins is kept, in the order of the first and then the second list.
+
+    Returns
+    -------
+    indices of the intervals of the first and of the second list
+
+    >>> get_window_pairs(np.array([0, 5, 9]), np.array([5, 0, 9, 3]), 3, 5)
+    (array([0, 0, 1]), array([0, 3, 2]))
+    """
+    valid2 = np.flatnonzero(pBinIds2 >= 0)
+    order2 = valid2[np.argsort(pBinIds2[valid2], kind='stable')]
+    sorted_bins2 = pBinIds2[order2]
+
+    first_distance = max(pMinDistance, 1)
+    index1 = []
+    index2 = []
+    valid1 = np.flatnonzero(pBinIds >= 0)
+    for low, high in [(pBinIds[valid1] - pMaxDistance, pBinIds[valid1] - first_distance),
+                      (pBinIds[valid1] + first_distance, pBinIds[valid1] + pMaxDistance)]:
+        window_start = np.searchsorted(sorted_bins2, low, side='left')
+        window_end = np.searchsorted(sorted_bins2, high, side='right')
+        counts = np.maximum(window_end - window_start, 0)
+        repeated = np.repeat(np.arange(len(valid1)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        index1.append(valid1[repeated])
+        index2.append(order2[window_start[repeated] + offsets])
+    index1 = np.concatenate(index1)
+    index2 = np.concatenate(index2)
+
+    order = np.lexsort((index2, index1))
+    index1 = index1[order]
+    index2 = index2[order]
+    bins1 = pBinIds[index1]
+    bins2 = pBinIds2[index2]
+    keys = np.minimum(bins1, bins2).astype(np.int64) * (max(pBinIds.max(), pBinIds2.max()) + 1) + \
+        np.maximum(bins1, bins2)
+    _, first = np.unique(keys, return_index=True)
+    first.sort()
+    return index1[first], index2[first]
+
+
+def get_matrix_band(pMatrix, pMaxDistance):
+    """
+    Returns the pixels of the band of the matrix within pMaxDistance bins of
+    the main diagonal as sorted keys (row * number of bins + col), their values
+    and the number of bins, to be used by get_submatrices.
+
+    >>> from scipy.sparse import csr_matrix
+    >>> get_matrix_band(csr_matrix(np.arange(9).reshape(3, 3)), 1)
+    (array([1, 3, 4, 5, 7, 8]), array([1., 3., 4., 5., 7., 8.]), 3)
+    """
+    matrix = pMatrix.tocoo()
+    band = np.abs(matrix.col - matrix.row) <= pMaxDistance
+    num_bins = pMatrix.shape[1]
+    keys = matrix.row[band].astype(np.int64) * num_bins + matrix.col[band]
+    order = np.argsort(keys)
+    return keys[order], matrix.data[band][order].astype(float), num_bins
+
+
+def get_submatrices(pBand, pRows, pCols, pHalfWidth, pChunkSize=100000):
+    """
+    Extracts the submatrices of (2 * pHalfWidth + 1) x (2 * pHalfWidth + 1)
+    bins centered at each (row, col) into a 3D array. The band of the matrix,
+    as returned by get_matrix_band, has to contain all submatrices. Its values
+    are looked up for all submatrices at once with a binary search on the
+    sorted pixel keys.
+
+    >>> from scipy.sparse import csr_matrix
+    >>> band = get_matrix_band(csr_matrix(np.arange(36, dtype=float).reshape(6, 6)), 4)
+    >>> get_submatrices(band, np.array([1, 2]), np.array([3, 4]), 1)[1]
+    array([[ 9., 10., 11.],
+           [15., 16., 17.],
+           [21., 22., 23.]])
+    """
+    keys, data, num_bins = pBand
+    offsets = np.arange(-pHalfWidth, pHalfWidth + 1)
+    size = len(offsets)
+    submatrices = np.zeros((len(pRows), size, size))
+    chunk = max(pChunkSize // (size * size), 1)
+    for start in range(0, len(pRows), chunk):
+        rows = pRows[start:start + chunk, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis]
+        cols = pCols[start:start + chunk, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]
+        query = rows.astype(np.int64) * num_bins + cols
+        position = np.minimum(np.searchsorted(keys, query), max(len(keys) - 1, 0))
+        if len(keys):
+            found = keys[position] == query
+            submatrices[start:start + chunk][found] = data[position[found]]
+    return submatrices
+
+
+class SubmatrixAggregator(object):
+    """
+    Accumulates the sum and the sum of squares of submatrices of the same
+    shape, which are added in chunks, and keeps a uniform random sample
+    (reservoir) of at most pReservoirSize of them. The mean and the standard
+    deviation are computed from all submatrices, the median from the
+    reservoir. As long as no more than pReservoirSize submatrices were added,
+    the reservoir contains all of them in the order they were added and the
+    median is exact.
+
+    >>> aggregator = SubmatrixAggregator((1, 2), 2)
+    >>> aggregator.add(np.array([[[1., 2.]], [[3., 4.]]]))
+    >>> aggregator.add(np.array([[[5., 12.]]]))
+    >>> aggregator.count, len(aggregator.reservoir)
+    (3, 2)
+    >>> aggregator.mean()
+    array([[3., 6.]])
+    """
+
+    def __init__(self, pShape, pReservoirSize, pSeed=0):
+        self.count = 0
+        self.sum = np.zeros(pShape)
+        self.sum_of_squares = np.zeros(pShape)
+        self.reservoir = np.zeros((0,) + tuple(pShape))
+        self.reservoirSize = pReservoirSize
+        self.randomState = np.random.RandomState(pSeed)
+
+    def add(self, pSubmatrices):
+        self.sum += pSubmatrices.sum(axis=0)
+        self.sum_of_squares += (pSubmatrices ** 2).sum(axis=0)
+
+        free = min(max(self.reservoirSize - len(self.reservoir), 0), len(pSubmatrices))
+        if free > 0:
+            self.reservoir = np.concatenate([self.reservoir, pSubmatrices[:free]])
+        if len(pSubmatrices) > free and self.reservoirSize > 0:
+            # reservoir sampling: the n-th submatrix replaces a random
+            # one of the reservoir with probability reservoirSize / n
+            seen = self.count + np.arange(free, len(pSubmatrices)) + 1
+            position = self.randomState.randint(0, seen)
+            replace = position < self.reservoirSize
+            # in case of repeated positions the later submatrix is kept
+            self.reservoir[position[replace]] = pSubmatrices[free:][replace]
+        self.count += len(pSubmatrices)
+
+    def mean(self):
+        return self.sum / self.count
+
+    def std(self):
+        return np.sqrt(np.maximum(self.sum_of_squares / self.count - self.mean() ** 2, 0))
+
+    def median(self):
+        return np.median(self.reservoir, axis=0)
+
+
+def aggregate_chromosome(pMatrix, pBinStarts, pBinEnds, pIntervals, pIntervals2, pChromSize, pMinDistance,
+                         pMaxDistance, pHalfWidth, pTotalCounts, pReservoirSize, pKeepSubmatrices,
+                         pKeepContactPairs, pChunkSize=1000):
+    """
+    Computes the submatrices centered at the pairs of intervals of a
+    chromosome that are in range and adds the non empty ones, chunk by chunk,
+    to a SubmatrixAggregator. The submatrices are only returned if
+    pKeepSubmatrices is set (needed for the clustering) and the center values
+    and positions of the pairs only if pKeepContactPairs is set.
+
+    Returns
+    -------
+    aggregator, submatrices, center values, contact positions, number of pairs
+    in range, number of empty submatrices and number of center values over 1.5
+    """
+    bin_ids = get_bin_ids(pBinStarts, pBinEnds, pIntervals, pChromSize)
+    bin_ids2 = get_bin_ids(pBinStarts, pBinEnds, pIntervals2, pChromSize)
+
+    index1, index2 = get_window_pairs(bin_ids, bin_ids2, pMinDistance, pMaxDistance)
+    idx1 = np.minimum(bin_ids[index1], bin_ids2[index2])
+    idx2 = np.maximum(bin_ids[index1], bin_ids2[index2])
+    inside = (idx1 - pHalfWidth >= 0) & (idx2 + 1 + pHalfWidth <= pMatrix.shape[0])
+    index1, index2, idx1, idx2 = index1[inside], index2[inside], idx1[inside], idx2[inside]
+
+    band = get_matrix_band(pMatrix, pMaxDistance + 2 * pHalfWidth)
+    size = 2 * pHalfWidth + 1
+    aggregator = SubmatrixAggregator((size, size), pReservoirSize)
+    submatrices = []
+    center_values = []
+    contact_positions = []
+    empty_mat = 0
+    over_1_5 = 0
+    for start in range(0, len(idx1), pChunkSize):
+        chunk = get_submatrices(band, idx1[start:start + pChunkSize], idx2[start:start + pChunkSize], pHalfWidth)
+        submatrix_sum = chunk.sum(axis=(1, 2))
+        non_empty = submatrix_sum != 0
+        empty_mat += len(chunk) - non_empty.sum()
+        chunk = chunk[non_empty]
+
+        center = chunk[:, pHalfWidth, pHalfWidth].copy()
+        over_1_5 += (center > 1.5).sum()
+        if pTotalCounts:
+            # to account for the fact that submatrices
+            # close to the diagonal have more counts thatn
+            # submatrices far from the diagonal
+            # the submatrices values are normalized using the
+            # total submatrix sum.
+            chunk /= submatrix_sum[non_empty][:, np.newaxis, np.newaxis]
+
+        aggregator.add(chunk)
+        if pKeepSubmatrices:
+            submatrices.append(chunk)
+        if pKeepContactPairs:
+            center_values.extend(center)
+            contact_positions.extend([pIntervals[i] + pIntervals2[j] for i, j in
+                                      zip(index1[start:start + pChunkSize][non_empty],
+                                          index2[start:start + pChunkSize][non_empty])])
+
+    if pKeepSubmatrices:
+        submatrices = np.concatenate(submatrices) if submatrices else np.zeros((0, size, size))
+    else:
+        submatrices = None
+    return aggregator, submatrices, center_values, contact_positions, len(idx1), empty_mat, over_1_5
+
+
+def aggregate_chromosome_wrapper(pArgs):
+    return aggregate_chromosome(*pArgs)
+
+
 def main(args=None):
     args = parse_arguments().parse_args(args)
+    if args.hclustCentroids is not None and args.hclust is None:
+        log.error("--hclustCentroids can only be used together with --hclust.")
+        exit(1)
 
     ma = hm.hiCMatrix(args.matrix)
     ma.maskBins(ma.nan_bins)
@@ -536,126 +935,106 @@ def main(args=None):
 
     M = args.numberOfBins if args.numberOfBins % 2 == 1 else args.numberOfBins + 1
     M_half = int((M - 1) // 2)
-    # make a new matrix for each chromosome.
-    chrom_matrix = OrderedDict()
-    chrom_total = {}
-    chrom_diagonals = OrderedDict()
-    chrom_contact_position = {}
-    seen = {}
-
-    center_values = {}
+    clustering = args.kmeans is not None or args.hclust is not None
+    # without clustering, only a sample of the submatrices is needed for the median
+    # and the diagnostic heatmap, while the mean is computed from all of them
+    reservoir_size = 0
+    if args.avgType == 'median' or args.diagnosticHeatmapFile:
+        reservoir_size = args.reservoirSize
 
     chrom_list = check_chrom_str_bytes(bed_intervals, chrom_list)
 
+    TASKS = []
+    task_chroms = []
     for chrom in chrom_list:
         if chrom not in bed_intervals:
             continue
 
-        chrom_matrix[chrom] = []
-        chrom_total[chrom] = 1
-        chrom_diagonals[chrom] = []
-        chrom_contact_position[chrom] = []
-        center_values[chrom] = []
-        seen[chrom] = set()
-        over_1_5 = 0
-        empty_mat = 0
         chrom_bin_range = ma.getChrBinRange(toString(chrom))
+        cut_intervals = ma.cut_intervals[chrom_bin_range[0]:chrom_bin_range[1]]
+        bin_starts = np.array([interval[1] for interval in cut_intervals])
+        bin_ends = np.array([interval[2] for interval in cut_intervals])
+        submatrix = ma.matrix[chrom_bin_range[0]:chrom_bin_range[1], chrom_bin_range[0]:chrom_bin_range[1]]
+        TASKS.append((submatrix, bin_starts, bin_ends, bed_intervals[chrom], bed_intervals2.get(chrom, []),
+                      chrom_sizes[chrom], min_dist_in_bins, max_dist_in_bins, M_half,
+                      args.transform == 'total_counts', reservoir_size, clustering,
+                      bool(args.outFileContactPairs)))
+        task_chroms.append(chrom)
+
+    if args.numberOfProcessors > 1 and len(TASKS) > 1:
+        pool = multiprocessing.Pool(min(args.numberOfProcessors, len(TASKS)))
+        results = pool.map_async(aggregate_chromosome_wrapper, TASKS).get(9999999)
+        pool.close()
+        pool.join()
+    else:
+        results = [aggregate_chromosome(*task) for task in TASKS]
 
+    # make a new matrix for each chromosome.
+    chrom_aggregator = OrderedDict()
+    chrom_matrix = OrderedDict()
+    chrom_contact_position = {}
+    center_values = {}
+    for chrom, result in zip(task_chroms, results):
+        aggregator, submatrices, center_values[chrom], chrom_contact_position[chrom], \
+            num_pairs, empty_mat, over_1_5 = result
         log.info("processing {}".format(chrom))
+        log.info("Number of contacts within range computed: {:,}".format(num_pairs))
 
-        counter = 0
-        for start, end in bed_intervals[chrom]:
-            # check all other regions that may interact with the
-            # current interval at the given depth range
-            if end > chrom_sizes[chrom]:
-                continue
-            bin_id = ma.getRegionBinRange(toString(chrom), start, end)
-            if bin_id is None:
-                continue
-            else:
-                bin_id = bin_id[0]
-
-            for start2, end2 in bed_intervals2[chrom]:
-                counter += 1
-                if counter % 50000 == 0:
-                    log.info("Number of contacts considered: {:,}".format(counter))
-
-                if end2 > chrom_sizes[chrom]:
-                    continue
-                bin_id2 = ma.getRegionBinRange(toString(chrom), start2, end2)
-                if bin_id2 is None:
-                    continue
-                else:
-                    bin_id2 = bin_id2[0]
-                if bin_id2 in seen[chrom]:
-                    continue
-                if bin_id == bin_id2:
-                    continue
-                if min_dist_in_bins <= abs(bin_id2 - bin_id) <= max_dist_in_bins:
-                    idx1, idx2 = sorted([bin_id, bin_id2])
-                    if (idx1, idx2) in seen[chrom]:
-                        continue
-                    seen[chrom].add((idx1, idx2))
-                    if idx1 - M_half < chrom_bin_range[0] or idx2 + 1 + M_half > chrom_bin_range[1]:
-                        continue
-                    try:
-                        mat_to_append = ma.matrix[idx1 - M_half:idx1 + M_half + 1, :][:, idx2 - M_half:idx2 + M_half + 1].todense().astype(float)
-                    except IndexError:
-                        log.info("index error for {} {}".format(idx1, idx2))
-                        continue
-                    counter += 1
-                    if counter % 1000 == 0:
-                        log.info("Number of contacts within range computed: {:,}".format(counter))
-                    if mat_to_append.sum() == 0:
-                        empty_mat += 1
-                        continue
-                    # to account for the fact that submatrices
-                    # close to the diagonal have more counts thatn
-                    # submatrices far from the diagonal
-                    # the submatrices values are normalized using the
-                    # total submatrix sum.
-
-                    if args.transform == 'total_counts' and mat_to_append.sum() > 0:
-                        mat_to_append = mat_to_append / mat_to_append.sum()
-
-                    chrom_total[chrom] += 1
-                    chrom_matrix[chrom].append(mat_to_append)
-                    chrom_diagonals[chrom].append(mat_to_append.diagonal())
-                    center_values[chrom].append(ma.matrix[idx1, idx2])
-                    chrom_contact_position[chrom].append((start, end, start2, end2))
-                    if ma.matrix[idx1, idx2] > 1.5:
-                        over_1_5 += 1
-
-        if len(chrom_matrix[chrom]) == 0:
+        if aggregator.count == 0:
             log.warn("No valid submatrices were found for chrom: {}".format(chrom))
-            chrom_matrix.pop(chrom, None)
+            continue
+        chrom_aggregator[chrom] = aggregator
+        if clustering:
+            chrom_matrix[chrom] = submatrices
 
         log.info("Number of matrices with ratio over 1.5 at center {}, fraction w.r.t. non empty submatrices: ({:.2f})".
-                 format(over_1_5, float(over_1_5) / len(chrom_matrix[chrom])))
+                 format(over_1_5, float(over_1_5) / aggregator.count))
 
         log.info("Number of discarded empty submatrices  {} ({:.2f})".
-                 format(empty_mat, float(empty_mat) / counter))
+                 format(empty_mat, float(empty_mat) / max(num_pairs, 1)))
 
+    chrom_diagonals = OrderedDict()
     if args.kmeans is not None:
-        cluster_ids = cluster_matrices(chrom_matrix, args.kmeans, method='kmeans', how=args.howToCluster)
+        cluster_ids = cluster_matrices(chrom_matrix, args.kmeans, method='kmeans', how=args.howToCluster,
+                                       pca_components=args.pcaComponents, batch_size=args.kmeansBatchSize,
+                                       seed=args.seed)
         num_clusters = args.kmeans
     elif args.hclust is not None:
         log.info("Performing hierarchical clustering."
                  "Please note that it might be very slow for large datasets.\n")
         cluster_ids = cluster_matrices(chrom_matrix, args.hclust, method='hierarchical',
-                                       how=args.howToCluster)
+                                       how=args.howToCluster, pca_components=args.pcaComponents,
+                                       batch_size=args.kmeansBatchSize, num_centroids=args.hclustCentroids,
+                                       seed=args.seed)
         num_clusters = args.hclust
     else:
         # make a 'fake' clustering to generalize the plotting of the submatrices
         cluster_ids = {}
         num_clusters = 1
-        for chrom in chrom_list:
-            cluster_ids[chrom] = [range(len(chrom_matrix[chrom]))]
+        for chrom, aggregator in iteritems(chrom_aggregator):
+            cluster_ids[chrom] = [range(aggregator.count)]
+            chrom_diagonals[chrom] = list(np.diagonal(aggregator.reservoir, axis1=1, axis2=2))
+        diagnostic_ids = {chrom: [range(len(chrom_diagonals[chrom]))] for chrom in chrom_diagonals}
+
+    if clustering:
+        # replace the aggregates of each chromosome by the aggregates of each cluster
+        for chrom, submatrices in iteritems(chrom_matrix):
+            chrom_aggregator[chrom] = []
+            for cluster_indices in cluster_ids[chrom]:
+                cluster_submatrices = submatrices if num_clusters == 1 else submatrices[cluster_indices]
+                aggregator = SubmatrixAggregator(submatrices.shape[1:], len(cluster_submatrices))
+                aggregator.add(cluster_submatrices)
+                chrom_aggregator[chrom].append(aggregator)
+            chrom_diagonals[chrom] = list(np.diagonal(submatrices, axis1=1, axis2=2))
+        diagnostic_ids = cluster_ids
+    else:
+        for chrom in chrom_aggregator:
+            chrom_aggregator[chrom] = [chrom_aggregator[chrom]]
 
-    plot_aggregated_contacts(chrom_matrix, chrom_contact_position, cluster_ids, num_clusters, M_half, args)
+    plot_aggregated_contacts(chrom_aggregator, cluster_ids, num_clusters, M_half, args)
 
     if args.outFileContactPairs:
-        for idx, chrom in enumerate(chrom_matrix):
+        for idx, chrom in enumerate(chrom_aggregator):
 
             for cluster_number, cluster_indices in enumerate(cluster_ids[chrom]):
                 center_values_to_order = np.array(center_values[chrom])[cluster_indices]
@@ -672,4 +1051,4 @@ def main(args=None):
     # plot the diagonals
     # the diagonals plot is useful to see individual cases and if they had a contact in the center
     if args.diagnosticHeatmapFile:
-        plot_diagnostic_heatmaps(chrom_diagonals, cluster_ids, M_half, args)
+        plot_diagnostic_heatmaps(chrom_diagonals, diagnostic_ids, M_half, args)
@@ -0,0 +1,452 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+import argparse
+import logging
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+from scipy.sparse import coo_matrix, triu
+from scipy.stats import pearsonr, spearmanr
+
+from hicmatrix import HiCMatrix as hm
+from hicexplorer import hicFindTADs
+from hicexplorer.hicCorrectMatrix import filter_by_zscore
+from hicexplorer.iterativeCorrection import iterativeCorrection
+from hicexplorer._version import __version__
+from hicexplorer.utilities import toString, share_arrays, get_shared_arrays
+
+# for plotting
+from matplotlib import use as mplt_use
+mplt_use('Agg')
+import matplotlib.pyplot as plt
+
+# python 2 / 3 compatibility
+from past.builtins import zip
+from builtins import range
+
+log = logging.getLogger(__name__)
+
+# these are holders for the upper triangle of the matrix, the indices of the pixels used
+# for the correlations and the bins of the matrix that are used by the processes
+# that compute the subsamples. In the worker processes the arrays are views of
+# shared memory (see share_arrays)
+shared_row = None
+shared_col = None
+shared_counts = None
+shared_correlation_idx = None
+shared_shape = None
+shared_cut_intervals = None
+
+
+def parse_arguments(args=None):
+    """
+    get command line arguments
+    """
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        conflict_handler='resolve',
+        description="""
+Estimates whether a Hi-C library was sequenced deep enough. The contacts of an uncorrected
+Hi-C matrix are subsampled to several fractions of the reads and each subsample is compared
+with the whole matrix. Each read is kept with a probability equal to the fraction (binomial
+sampling) or the given fraction of the reads is sampled with replacement (multinomial sampling).
+The fractions are processed in parallel.
+
+For each fraction the following metrics are computed:
+
+ * correlation: Pearson and Spearman correlation of the contacts of the subsample and of the
+   whole matrix.
+ * tads: the subsample is corrected as in `hicCorrectMatrix` and its TAD boundaries are found
+   as in `hicFindTADs`. The recall is the fraction of the boundaries of the whole matrix found
+   in the subsample and the precision is the fraction of the boundaries of the subsample found
+   in the whole matrix.
+
+If the metrics barely change for the largest fractions, deeper sequencing of the library
+is not expected to improve them.
+
+ A simple example usage is:
+
+$ hicComputeSaturation -m hic_matrix.h5 --outPrefix saturation -p 10
+
+The metrics are saved in <outPrefix>_saturation.tsv and plotted in <outPrefix>_saturation.png
+""")
+
+    parserRequired = parser.add_argument_group('Required arguments')
+
+    parserRequired.add_argument('--matrix', '-m',
+                                help='Uncorrected Hi-C matrix, containing read counts.',
+                                required=True)
+
+    parserRequired.add_argument('--outPrefix',
+                                help='File prefix to save the resulting files: 1. <prefix>_saturation.tsv '
+                                'The metrics of each fraction, including the whole matrix (fraction 1). '
+                                '2. <prefix>_saturation.<plotFileFormat> The plot of the metrics.',
+                                required=True)
+
+    parserOpt = parser.add_argument_group('Optional arguments')
+
+    parserOpt.add_argument('--fractions',
+                           help='Fractions of the reads to subsample.',
+                           type=float,
+                           nargs='+',
+                           default=[0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9])
+
+    parserOpt.add_argument('--sampling',
+                           help='binomial: each read is kept with a probability equal to the fraction. '
+                           'multinomial: the number of reads given by the fraction is sampled with '
+                           'replacement.',
+                           choices=['binomial', 'multinomial'],
+                           default='binomial')
+
+    parserOpt.add_argument('--metrics',
+                           help='Metrics to compute for each fraction.',
+                           choices=['correlation', 'tads'],
+                           nargs='+',
+                           default=['correlation', 'tads'])
+
+    parserOpt.add_argument('--seed',
+                           help='Seed of the random number generator. The same seed gives the same subsamples.',
+                           type=int,
+                           default=0)
+
+    parserOpt.add_argument('--range',
+                           help='In bp with the format low_range:high_range, for example 1000000:2000000. '
+                           'If given, only the intra-chromosomal contacts in this range are correlated.')
+
+    parserOpt.add_argument('--log1p',
+                           help='If set, the log1p of the contacts is correlated.',
+                           action='store_true')
+
+    parserOpt.add_argument('--filterThreshold',
+                           help='Lower and upper threshold used to remove bins of low or large coverage '
+                           'before the correction of each subsample (see hicCorrectMatrix).',
+                           type=float,
+                           nargs=2,
+                           default=[-1.5, 5])
+
+    parserOpt.add_argument('--iterNum',
+                           help='Number of iterations of the correction of each subsample.',
+                           type=int,
+                           default=500)
+
+    parserOpt.add_argument('--minDepth',
+                           help='Minimum window length (in bp) to be considered to the left and to the right '
+                           'of each Hi-C bin (see hicFindTADs).',
+                           metavar='INT bp',
+                           type=int)
+
+    parserOpt.add_argument('--maxDepth',
+                           help='Maximum window length to be considered to the left and to the right '
+                           'of the cut point in bp (see hicFindTADs).',
+                           metavar='INT bp',
+                           type=int)
+
+    parserOpt.add_argument('--step',
+                           help='Step size when moving from --minDepth to --maxDepth (see hicFindTADs).',
+                           metavar='INT bp',
+                           type=int)
+
+    parserOpt.add_argument('--correctForMultipleTesting',
+                           help='Multiple comparison method used to find the boundaries (see hicFindTADs).',
+                           type=str,
+                           default="fdr",
+                           choices=['fdr', 'bonferroni', 'None'])
+
+    parserOpt.add_argument('--thresholdComparisons',
+                           help='P-value threshold for the bonferroni correction / q-value for FDR used to find '
+                           'the boundaries (see hicFindTADs).',
+                           type=float,
+                           default=0.01)
+
+    parserOpt.add_argument('--delta',
+                           help='Minimum threshold of the difference between the TAD-separation score of a '
+                           'putative boundary and the mean of the TAD-sep. score of surrounding bins '
+                           '(see hicFindTADs).',
+                           type=float,
+                           default=0.01)
+
+    parserOpt.add_argument('--minBoundaryDistance',
+                           help='Minimum distance between boundaries (in bp) (see hicFindTADs).',
+                           metavar='INT bp',
+                           type=int)
+
+    parserOpt.add_argument('--boundaryTolerance',
+                           help='Boundaries of a subsample and of the whole matrix that are at most this '
+                           'number of bins apart are considered the same boundary.',
+                           type=int,
+                           default=1)
+
+    parserOpt.add_argument('--chromosomes',
+                           help='Chromosomes to include in the analysis.',
+                           nargs='+')
+
+    parserOpt.add_argument('--plotFileFormat',
+                           help='Image format of the plot.',
+                           choices=['png', 'pdf', 'svg', 'eps'],
+                           default='png')
+
+    parserOpt.add_argument('--numberOfProcessors', '-p',
+                           help='Number of processors to use. Each fraction is processed by one processor.',
+                           type=int,
+                           default=1)
+
+    parserOpt.add_argument('--help', '-h', action='help', help='show this help message and exit.')
+
+    parserOpt.add_argument('--version', action='version',
+                           version='%(prog)s {}'.format(__version__))
+    return parser
+
+
+def set_shared_arrays(shared, shape, cut_intervals):
+    """
+    Initializer of the worker processes. Sets the module level holders of the
+    upper triangle of the matrix as views of the arrays created by `share_arrays`
+    """
+    global shared_row, shared_col, shared_counts, shared_correlation_idx, shared_shape, shared_cut_intervals
+    shared_row, shared_col, shared_counts, shared_correlation_idx = get_shared_arrays(shared)
+    shared_shape = shape
+    shared_cut_intervals = cut_intervals
+
+
+def subsample_counts(counts, fraction, sampling='binomial', random_state=None):
+    """
+    Subsamples the reads of the given contact counts.
+
+    Parameters
+    ----------
+    counts integer array of the number of reads of each contact
+    fraction fraction of the reads to keep
+    sampling 'binomial' to keep each read with a probability equal to the fraction or
+             'multinomial' to sample round(fraction * counts.sum()) reads with replacement
+    random_state numpy RandomState
+
+    Returns
+    -------
+    array of the subsampled counts, in the same order as `counts`
+
+    >>> counts = np.array([10, 0, 5, 1000])
+    >>> subsample_counts(counts, 1)
+    array([  10,    0,    5, 1000])
+    >>> sub = subsample_counts(counts, 0.5, random_state=np.random.RandomState(0))
+    >>> bool(np.all(sub <= counts)), sub[1]
+    (True, 0)
+    >>> int(subsample_counts(counts, 0.5, 'multinomial', np.random.RandomState(0)).sum())
+    508
+    """
+    if fraction >= 1:
+        return counts
+    if random_state is None:
+        random_state = np.random.RandomState()
+    if sampling == 'binomial':
+        return random_state.binomial(counts, fraction)
+    total = counts.sum()
+    return random_state.multinomial(int(round(fraction * total)), counts / float(total))
+
+
+def get_subsample_matrix(row, col, counts, shape):
+    """
+    Returns the symmetric csr matrix of the given upper triangle counts.
+    Contacts without reads are not included.
+    """
+    keep = counts > 0
+    row, col, counts = row[keep], col[keep], counts[keep]
+    off_diagonal = row != col
+    return coo_matrix((np.concatenate([counts, counts[off_diagonal]]),
+                       (np.concatenate([row, col[off_diagonal]]),
+                        np.concatenate([col, row[off_diagonal]]))),
+                      shape=shape).tocsr()
+
+
+def correct_matrix(hic_ma, filter_threshold, iter_num):
+    """
+    Removes the bins without contacts and the bins of low or large coverage
+    and corrects the matrix as in hicCorrectMatrix. The removed bins are
+    put back as nan bins.
+    """
+    row_sum = np.asarray(hic_ma.matrix.sum(axis=1)).flatten()
+    hic_ma.maskBins(np.flatnonzero(row_sum == 0))
+    outlier_regions = filter_by_zscore(hic_ma, filter_threshold[0], filter_threshold[1])
+    hic_ma.maskBins(outlier_regions)
+    corrected_matrix, correction_factors = iterativeCorrection(hic_ma.matrix, M=iter_num)
+    hic_ma.setMatrixValues(corrected_matrix)
+    hic_ma.setCorrectionFactors(correction_factors)
+    hic_ma.restoreMaskedBins()
+
+
+def find_boundaries(hic_ma, tad_parameters):
+    """
+    Finds the TAD boundaries of the matrix as in hicFindTADs. As in the boundaries
+    file of hicFindTADs, boundaries at the start or at the end of a chromosome are skipped.
+
+    Returns
+    -------
+    chrom and start arrays of the bins at the boundaries
+    """
+    ft = hicFindTADs.HicFindTads(hic_ma, num_processors=1, **tad_parameters)
+    ft.compute_spectra_matrix()
+    chrom = toString(np.asarray(ft.bedgraph_matrix['chrom']))
+    chr_start = np.asarray(ft.bedgraph_matrix['chr_start'])
+    try:
+        ft.find_boundaries()
+        boundaries, chr_end_idx = ft.filter_boundaries()
+        boundaries = np.array(boundaries, dtype=int)
+    except hicFindTADs.NoBoundariesError:
+        boundaries, chr_end_idx = np.array([], dtype=int), []
+
+    boundaries = boundaries[(boundaries > 0) & ~np.in1d(boundaries, chr_end_idx)]
+    boundaries = boundaries[chrom[boundaries] == chrom[boundaries - 1]]
+
+    return chrom[boundaries], chr_start[boundaries]
+
+
+def match_boundaries(chrom, start, other_chrom, other_start, max_distance):
+    """
+    Returns a boolean array that is True for the boundaries that have a boundary
+    of the other set in the same chromosome at most max_distance bp apart.
+
+    >>> match_boundaries(np.array(['a', 'a', 'b']), np.array([100, 500, 100]),
+    ...                  np.array(['a', 'b', 'b']), np.array([110, 300, 700]), 50)
+    array([ True, False, False])
+    """
+    matched = np.zeros(len(start), dtype=bool)
+    for chrom_name in np.intersect1d(chrom, other_chrom):
+        idx = np.flatnonzero(chrom == chrom_name)
+        other = np.sort(other_start[other_chrom == chrom_name])
+        # distance to the closest boundary of the other set on each side
+        right = np.searchsorted(other, start[idx])
+        distance_right = np.abs(other[np.minimum(right, len(other) - 1)] - start[idx])
+        distance_left = np.abs(start[idx] - other[np.maximum(right - 1, 0)])
+        matched[idx] = np.minimum(distance_left, distance_right) <= max_distance
+
+    return matched
+
+
+def compute_fraction_metrics(fraction, seed, sampling, metrics, log1p, tad_parameters,
+                             filter_threshold, iter_num):
+    """
+    Subsamples the shared matrix and computes the metrics of the subsample.
+
+    Returns
+    -------
+    OrderedDict with the name and value of each metric. If the TAD metrics are computed,
+    the boundaries of the subsample are returned as the 'boundaries' entry.
+    """
+    counts = subsample_counts(shared_counts, fraction, sampling, np.random.RandomState(seed))
+    result = OrderedDict()
+    result['fraction'] = fraction
+    result['contacts'] = int(counts.sum())
+    result['non_zero_pixels'] = int(np.count_nonzero(counts))
+
+    if 'correlation' in metrics:
+        full, sub = shared_counts[shared_correlation_idx], counts[shared_correlation_idx]
+        if log1p:
+            full, sub = np.log1p(full), np.log1p(sub)
+        result['pearson'] = pearsonr(full, sub)[0]
+        result['spearman'] = spearmanr(full, sub)[0]
+
+    if 'tads' in metrics:
+        hic_ma = hm.hiCMatrix()
+        hic_ma.setMatrix(get_subsample_matrix(shared_row, shared_col, counts, shared_shape),
+                         shared_cut_intervals)
+        hic_ma.nan_bins = np.array([])
+        correct_matrix(hic_ma, filter_threshold, iter_num)
+        result['boundaries'] = find_boundaries(hic_ma, tad_parameters)
+
+    log.info("Subsample of {} of the reads done\n".format(fraction))
+    return result
+
+
+def compute_fraction_metrics_wrapper(args):
+    return compute_fraction_metrics(*args)
+
+
+def plot_metrics(results, columns, file_name):
+    fig, axes = plt.subplots(1, len(columns), figsize=(4 * len(columns), 4), squeeze=False)
+    fractions = [result['fraction'] for result in results]
+    for ax, column in zip(axes[0], columns):
+        ax.plot(fractions, [result[column] for result in results], 'o-')
+        ax.set_xlabel('fraction of reads')
+        ax.set_title(column)
+        ax.set_xlim(0, 1.05)
+    plt.tight_layout()
+    plt.savefig(file_name, dpi=150)
+    plt.close(fig)
+
+
+def main(args=None):
+
+    args = parse_arguments().parse_args(args)
+
+    fractions = sorted(set(args.fractions))
+    if fractions[0] <= 0 or fractions[-1] > 1:
+        log.error("The fractions should be larger than 0 and at most 1.")
+        exit(1)
+    # the whole matrix is the reference of the TAD metrics
+    if fractions[-1] < 1:
+        fractions.append(1.0)
+
+    hic_ma = hm.hiCMatrix(args.matrix)
+    if args.chromosomes:
+        hic_ma.keepOnlyTheseChr(toString(args.chromosomes))
+
+    upper = triu(hic_ma.matrix, format='coo')
+    counts = np.round(upper.data).astype(np.int64)
+    if not np.allclose(counts, upper.data):
+        log.error("The matrix does not contain read counts. Please use an uncorrected matrix.")
+        exit(1)
+    log.info("The matrix contains {} reads in {} contacts.\n".format(counts.sum(), len(counts)))
+
+    correlation_idx = np.arange(len(counts))
+    if args.range:
+        min_dist, max_dist = [int(value) for value in args.range.split(":")]
+        bin_size = hic_ma.getBinSize()
+        chrom = np.array([interval[0] for interval in hic_ma.cut_intervals])
+        distance = (upper.col - upper.row) * bin_size
+        correlation_idx = np.flatnonzero((chrom[upper.row] == chrom[upper.col]) &
+                                         (distance >= min_dist) & (distance <= max_dist))
+
+    tad_parameters = {'max_depth': args.maxDepth, 'min_depth': args.minDepth, 'step': args.step,
+                      'delta': args.delta, 'min_boundary_distance': args.minBoundaryDistance,
+                      'p_correct_for_multiple_testing': args.correctForMultipleTesting,
+                      'p_threshold_comparisons': args.thresholdComparisons}
+
+    # one seed per fraction, such that the subsamples do not depend on the number of processors
+    seeds = np.random.RandomState(args.seed).randint(0, 2 ** 31 - 1, size=len(fractions))
+    TASKS = [(fraction, seed, args.sampling, args.metrics, args.log1p, tad_parameters,
+              args.filterThreshold, args.iterNum) for fraction, seed in zip(fractions, seeds)]
+
+    arrays = [upper.row, upper.col, counts, correlation_idx]
+    if args.numberOfProcessors > 1:
+        # the counts are put into shared memory to avoid that each process gets a copy
+        pool = multiprocessing.Pool(min(args.numberOfProcessors, len(TASKS)), initializer=set_shared_arrays,
+                                    initargs=(share_arrays(arrays), hic_ma.matrix.shape, hic_ma.cut_intervals))
+        results = pool.map_async(compute_fraction_metrics_wrapper, TASKS).get(9999999)
+        pool.close()
+        pool.join()
+    else:
+        set_shared_arrays([(array, array.dtype.str, len(array)) for array in arrays],
+                          hic_ma.matrix.shape, hic_ma.cut_intervals)
+        results = [compute_fraction_metrics(*task) for task in TASKS]
+
+    if 'tads' in args.metrics:
+        chrom, start = results[-1]['boundaries']
+        max_distance = args.boundaryTolerance * hic_ma.getBinSize()
+        for result in results:
+            sub_chrom, sub_start = result.pop('boundaries')
+            result['boundaries'] = len(sub_start)
+            result['boundary_recall'] = match_boundaries(chrom, start, sub_chrom, sub_start, max_distance).mean() \
+                if len(start) else np.nan
+            result['boundary_precision'] = match_boundaries(sub_chrom, sub_start, chrom, start, max_distance).mean() \
+                if len(sub_start) else np.nan
+
+    columns = list(results[0].keys())
+    with open(args.outPrefix + "_saturation.tsv", 'w') as fh:
+        fh.write("#{}\n".format("\t".join(columns)))
+        for result in results:
+            values = [str(value) if isinstance(value, int) else "{:.6g}".format(value) for value in result.values()]
+            fh.write("{}\n".format("\t".join(values)))
+
+    plot_metrics(results, [column for column in columns if column not in ['fraction', 'contacts']],
+                 "{}_saturation.{}".format(args.outPrefix, args.plotFileFormat))
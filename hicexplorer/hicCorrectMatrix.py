@@ -1,7 +1,9 @@
 from __future__ import division
 import argparse
+from collections import OrderedDict
 from past.builtins import zip
-from scipy.sparse import lil_matrix
+from six import iteritems
+from scipy.sparse import lil_matrix, coo_matrix
 
 from hicexplorer.iterativeCorrection import iterativeCorrection
 from hicmatrix import HiCMatrix as hm
@@ -180,6 +182,13 @@ def correct_subparser():
                            default=None,
                            type=float)
 
+    parserOpt.add_argument('--fillGaps',
+                           help='If set, the bins removed by --sequencedCountCutoff are '
+                           'filled with the average of their neighboring bins instead '
+                           'of being removed. Stretches of consecutive failed bins can not '
+                           'be filled and are removed.',
+                           action='store_true')
+
     parserOpt.add_argument('--chromosomes',
                            help='List of chromosomes to be included in the iterative '
                            'correction. The order of the given chromosomes will be then '
@@ -212,24 +221,65 @@ def iterative_correction(matrix, args):
     return corrected_matrix, correction_factors
 
 
+def _shift_along_diagonal(matrix, offset):
+    """
+    Returns a csr matrix of the same shape as `matrix` in which
+    each value is moved `offset` positions along the diagonal, i.e.
+    shifted[i, j] = matrix[i - offset, j - offset]. Values moved
+    outside of the matrix are discarded.
+    """
+    coo = matrix.tocoo()
+    row = coo.row + offset
+    col = coo.col + offset
+    keep = (row >= 0) & (row < matrix.shape[0]) & (col >= 0) & (col < matrix.shape[1])
+    return coo_matrix((coo.data[keep], (row[keep], col[keep])),
+                      shape=matrix.shape).tocsr()
+
+
 def fill_gaps(hic_ma, failed_bins, fill_contiguous=False):
     """ try to fill-in the failed_bins the matrix by adding the
     average values of the neighboring rows and cols. The idea
     for the iterative correction is that is best to put
     something in contrast to not put anything
 
+    The rows and columns of a failed bin get, for each position,
+    the mean of the two diagonal neighbors (i - 1, j - 1) and
+    (i + 1, j + 1). The positions next to the intersection of two
+    failed bins get the mean of the four diagonal neighbors of the
+    intersection. All values are computed with shifted copies of the
+    sparse matrix, thus the run time does not depend on the
+    number of failed bins.
+
     hic_ma:  Hi-C matrix object
     failed_bins: list of bin ids
     fill_contiguous: If True, stretches of masked rows/cols are filled.
                      Otherwise, these cases are skipped
 
+    >>> from scipy.sparse import csr_matrix
+    >>> from hicmatrix import HiCMatrix as hm
+    >>> hic = hm.hiCMatrix()
+    >>> hic.matrix = csr_matrix(np.array([[1, 2, 3, 4, 5],
+    ...                                   [2, 0, 0, 0, 6],
+    ...                                   [3, 0, 7, 8, 9],
+    ...                                   [4, 0, 8, 1, 2],
+    ...                                   [5, 6, 9, 2, 3]], dtype=float))
+    >>> matrix, to_remove = fill_gaps(hic, np.array([1]))
+    >>> matrix.todense()
+    matrix([[1. , 3.5, 3. , 4. , 5. ],
+            [3.5, 4. , 3.5, 6. , 6. ],
+            [3. , 3.5, 7. , 8. , 9. ],
+            [4. , 6. , 8. , 1. , 2. ],
+            [5. , 6. , 9. , 2. , 3. ]])
+    >>> to_remove
+    array([], dtype=int64)
     """
     log.debug("starting fill gaps")
+    failed_bins = np.asarray(failed_bins, dtype=np.int64)
     mat_size = hic_ma.matrix.shape[0]
-    fill_ma = hic_ma.matrix.copy().tolil()
+    matrix = hic_ma.matrix.tocsr()
     if fill_contiguous is True:
         discontinuous_failed = failed_bins
-        consecutive_failed_idx = np.array([])
+        consecutive_failed_idx = np.array([], dtype=np.int64)
     else:
         # find stretches of consecutive failed regions
         consecutive_failed_idx = np.flatnonzero(np.diff(failed_bins) == 1)
@@ -238,70 +288,91 @@ def fill_gaps(hic_ma, failed_bins, fill_contiguous=False):
         # for [1,2,5,10] the np.diff is [1,3,5]. The consecutive id list
         # is [0], for '1', in the original list, but we are missing the '2'
         # thats where the consecutive_failed_idx+1 comes.
-        consecutive_failed_idx = np.unique(np.sort(
-            np.concatenate([consecutive_failed_idx,
-                            consecutive_failed_idx + 1])))
+        consecutive_failed_idx = np.unique(np.concatenate([consecutive_failed_idx,
+                                                           consecutive_failed_idx + 1]))
         # find the failed regions that are not consecutive
-        discontinuous_failed = [x for idx, x in enumerate(failed_bins)
-                                if idx not in consecutive_failed_idx]
+        discontinuous_failed = np.delete(failed_bins, consecutive_failed_idx)
 
     log.debug("Filling {} failed bins\n".format(
         len(discontinuous_failed)))
 
-    """
-    for missing_bin in discontinuous_failed:
-        if 0 < missing_bin < mat_size - 1:
-            for idx in range(1, mat_size - 2):
-                if idx % 100 == 0:
-                    log.info(".")
-                # the new row value is the mean between the upper
-                # and lower bins corresponding to the same diagonal
-                fill_ma[missing_bin, idx :] = \
-                    (hic_ma.matrix[missing_bin-1, idx-1] +
-                     hic_ma.matrix[missing_bin+1, idx+1]) / 2
-
-                # same for cols
-                fill_ma[idx, missing_bin] = \
-                    (hic_ma.matrix[idx-1, missing_bin-1] +
-                     hic_ma.matrix[idx+1, missing_bin+1]) / 2
-
-    """
-    for missing_bin in discontinuous_failed:
-        if 0 < missing_bin < mat_size - 1:
-            # the new row value is the mean between the upper
-            # and lower rows
-            fill_ma[missing_bin, 1:mat_size - 1] = \
-                (hic_ma.matrix[missing_bin - 1, :mat_size - 2] +
-                 hic_ma.matrix[missing_bin + 1, 2:]) / 2
-
-            # same for cols
-            fill_ma[1:mat_size - 1, missing_bin] = \
-                (hic_ma.matrix[:mat_size - 2, missing_bin - 1] +
-                 hic_ma.matrix[2:, missing_bin + 1]) / 2
-
-    # identify the intersection points of the failed regions because they
-    # neighbors get wrong values
-    for bin_a in discontinuous_failed:
-        for bin_b in discontinuous_failed:
-            if 0 < bin_a < mat_size and \
-                    0 < bin_b < mat_size:
-                # the fill value is the average over the
-                # neighbors that do have a value
-
-                fill_value = np.mean([
-                    hic_ma.matrix[bin_a - 1, bin_b - 1],
-                    hic_ma.matrix[bin_a - 1, bin_b + 1],
-                    hic_ma.matrix[bin_a + 1, bin_b - 1],
-                    hic_ma.matrix[bin_a + 1, bin_b + 1],
-                ])
-
-                fill_ma[bin_a - 1, bin_b] = fill_value
-                fill_ma[bin_a + 1, bin_b] = fill_value
-                fill_ma[bin_a, bin_b - 1] = fill_value
-                fill_ma[bin_a, bin_b + 1] = fill_value
+    # the first and last bins lack one of the neighbors and are not filled
+    discontinuous_failed = discontinuous_failed[(discontinuous_failed > 0) &
+                                                (discontinuous_failed < mat_size - 1)]
+    is_failed = np.zeros(mat_size, dtype=bool)
+    is_failed[discontinuous_failed] = True
+    is_inner = np.zeros(mat_size, dtype=bool)
+    is_inner[1:mat_size - 1] = True
+
+    # the new row (and col) value is the mean between the upper
+    # and lower bins corresponding to the same diagonal
+    neighbor_mean = (_shift_along_diagonal(matrix, 1) +
+                     _shift_along_diagonal(matrix, -1)) / 2
+
+    def in_failed_row_or_col(row, col):
+        return (is_failed[row] & is_inner[col]) | (is_failed[col] & is_inner[row])
+
+    def next_to_intersection(row, col):
+        return (is_failed[col] & (is_failed[np.maximum(row - 1, 0)] |
+                                  is_failed[np.minimum(row + 1, mat_size - 1)])) | \
+               (is_failed[row] & (is_failed[np.maximum(col - 1, 0)] |
+                                  is_failed[np.minimum(col + 1, mat_size - 1)]))
+
+    # identify the intersection points of the failed regions because
+    # their neighbors get wrong values. The fill value is the average over
+    # the four diagonal neighbors of the intersection.
+    rows_up = discontinuous_failed - 1
+    rows_down = discontinuous_failed + 1
+    intersection_mean = (matrix[rows_up, :][:, rows_up] +
+                         matrix[rows_up, :][:, rows_down] +
+                         matrix[rows_down, :][:, rows_up] +
+                         matrix[rows_down, :][:, rows_down]).tocoo() / 4
+    bin_a = discontinuous_failed[intersection_mean.row]
+    bin_b = discontinuous_failed[intersection_mean.col]
+
+    # each position next to an intersection may be reached from up to four
+    # intersections. Keep, as the last writer would, the value of the
+    # intersection below, otherwise right, left and finally above the position.
+    row_list = []
+    col_list = []
+    data_list = []
+    for row_shift, col_shift, preferred in [(-1, 0, []),
+                                            (0, -1, [(1, 0)]),
+                                            (0, 1, [(1, 0), (0, 1)]),
+                                            (1, 0, [(1, 0), (0, 1), (0, -1)])]:
+        row = bin_a + row_shift
+        col = bin_b + col_shift
+        keep = np.ones(len(row), dtype=bool)
+        for pref_row, pref_col in preferred:
+            keep &= ~(is_failed[np.clip(row + pref_row, 0, mat_size - 1)] &
+                      is_failed[np.clip(col + pref_col, 0, mat_size - 1)])
+        row_list.append(row[keep])
+        col_list.append(col[keep])
+        data_list.append(intersection_mean.data[keep])
+
+    # masked merge of the original values, the neighbor mean for
+    # the failed rows and cols and the intersection values
+    original = matrix.tocoo()
+    keep = ~in_failed_row_or_col(original.row, original.col) & \
+        ~next_to_intersection(original.row, original.col)
+    row_list.append(original.row[keep])
+    col_list.append(original.col[keep])
+    data_list.append(original.data[keep])
+
+    neighbor_mean = neighbor_mean.tocoo()
+    keep = in_failed_row_or_col(neighbor_mean.row, neighbor_mean.col) & \
+        ~next_to_intersection(neighbor_mean.row, neighbor_mean.col)
+    row_list.append(neighbor_mean.row[keep])
+    col_list.append(neighbor_mean.col[keep])
+    data_list.append(neighbor_mean.data[keep])
+
+    fill_ma = coo_matrix((np.concatenate(data_list),
+                          (np.concatenate(row_list), np.concatenate(col_list))),
+                         shape=matrix.shape).tocsr()
+    fill_ma.eliminate_zeros()
 
     # return the matrix and the bins that continue to be failed regions
-    return fill_ma.tocsr(), np.sort(failed_bins[consecutive_failed_idx])
+    return fill_ma, np.sort(failed_bins[consecutive_failed_idx])
 
 
 class MAD(object):
@@ -378,6 +449,47 @@ class MAD(object):
         return (mad * self.med_abs_deviation / self.mad_b_value) + self.median
 
 
+def get_row_sums(hic_ma):
+    """
+    Returns the sum of contacts per bin excluding self contacts
+    (the diagonal), genome wide and considering only the contacts
+    within the chromosome of the bin.
+
+    Both marginals are computed in a single pass over the non-zero
+    pixels.
+
+    :param hic_ma: Hi-C matrix object
+
+    :return: tuple of genome-wide row sums and a dictionary with
+             the intra-chromosomal row sums per chromosome
+    """
+    mat_size = hic_ma.matrix.shape[0]
+    pixels = hic_ma.matrix.tocoo()
+    data = pixels.data
+    if np.isnan(data).any():
+        data = np.nan_to_num(data)
+
+    # bin id -> chromosome id
+    chrom_ids = np.zeros(mat_size, dtype=np.int64)
+    for idx, chrname in enumerate(hic_ma.getChrNames()):
+        start, end = hic_ma.getChrBinRange(chrname)
+        chrom_ids[start:end] = idx
+
+    off_diagonal = pixels.row != pixels.col
+    row_sum = np.bincount(pixels.row[off_diagonal], weights=data[off_diagonal],
+                          minlength=mat_size)
+
+    intra_chrom = off_diagonal & (chrom_ids[pixels.row] == chrom_ids[pixels.col])
+    intra_row_sum = np.bincount(pixels.row[intra_chrom], weights=data[intra_chrom],
+                                minlength=mat_size)
+    row_sum_per_chr = OrderedDict()
+    for chrname in hic_ma.getChrNames():
+        start, end = hic_ma.getChrBinRange(chrname)
+        row_sum_per_chr[chrname] = intra_row_sum[start:end]
+
+    return row_sum, row_sum_per_chr
+
+
 def plot_total_contact_dist(hic_ma, args):
     """
     Plots the distribution of number of contacts (excluding self contacts)
@@ -449,6 +561,7 @@ def plot_total_contact_dist(hic_ma, args):
     # hic_ma.matrix.data[np.isnan(hic_ma.matrix.data)] = 0
     hic_ma.matrix = convertNansToZeros(hic_ma.matrix)
     hic_ma.matrix = convertInfsToZeros(hic_ma.matrix)
+    row_sum_genome, row_sum_per_chr = get_row_sums(hic_ma)
 
     if args.perchr:
         chroms = hic_ma.getChrNames()
@@ -464,11 +577,7 @@ def plot_total_contact_dist(hic_ma, args):
         for plot_num, chrname in enumerate(chroms):
             log.info("Plotting chromosome {}".format(chrname))
 
-            chr_range = hic_ma.getChrBinRange(chrname)
-            chr_submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
-
-            row_sum = np.asarray(chr_submatrix.sum(axis=1)).flatten()
-            row_sum = row_sum - chr_submatrix.diagonal()
+            row_sum = row_sum_per_chr[chrname]
             mad = MAD(row_sum)
             modified_z_score = mad.get_motified_zscores()
 
@@ -483,8 +592,7 @@ def plot_total_contact_dist(hic_ma, args):
             ax[chrname].set_title(chrname)
     else:
         fig = plt.figure()
-        row_sum = np.asarray(hic_ma.matrix.sum(axis=1)).flatten()
-        row_sum = row_sum - hic_ma.matrix.diagonal()
+        row_sum = row_sum_genome
         mad = MAD(row_sum)
         modified_z_score = mad.get_motified_zscores()
 
@@ -504,20 +612,14 @@ def filter_by_zscore(hic_ma, lower_threshold, upper_threshold, perchr=False):
     to avoid introducing bias due to different chromosome numbers
 
     """
+    # the row sums exclude the diagonal
+    # to account for interactions with other bins
+    # and not only self interactions that are the dominant count
+    row_sum_genome, row_sum_per_chr = get_row_sums(hic_ma)
     to_remove = []
     if perchr:
-        for chrname in list(hic_ma.interval_trees):
+        for chrname, row_sum in iteritems(row_sum_per_chr):
             chr_range = hic_ma.getChrBinRange(chrname)
-            chr_submatrix = hic_ma.matrix[chr_range[0]:chr_range[1],
-                                          chr_range[0]:chr_range[1]]
-
-            # replace nan values by zero
-            chr_submatrix.data[np.isnan(chr_submatrix.data)] = 0
-            row_sum = np.asarray(chr_submatrix.sum(axis=1)).flatten()
-            # subtract from row sum, the diagonal
-            # to account for interactions with other bins
-            # and not only self interactions that are the dominant count
-            row_sum = row_sum - chr_submatrix.diagonal()
             mad = MAD(row_sum)
             problematic = np.flatnonzero(mad.is_outlier(lower_threshold, upper_threshold))
 
@@ -531,12 +633,7 @@ def filter_by_zscore(hic_ma, lower_threshold, upper_threshold, perchr=False):
 
             to_remove.extend(problematic)
     else:
-        row_sum = np.asarray(hic_ma.matrix.sum(axis=1)).flatten()
-        # subtract from row sum, the diagonal
-        # to account for interactions with other bins
-        # and not only self interactions that are the dominant count
-        row_sum = row_sum - hic_ma.matrix.diagonal()
-        mad = MAD(row_sum)
+        mad = MAD(row_sum_genome)
         to_remove = np.flatnonzero(mad.is_outlier(lower_threshold, upper_threshold))
 
     return sorted(to_remove)
@@ -597,15 +694,14 @@ def main(args=None):
             np.array(coverage) < args.sequencedCountCutoff)
 
         ma.printchrtoremove(failed_bins, label="Bins with low coverage", restore_masked_bins=False)
+        if args.fillGaps:
+            ma.matrix, to_remove = fill_gaps(ma, failed_bins)
+            log.warning("From {} failed bins, {} could "
+                        "not be filled\n".format(len(failed_bins),
+                                                 len(to_remove)))
+            failed_bins = to_remove
         ma.maskBins(failed_bins)
         total_filtered_out = set(failed_bins)
-        """
-        ma.matrix, to_remove = fill_gaps(ma, failed_bins)
-        log.warning("From {} failed bins, {} could "
-                         "not be filled\n".format(len(failed_bins),
-                                                  len(to_remove)))
-        ma.maskBins(to_remove)
-        """
 
     if args.transCutoff and 0 < args.transCutoff < 100:
         cutoff = float(args.transCutoff) / 100
@@ -2,15 +2,18 @@ from __future__ import division
 
 import argparse
 import os
+from tempfile import mkstemp
+from multiprocessing import Pool
 import numpy as np
 from builtins import range
 from past.builtins import map
-from scipy.sparse import triu
-from scipy.stats import pearsonr, spearmanr
+from scipy.sparse import triu, diags, csr_matrix
+from scipy.stats import rankdata
 
 from hicmatrix import HiCMatrix as hm
 from hicexplorer._version import __version__
 from hicexplorer.utilities import check_cooler
+import cooler
 # for plotting
 from matplotlib import use as mplt_use
 mplt_use('Agg')
@@ -91,10 +94,21 @@ def parse_arguments(args=None):
 
     # define the arguments
     parserOpt.add_argument('--method',
-                           help='Correlation method to use.',
-                           choices=['pearson', 'spearman'],
+                           help='Correlation method to use. The method scc computes the stratum-adjusted '
+                           'correlation coefficient of HiCRep (Yang et al. 2017): the correlations of the '
+                           'pixels of each distance are combined in a weighted mean. This removes the effect '
+                           'of the decay of the contacts with the distance and is better suited to compare '
+                           'replicates. Use --range to set the considered distances.',
+                           choices=['pearson', 'spearman', 'scc'],
                            default='pearson')
 
+    parserOpt.add_argument('--smoothingWindow',
+                           help='Only for the method scc: before the correlation, each matrix is smoothed '
+                           'with a 2D mean filter of (2h + 1) x (2h + 1) bins, with h this value. 0 disables '
+                           'the smoothing.',
+                           default=0,
+                           type=int)
+
     parserOpt.add_argument('--log1p',
                            help='If set, then the log1p of the matrix values is used. This parameter has no '
                            'effect for Spearman correlations but changes the output of Pearson correlation '
@@ -121,8 +135,15 @@ def parse_arguments(args=None):
                            required=True)
 
     parserOpt.add_argument('--outFileNameScatter', '-os',
-                           help='File name to save the resulting scatter plot.',
-                           required=True)
+                           help='File name to save the resulting scatter plots of all pairs of matrices. '
+                           'If not given, the scatter plots are not created, which is faster for many matrices.',
+                           required=False)
+
+    parserOpt.add_argument('--outFileNameCorrelation', '-oc',
+                           help='File name to save the correlation of all pairs of matrices. If the '
+                           'file name ends with .npy, the correlation matrix is saved in the numpy format, '
+                           'otherwise as a tab-separated table with the labels as header and first column.',
+                           required=False)
 
     parserOpt.add_argument('--chromosomes',
                            help='List of chromosomes to be included in the '
@@ -131,14 +152,19 @@ def parse_arguments(args=None):
                            nargs='+')
 
     parserOpt.add_argument('--threads',
-                           help='Number of threads. Using the python multiprocessing module. Is only used with \'cool\' matrix format.'
-                           ' One master process which is used to read the input file into the buffer and one process which is merging '
-                           'the output bam files of the processes into one output bam file. All other threads do the actual computation.',
+                           help='Number of processes used to load the matrices. With the \'cool\' matrix '
+                           'format, each chromosome of each matrix is loaded by its own process.',
                            required=False,
                            default=4,
                            type=int
                            )
 
+    parserOpt.add_argument('--memoryMap',
+                           help='If set, the pixel values of all matrices are kept in a temporary '
+                           'memory-mapped file instead of the main memory. Useful for many samples '
+                           'at high resolution.',
+                           action='store_true')
+
     parserOpt.add_argument("--help", "-h", action="help", help="show this help message and exit")
 
     parserOpt.add_argument('--version', action='version',
@@ -241,164 +267,448 @@ def get_vectors(mat1, mat2):
     return values1, values2
 
 
-def main(args=None):
+def load_matrix_pixels(pMatrixFile, pChromosomes, pRange, pLog1p, pSmoothingWindow=0):
+    """
+    Loads a matrix, or only the given chromosomes of a matrix, and returns
+    the pixels of the upper triangle of each chromosome without the main
+    diagonal. The pixels of a chromosome are identified by the sorted keys
+    row * number of bins + column. If pSmoothingWindow is h > 0, each
+    chromosome is smoothed with a 2D mean filter of (2h + 1) x (2h + 1) bins.
+
+    Returns
+    -------
+    bin size, list of (chromosome name, number of bins, keys, values, nan bins)
+    """
+    if check_cooler(pMatrixFile) and pChromosomes is not None and len(pChromosomes) == 1:
+        hic_ma = hm.hiCMatrix(pMatrixFile, pChrnameList=pChromosomes)
+    else:
+        hic_ma = hm.hiCMatrix(pMatrixFile)
+        if pChromosomes:
+            hic_ma.keepOnlyTheseChr(pChromosomes)
+
+    bin_size = hic_ma.getBinSize()
+    nan_bins = np.asarray(hic_ma.nan_bins, dtype=np.int64)
+    if pRange:
+        min_dist, max_dist = [int(x) // bin_size for x in pRange.split(":")]
+
+    chromosome_pixels = []
+    for chrname in hic_ma.getChrNames():
+        start, end = hic_ma.getChrBinRange(chrname)
+        num_bins = end - start
+        submatrix = hic_ma.matrix[start:end, start:end]
+        if pSmoothingWindow > 0:
+            submatrix = smooth_matrix(submatrix, pSmoothingWindow)
+        submatrix = triu(submatrix, k=1, format='coo')
+        dist = submatrix.col - submatrix.row
+        if pRange:
+            keep = (submatrix.data != 0) & np.isfinite(submatrix.data) & (dist >= min_dist) & (dist < max_dist)
+        else:
+            keep = (submatrix.data != 0) & np.isfinite(submatrix.data)
+        keys = submatrix.row[keep].astype(np.int64) * num_bins + submatrix.col[keep]
+        order = np.argsort(keys, kind='stable')
+        values = submatrix.data[keep][order].astype(float)
+        if pLog1p:
+            values = np.log1p(values)
+        chr_nan_bins = nan_bins[(nan_bins >= start) & (nan_bins < end)] - start
+        chromosome_pixels.append((chrname, num_bins, keys[order], values, chr_nan_bins))
+    return bin_size, chromosome_pixels
+
+
+def smooth_matrix(pMatrix, pSmoothingWindow):
+    """
+    Smoothes a sparse matrix with a 2D mean filter of (2h + 1) x (2h + 1)
+    pixels, h = pSmoothingWindow, as in HiCRep. The filter is the product
+    with a band matrix of ones on both sides.
+
+    >>> matrix = csr_matrix(np.array([[0., 3., 0.], [3., 0., 6.], [0., 6., 0.]]))
+    >>> smooth_matrix(matrix, 1).toarray()
+    array([[0.66666667, 1.33333333, 1.        ],
+           [1.33333333, 2.        , 1.66666667],
+           [1.        , 1.66666667, 1.33333333]])
+    """
+    pMatrix = csr_matrix(pMatrix, dtype=float)
+    pMatrix.data[~np.isfinite(pMatrix.data)] = 0
+    num_bins = pMatrix.shape[0]
+    offsets = list(range(-pSmoothingWindow, pSmoothingWindow + 1))
+    band = diags([np.ones(num_bins - abs(offset)) for offset in offsets], offsets, format='csr')
+    return band.dot(pMatrix).dot(band) / (2 * pSmoothingWindow + 1) ** 2
 
-    args = parse_arguments().parse_args(args)
 
-    if args.labels and len(args.matrices) != len(args.labels):
-        log.error("The number of labels does not match the number of matrices.")
-        exit(0)
-    if not args.labels:
-        args.labels = map(lambda x: os.path.basename(x), args.matrices)
+def load_matrix_pixels_wrapper(pArgs):
+    return load_matrix_pixels(*pArgs)
+
+
+def merge_pixel_keys(pKeys, pNumberOfBins, pNanBins):
+    """
+    Merges the sorted pixel keys of several samples into the sorted union
+    of the keys. Because each list is already sorted, the stable sort
+    (timsort) of their concatenation is a k-way merge. Pixels in a row or
+    column that is a nan bin in any sample are removed.
+
+    >>> merge_pixel_keys([np.array([1, 5, 7]), np.array([2, 5, 8])], 3, [np.array([])])
+    array([1, 2, 5, 7, 8])
+    >>> merge_pixel_keys([np.array([1, 5, 7]), np.array([2, 5, 8])], 3, [np.array([]), np.array([0])])
+    array([5, 7, 8])
+    """
+    keys = np.concatenate(pKeys)
+    keys.sort(kind='stable')
+    if len(keys):
+        keys = keys[np.concatenate([[True], keys[1:] != keys[:-1]])]
+    nan_bins = np.unique(np.concatenate(pNanBins)).astype(np.int64)
+    if len(nan_bins):
+        nan_pixel = np.in1d(keys // pNumberOfBins, nan_bins) | np.in1d(keys % pNumberOfBins, nan_bins)
+        keys = keys[~nan_pixel]
+    return keys
+
+
+def allocate_pixel_matrix(pShape, pMemoryMap=False):
+    """
+    Returns a column-major array of zeros, kept in a temporary memory-mapped
+    file if pMemoryMap is set. The file, given by the filename attribute of the
+    array, has to be removed once the array is not used anymore.
+    """
+    if pMemoryMap:
+        file_descriptor, file_name = mkstemp(suffix='.npy', prefix='hicCorrelate_')
+        os.close(file_descriptor)
+        return np.memmap(file_name, dtype=float, mode='w+', shape=pShape, order='F')
+    return np.zeros(pShape, order='F')
+
 
-    num_files = len(args.matrices)
-    map(lambda x: os.path.basename(x), args.matrices)
-    # initialize results matrix
-    results = np.zeros((num_files, num_files), dtype='float')
-
-    rows, cols = np.triu_indices(num_files)
-    correlation_opts = {'spearman': spearmanr,
-                        'pearson': pearsonr}
-    hic_mat_list = []
-    max_value = None
-    min_value = None
-    all_mat = None
-    all_nan = []
-
-    for i, matrix in enumerate(args.matrices):
-        log.info("loading hic matrix {}\n".format(matrix))
-
-        if (check_cooler(args.matrices[i])) and args.chromosomes is not None and len(args.chromosomes) == 1:
-            _mat = hm.hiCMatrix(matrix, pChrnameList=args.chromosomes)
+def get_pixel_matrix(pMatrices, pChromosomes, pRange, pLog1p, pThreads, pMemoryMap=False, pSmoothingWindow=0):
+    """
+    Loads the matrices in parallel and aligns their pixels to the union of
+    the pixels of all matrices. Cooler files are loaded per chromosome.
+
+    Returns
+    -------
+    array of pixels x samples, column-major, with the value 0 for the pixels
+    that are missing in a sample, the bin size of the matrices, the distance
+    in bins of each pixel and the list of (chromosome, first pixel, last pixel + 1)
+    """
+    tasks = []
+    for sample, matrix in enumerate(pMatrices):
+        if check_cooler(matrix) and '.mcool' not in matrix:
+            chromosomes = pChromosomes if pChromosomes else cooler.Cooler(matrix).chromnames
+            for chrname in chromosomes:
+                tasks.append((sample, (matrix, [chrname], pRange, pLog1p, pSmoothingWindow)))
         else:
-            _mat = hm.hiCMatrix(matrix)
-            if args.chromosomes:
-                _mat.keepOnlyTheseChr(args.chromosomes)
-            _mat.filterOutInterChrCounts()
-
-        _mat.diagflat(0)
-        log.info("restore masked bins {}\n".format(matrix))
-        bin_size = _mat.getBinSize()
-        all_nan = np.unique(np.concatenate([all_nan, _mat.nan_bins]))
-
-        _mat = triu(_mat.matrix, k=0, format='csr')
-        if args.range:
-            min_dist, max_dist = args.range.split(":")
-            min_dist = int(min_dist)
-            max_dist = int(max_dist)
-            if max_dist < bin_size:
-                log.error("Please specify a max range that is larger than bin size ({})".format(bin_size))
-                exit()
-            max_depth_in_bins = int(max_dist / bin_size)
-            max_dist = int(max_dist) // bin_size
-            min_dist = int(min_dist) // bin_size
-            # work only with the upper matrix
-            # and remove all pixels that are beyond
-            # max_depth_in_bis
-            # (this is done by subtracting a second sparse matrix
-            # that contains only the upper matrix that wants to be removed.
-            _mat = triu(_mat, k=0, format='csr') - triu(_mat, k=max_depth_in_bins, format='csr')
-
-            _mat.eliminate_zeros()
-
-            _mat_coo = _mat.tocoo()
-            dist = _mat_coo.col - _mat_coo.row
-            keep = np.flatnonzero((dist <= max_dist) & (dist >= min_dist))
-            _mat_coo.data = _mat_coo.data[keep]
-            _mat_coo.row = _mat_coo.row[keep]
-            _mat_coo.col = _mat_coo.col[keep]
-            _mat = _mat_coo.tocsr()
+            tasks.append((sample, (matrix, pChromosomes, pRange, pLog1p, pSmoothingWindow)))
+
+    log.info("loading {} matrices\n".format(len(pMatrices)))
+    if pThreads > 1 and len(tasks) > 1:
+        pool = Pool(min(pThreads, len(tasks)))
+        results = pool.map_async(load_matrix_pixels_wrapper, [task for _, task in tasks]).get(9999999)
+        pool.close()
+        pool.join()
+    else:
+        results = [load_matrix_pixels_wrapper(task) for _, task in tasks]
+
+    bin_sizes = set()
+    # pixels[chromosome][sample] = (keys, values)
+    pixels = {}
+    num_bins = {}
+    nan_bins = {}
+    for (sample, _), (bin_size, chromosome_pixels) in zip(tasks, results):
+        bin_sizes.add(bin_size)
+        for chrname, chr_num_bins, keys, values, chr_nan_bins in chromosome_pixels:
+            pixels.setdefault(chrname, {})[sample] = (keys, values)
+            num_bins[chrname] = chr_num_bins
+            nan_bins.setdefault(chrname, []).append(chr_nan_bins)
+
+    union_keys = {}
+    for chrname in pixels:
+        union_keys[chrname] = merge_pixel_keys([keys for keys, _ in pixels[chrname].values()],
+                                               num_bins[chrname], nan_bins[chrname])
+    num_pixels = sum([len(keys) for keys in union_keys.values()])
+    pixel_matrix = allocate_pixel_matrix((num_pixels, len(pMatrices)), pMemoryMap)
+    distances = np.zeros(num_pixels, dtype=np.int64)
+    chromosome_ranges = []
+
+    offset = 0
+    for chrname in pixels:
+        keys_chr = union_keys[chrname]
+        distances[offset:offset + len(keys_chr)] = keys_chr % num_bins[chrname] - keys_chr // num_bins[chrname]
+        chromosome_ranges.append((chrname, offset, offset + len(keys_chr)))
+        for sample, (keys, values) in pixels[chrname].items():
+            position = np.searchsorted(keys_chr, keys)
+            in_union = position < len(keys_chr)
+            in_union[in_union] = keys_chr[position[in_union]] == keys[in_union]
+            pixel_matrix[offset + position[in_union], sample] = values[in_union]
+        offset += len(keys_chr)
+        # release the pixels of the chromosome
+        pixels[chrname] = None
+
+    return pixel_matrix, bin_sizes.pop(), distances, chromosome_ranges
+
+
+def compute_pairwise_statistics(pPixelMatrix, pMethod='pearson', pChunkSize=1000000):
+    """
+    Computes the sufficient statistics of the Pearson or Spearman correlation
+    of all pairs of columns (samples) of a pixels x samples matrix. For each
+    pair of samples, the pixels that are zero in both samples are not
+    considered.
+
+    Instead of correlating each pair separately, the sums needed by all pairs
+    are accumulated with one matrix product per chunk of pixels. The pixels
+    that are zero in both samples of a pair contribute a known constant to
+    these sums, which is subtracted afterwards. For Spearman, each column is
+    ranked once. Removing d pixels that are zero in both samples lowers the
+    ranks of the zeros of a column by d / 2 and the ranks of the positive
+    values by d, which is a per pixel correction of the same form.
+
+    Returns
+    -------
+    for each pair (i, j): the number of pixels kept for the pair, the sum of
+    the squared deviations of sample i (of its ranks for Spearman) over these
+    pixels and the sum of the products of the deviations of i and j
+    """
+    num_pixels, num_samples = pPixelMatrix.shape
+    if pMethod == 'spearman':
+        values = allocate_pixel_matrix(pPixelMatrix.shape, isinstance(pPixelMatrix, np.memmap))
+        negative = np.zeros(num_samples)
+        zeros = np.zeros(num_samples)
+        for sample in range(num_samples):
+            column = pPixelMatrix[:, sample]
+            values[:, sample] = rankdata(column)
+            negative[sample] = (column < 0).sum()
+            zeros[sample] = (column == 0).sum()
+        # the rank of the zeros of a column and the rank correction
+        # of the zeros for a removed pixel
+        zero_value = negative + (zeros + 1) / 2
+        zero_shift = 0.5
+    else:
+        values = pPixelMatrix
+        zero_value = np.zeros(num_samples)
+        zero_shift = 0
+
+    # the products of the columns of [values, shift, zero], in which shift is
+    # the rank correction of a pixel for each removed pixel
+    products = np.zeros((3 * num_samples, 3 * num_samples))
+    sums = np.zeros(3 * num_samples)
+    for start in range(0, num_pixels, pChunkSize):
+        chunk = np.asarray(pPixelMatrix[start:start + pChunkSize, :])
+        is_zero = (chunk == 0).astype(float)
+        if pMethod == 'spearman':
+            shift = (chunk > 0) + zero_shift * is_zero
         else:
-            _mat = triu(_mat, k=0, format='csr')
+            shift = np.zeros(chunk.shape)
+        stacked = np.hstack([np.asarray(values[start:start + pChunkSize, :]), shift, is_zero])
+        products += stacked.T.dot(stacked)
+        sums += stacked.sum(axis=0)
+    if pMethod == 'spearman' and isinstance(values, np.memmap):
+        file_name = values.filename
+        del values
+        os.remove(file_name)
+
+    index_values = slice(0, num_samples)
+    index_shift = slice(num_samples, 2 * num_samples)
+    index_zero = slice(2 * num_samples, 3 * num_samples)
+    # number of pixels that are zero in both samples of a pair
+    removed = products[index_zero, index_zero]
+    count = num_pixels - removed
+    zero_shift = np.repeat(zero_shift, num_samples)
+
+    def sum_of_products(pIndexA, pZeroA, pIndexB, pZeroB):
+        # sum over the kept pixels of the product of two columns
+        return products[pIndexA, pIndexB] - removed * np.outer(pZeroA, pZeroB)
+
+    def sum_of_squares(pIndexA, pZeroA, pIndexB, pZeroB):
+        # sum over the kept pixels of the products of the same sample, for each pair
+        return np.diag(products[pIndexA, pIndexB])[:, np.newaxis] - removed * (pZeroA * pZeroB)[:, np.newaxis]
+
+    # sums of the corrected values of sample i over the pixels kept for the pair (i, j)
+    sum_values = (sums[index_values] - removed * zero_value[:, np.newaxis].T).T
+    sum_shift = (sums[index_shift] - removed * zero_shift[:, np.newaxis].T).T
+    sum_corrected = sum_values - removed * sum_shift
+
+    cross = sum_of_products(index_values, zero_value, index_values, zero_value) - \
+        removed * sum_of_products(index_values, zero_value, index_shift, zero_shift) - \
+        removed * sum_of_products(index_shift, zero_shift, index_values, zero_value) + \
+        removed ** 2 * sum_of_products(index_shift, zero_shift, index_shift, zero_shift)
+    squares = sum_of_squares(index_values, zero_value, index_values, zero_value) - \
+        2 * removed * sum_of_squares(index_values, zero_value, index_shift, zero_shift) + \
+        removed ** 2 * sum_of_squares(index_shift, zero_shift, index_shift, zero_shift)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = cross - sum_corrected * sum_corrected.T / count
+        variance = squares - sum_corrected ** 2 / count
+    return count, variance, covariance
+
+
+def compute_correlation_matrix(pPixelMatrix, pMethod='pearson', pChunkSize=1000000):
+    """
+    Computes the Pearson or Spearman correlation of all pairs of columns
+    (samples) of a pixels x samples matrix with compute_pairwise_statistics.
+    For each pair of samples, the pixels that are zero in both samples are
+    not considered.
+
+    >>> from scipy.stats import spearmanr
+    >>> pixels = np.array([[0, 1, 3], [2, 0, 0], [0, 0, 1], [4, 2, 0], [1, 1, 2]], dtype=float)
+    >>> keep = (pixels[:, 0] != 0) | (pixels[:, 1] != 0)
+    >>> correlation = compute_correlation_matrix(pixels, 'spearman', pChunkSize=2)
+    >>> np.allclose(correlation[0, 1], spearmanr(pixels[keep, 0], pixels[keep, 1])[0])
+    True
+    >>> np.allclose(compute_correlation_matrix(pixels)[0, 1], np.corrcoef(pixels[keep, :2].T)[0, 1])
+    True
+    """
+    _, variance, covariance = compute_pairwise_statistics(pPixelMatrix, pMethod, pChunkSize)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation = covariance / np.sqrt(variance * variance.T)
+    np.fill_diagonal(correlation, 1)
+    return correlation
 
-        if args.log1p:
-            _mat.data = np.log1p(_mat.data)
-        if all_mat is None:
-            all_mat = _mat
-        else:
-            all_mat = all_mat + _mat
 
-        if max_value is None or max_value < _mat.data.max():
-            max_value = _mat.data.max()
-        if min_value is None or min_value > _mat.data.min():
-            min_value = _mat.data.min()
+def compute_scc_chromosome(pPixelMatrix, pDistances):
+    """
+    Computes the stratum-adjusted correlation coefficient (SCC) of HiCRep
+    (Yang et al. 2017) for the pixels of one chromosome. For each diagonal,
+    the Pearson correlation r_d of all pairs of samples is computed with
+    compute_pairwise_statistics. It is weighted by N_d * sqrt(var(R_i / N_d) *
+    var(R_j / N_d)), with N_d the number of pixels of the diagonal that are not
+    zero in both samples and R_i their ranks in sample i.
+
+    Returns
+    -------
+    the sums over the diagonals of the weighted correlations and of the weights,
+    such that the sums of several chromosomes can be added
+    """
+    num_samples = pPixelMatrix.shape[1]
+    weighted_correlation = np.zeros((num_samples, num_samples))
+    weights = np.zeros((num_samples, num_samples))
+
+    order = np.argsort(pDistances, kind='stable')
+    distances = pDistances[order]
+    pixels = np.asarray(pPixelMatrix)[order]
+    boundaries = np.concatenate([[0], np.flatnonzero(np.diff(distances)) + 1, [len(distances)]])
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        diagonal = pixels[start:end]
+        count, variance, covariance = compute_pairwise_statistics(diagonal, 'pearson')
+        _, rank_variance, _ = compute_pairwise_statistics(diagonal, 'spearman')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            correlation = covariance / np.sqrt(variance * variance.T)
+            # var(R / N) is the sum of squared rank deviations / N^3
+            weight = count * np.sqrt(rank_variance * rank_variance.T) / count ** 3
+        valid = np.isfinite(correlation) & np.isfinite(weight) & (count > 1)
+        weighted_correlation[valid] += weight[valid] * correlation[valid]
+        weights[valid] += weight[valid]
+    return weighted_correlation, weights
+
+
+def compute_scc_chromosome_wrapper(pArgs):
+    return compute_scc_chromosome(*pArgs)
+
+
+def compute_scc_matrix(pPixelMatrix, pDistances, pChromosomeRanges, pThreads):
+    """
+    Computes the stratum-adjusted correlation coefficient of all pairs of
+    samples. The chromosomes are processed in parallel and the SCC is the
+    weighted mean of the correlations of the diagonals of all chromosomes.
+    """
+    tasks = [(pPixelMatrix[start:end], pDistances[start:end]) for _, start, end in pChromosomeRanges
+             if end > start]
+    pool = Pool(min(max(pThreads, 1), max(len(tasks), 1)))
+    results = pool.map_async(compute_scc_chromosome_wrapper, tasks).get(9999999)
+    pool.close()
+    pool.join()
+
+    weighted_correlation = sum([result[0] for result in results])
+    weights = sum([result[1] for result in results])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scc = weighted_correlation / weights
+    np.fill_diagonal(scc, 1)
+    return scc
+
+
+def save_correlation(pCorrelation, pLabels, pFileName):
+    """
+    Saves the correlation matrix as .npy file or as tab-separated table.
+    """
+    if pFileName.endswith('.npy'):
+        np.save(pFileName, pCorrelation)
+        return
+    with open(pFileName, 'w') as file:
+        file.write("#\t{}\n".format("\t".join(pLabels)))
+        for label, correlation in zip(pLabels, pCorrelation):
+            file.write("{}\t{}\n".format(label, "\t".join(["{:.6f}".format(value) for value in correlation])))
+
+
+def set_pixel_matrix(pPixelMatrix):
+    """
+    Initializer of the worker processes of plot_scatter. The pixel matrix is
+    inherited by the processes instead of being sent with each task.
+    """
+    global pixel_matrix
+    pixel_matrix = pPixelMatrix
+
 
-        hic_mat_list.append(_mat)
+def compute_histogram(pRow, pCol, pBins=150):
+    """
+    Computes the 2D histogram of the values of two samples of the pixel
+    matrix, without the pixels that are zero in both samples.
+    """
+    values = np.asarray(pixel_matrix[:, [pRow, pCol]])
+    values = values[(values != 0).any(axis=1), :]
+    return np.histogram2d(values[:, 0], values[:, 1], bins=pBins)
 
-    # remove nan bins
-    rows_keep = cols_keep = np.delete(list(range(all_mat.shape[1])), all_nan)
-    all_mat = all_mat[rows_keep, :][:, cols_keep]
 
-    # make large matrix to correlate by
-    # using sparse matrix tricks
+def compute_histogram_wrapper(pArgs):
+    return compute_histogram(*pArgs)
 
-    big_mat = None
-    for mat in hic_mat_list:
-        mat = mat[rows_keep, :][:, cols_keep]
-        sample_vector = (mat + all_mat).data - all_mat.data
-        if big_mat is None:
-            big_mat = sample_vector
-        else:
-            big_mat = np.vstack([big_mat, sample_vector])
 
-    # take the transpose such that columns represent each of the samples
-    big_mat = np.ma.masked_invalid(big_mat).T
+def plot_scatter(pPixelMatrix, pCorrelation, pLabels, pMethod, pLog1p, pFileName, pThreads):
+    """
+    Plots the 2D histograms of the values of all pairs of samples in a grid.
+    The histograms are computed in parallel and drawn as images, such that
+    the plotting time does not depend on the number of pixels.
+    """
+    num_files = pPixelMatrix.shape[1]
+    rows, cols = np.triu_indices(num_files, k=1)
+    tasks = list(zip(rows, cols))
+    histograms = []
+    if len(tasks):
+        pool = Pool(min(max(pThreads, 1), len(tasks)), initializer=set_pixel_matrix, initargs=(pPixelMatrix,))
+        histograms = pool.map_async(compute_histogram_wrapper, tasks).get(9999999)
+        pool.close()
+        pool.join()
 
     grids = gridspec.GridSpec(num_files, num_files)
     grids.update(wspace=0, hspace=0)
     fig = plt.figure(figsize=(2 * num_files, 2 * num_files))
     plt.rcParams['font.size'] = 8.0
 
-    min_value = int(big_mat.min())
-    max_value = int(big_mat.max())
+    min_value = int(min([pPixelMatrix[:, sample].min() for sample in range(num_files)]))
+    max_value = int(max([pPixelMatrix[:, sample].max() for sample in range(num_files)]))
     if (min_value % 2 == 0 and max_value % 2 == 0) or \
             (min_value % 1 == 0 and max_value % 2 == 1):
         # make one value odd and the other even
         max_value += 1
 
-    if args.log1p:
+    if pLog1p:
         major_locator = FixedLocator(list(range(min_value, max_value, 2)))
         minor_locator = FixedLocator(list(range(min_value, max_value, 1)))
 
-    for index in range(len(rows)):
-        row = rows[index]
-        col = cols[index]
-        if row == col:
-            results[row, col] = 1
-
-            # add titles as
-            # empty plot in the diagonal
-            ax = fig.add_subplot(grids[row, col])
-            ax.text(0.6, 0.6, args.labels[row],
-                    verticalalignment='center',
-                    horizontalalignment='center',
-                    fontsize=10, fontweight='bold',
-                    transform=ax.transAxes)
-            ax.set_axis_off()
-            continue
-
-        log.info("comparing {} and {}\n".format(args.matrices[row],
-                                                args.matrices[col]))
-
-        # remove cases in which both are zero or one is zero and
-        # the other is one
-        _mat = big_mat[:, [row, col]]
-        _mat = _mat[_mat.sum(axis=1) > 1, :]
-        vector1 = _mat[:, 0]
-        vector2 = _mat[:, 1]
-
-        results[row, col] = correlation_opts[args.method](vector1, vector2)[0]
+    for sample in range(num_files):
+        # add titles as
+        # empty plot in the diagonal
+        ax = fig.add_subplot(grids[sample, sample])
+        ax.text(0.6, 0.6, pLabels[sample],
+                verticalalignment='center',
+                horizontalalignment='center',
+                fontsize=10, fontweight='bold',
+                transform=ax.transAxes)
+        ax.set_axis_off()
 
+    for (row, col), (histogram, x_edges, y_edges) in zip(tasks, histograms):
         # scatter plots
         ax = fig.add_subplot(grids[row, col])
-        if args.log1p:
+        if pLog1p:
             ax.xaxis.set_major_locator(major_locator)
             ax.xaxis.set_minor_locator(minor_locator)
             ax.yaxis.set_major_locator(major_locator)
             ax.yaxis.set_minor_locator(minor_locator)
 
-        ax.text(0.2, 0.8, "{}={:.2f}".format(args.method,
-                                             results[row, col]),
+        ax.text(0.2, 0.8, "{}={:.2f}".format(pMethod,
+                                             pCorrelation[row, col]),
                 horizontalalignment='left',
                 transform=ax.transAxes)
         ax.get_yaxis().set_tick_params(
@@ -432,16 +742,58 @@ def main(args=None):
         else:
             ax.set_xticklabels([])
 
-        ax.hist2d(vector1, vector2, bins=150, cmin=0.1)
+        # as hist2d with cmin: empty bins are not drawn
+        ax.imshow(np.ma.masked_less(histogram.T, 0.1), origin='lower', aspect='auto', interpolation='nearest',
+                  extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]))
     fig.tight_layout()
-    log.info("saving {}".format(args.outFileNameScatter))
-    fig.savefig(args.outFileNameScatter, bbox_inches='tight')
-
-    results = results + np.triu(results, 1).T
-    plot_correlation(results, args.labels,
-                     args.outFileNameHeatmap,
-                     args.zMax,
-                     args.zMin,
-                     args.colorMap,
-                     image_format=args.plotFileFormat)
+    log.info("saving {}".format(pFileName))
+    fig.savefig(pFileName, bbox_inches='tight')
+
+
+def main(args=None):
+
+    args = parse_arguments().parse_args(args)
+
+    if args.labels and len(args.matrices) != len(args.labels):
+        log.error("The number of labels does not match the number of matrices.")
+        exit(0)
+    if not args.labels:
+        args.labels = map(lambda x: os.path.basename(x), args.matrices)
+
+    # pixels x samples
+    if args.smoothingWindow and args.method != 'scc':
+        log.error("--smoothingWindow can only be used with the method scc.")
+        exit(1)
+    big_mat, bin_size, distances, chromosome_ranges = get_pixel_matrix(args.matrices, args.chromosomes,
+                                                                       args.range, args.log1p, args.threads,
+                                                                       args.memoryMap, args.smoothingWindow)
+    try:
+        if args.range and int(args.range.split(":")[1]) < bin_size:
+            log.error("Please specify a max range that is larger than bin size ({})".format(bin_size))
+            exit()
+
+        if args.method == 'scc':
+            results = compute_scc_matrix(big_mat, distances, chromosome_ranges, args.threads)
+        else:
+            results = compute_correlation_matrix(big_mat, args.method)
+
+        if args.outFileNameCorrelation:
+            save_correlation(results, args.labels, args.outFileNameCorrelation)
+
+        if args.outFileNameScatter:
+            plot_scatter(big_mat, results, args.labels, args.method, args.log1p,
+                         args.outFileNameScatter, args.threads)
+
+        plot_correlation(results, args.labels,
+                         args.outFileNameHeatmap,
+                         args.zMax,
+                         args.zMin,
+                         args.colorMap,
+                         image_format=args.plotFileFormat)
 #                    plot_numbers=args.plotNumbers)
+    finally:
+        if isinstance(big_mat, np.memmap):
+            file_name = big_mat.filename
+            # the file is only removed after the memory map is released
+            del big_mat
+            os.remove(file_name)
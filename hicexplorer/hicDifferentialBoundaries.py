@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+import os.path
+import argparse
+import logging
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+from scipy import stats
+
+from hicexplorer import hicFindTADs
+from hicexplorer._version import __version__
+from hicexplorer.utilities import toString
+
+# python 2 / 3 compatibility
+from past.builtins import zip
+from builtins import range
+
+log = logging.getLogger(__name__)
+
+
+def parse_arguments(args=None):
+    """
+    get command line arguments
+    """
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        conflict_handler='resolve',
+        description="""
+Finds the TAD boundaries of several Hi-C matrices and joins them in one table
+with the TAD-separation score of each sample at each boundary. The boundaries of
+each sample are found as in `hicFindTADs` and the samples are processed in parallel.
+Boundaries of different samples that are closer than --mergeDistance are joined.
+If the samples belong to two groups (--groups), the TAD-separation scores of the
+groups are compared at each boundary using Welch's t-test.
+
+ A simple example usage is:
+
+$ hicDifferentialBoundaries -m wt_1.h5 wt_2.h5 ko_1.h5 ko_2.h5 --groups wt wt ko ko --outPrefix wt_vs_ko
+
+The TAD-separation score and the z-score matrix of each sample are saved as in
+`hicFindTADs` using the prefix <outPrefix>_<label>, and they are reused if the tool
+is run again with the same prefix.
+""")
+
+    parserRequired = parser.add_argument_group('Required arguments')
+
+    parserRequired.add_argument('--matrices', '-m',
+                                help='Corrected Hi-C matrices of the samples. The matrices should have the same bin size.',
+                                nargs='+',
+                                required=True)
+
+    parserRequired.add_argument('--outPrefix',
+                                help='File prefix to save the resulting files: 1. <prefix>_boundaries.tsv '
+                                'The joint boundaries with the columns chrom, start, end, number of samples '
+                                'having the boundary, the TAD-separation score and the presence (1 or 0) of the '
+                                'boundary in each sample and the statistics of the scores. 2. For each sample, '
+                                'the TAD-separation score and the z-score matrix files of `hicFindTADs` '
+                                '(<prefix>_<label>_tad_score.h5 and <prefix>_<label>_zscore_matrix.h5).',
+                                required=True)
+
+    parserOpt = parser.add_argument_group('Optional arguments')
+
+    parserOpt.add_argument('--labels',
+                           help='Label of each sample. By default the file names of the matrices are used.',
+                           nargs='+')
+
+    parserOpt.add_argument('--groups',
+                           help='Group of each sample, for example: wt wt ko ko. If two groups are given, the mean '
+                           'TAD-separation score of each group, the difference (second group minus first group) '
+                           'and the p-value (Welch\'s t-test) and q-value (Benjamini-Hochberg) of the difference '
+                           'are computed for each boundary. Otherwise, the mean and standard deviation of the '
+                           'scores of all samples are given.',
+                           nargs='+')
+
+    parserOpt.add_argument('--mergeDistance',
+                           help='Boundaries of different samples that are closer than this distance (in bp) '
+                           'are considered the same boundary. The position of the joint boundary is the one found '
+                           'in most samples. By default the --minBoundaryDistance is used.',
+                           metavar='INT bp',
+                           type=int)
+
+    parserOpt.add_argument('--minDepth',
+                           help='Minimum window length (in bp) to be considered to the left and to the right '
+                           'of each Hi-C bin (see hicFindTADs).',
+                           metavar='INT bp',
+                           type=int)
+
+    parserOpt.add_argument('--maxDepth',
+                           help='Maximum window length to be considered to the left and to the right '
+                           'of the cut point in bp (see hicFindTADs).',
+                           metavar='INT bp',
+                           type=int)
+
+    parserOpt.add_argument('--step',
+                           help='Step size when moving from --minDepth to --maxDepth (see hicFindTADs).',
+                           metavar='INT bp',
+                           type=int)
+
+    parserOpt.add_argument('--correctForMultipleTesting',
+                           help='Multiple comparison method used to find the boundaries of each sample '
+                           '(see hicFindTADs).',
+                           type=str,
+                           default="fdr",
+                           choices=['fdr', 'bonferroni', 'None'])
+
+    parserOpt.add_argument('--thresholdComparisons',
+                           help='P-value threshold for the bonferroni correction / q-value for FDR used to find '
+                           'the boundaries of each sample (see hicFindTADs).',
+                           type=float,
+                           default=0.01)
+
+    parserOpt.add_argument('--delta',
+                           help='Minimum threshold of the difference between the TAD-separation score of a '
+                           'putative boundary and the mean of the TAD-sep. score of surrounding bins '
+                           '(see hicFindTADs).',
+                           type=float,
+                           default=0.01)
+
+    parserOpt.add_argument('--minBoundaryDistance',
+                           help='Minimum distance between boundaries (in bp) of a sample (see hicFindTADs).',
+                           metavar='INT bp',
+                           type=int)
+
+    parserOpt.add_argument('--chromosomes',
+                           help='Chromosomes to include in the analysis.',
+                           nargs='+')
+
+    parserOpt.add_argument('--numberOfProcessors', '-p',
+                           help='Number of processors to use. If there are more processors than samples, the '
+                           'samples are processed one after another using all processors. Otherwise, the '
+                           'samples are processed in parallel using one processor each.',
+                           type=int,
+                           default=1)
+
+    parserOpt.add_argument('--help', '-h', action='help', help='show this help message and exit.')
+
+    parserOpt.add_argument('--version', action='version',
+                           version='%(prog)s {}'.format(__version__))
+    return parser
+
+
+def compute_sample_boundaries(matrix_file, out_prefix, tad_parameters, num_processors=1):
+    """
+    Computes the TAD-separation score of a sample, or loads it if it was already
+    saved using the same prefix, and finds the boundaries.
+
+    Parameters
+    ----------
+    matrix_file Hi-C matrix of the sample
+    out_prefix prefix of the TAD-separation score and z-score matrix files
+    tad_parameters dict of parameters for HicFindTads
+
+    Returns
+    -------
+    dict with the 'chrom', 'chr_start' and 'chr_end' of each bin, the TAD-separation 'score'
+    (mean of all window lengths) and the indices of the bins at the 'boundaries'
+    """
+    tad_score_file = hicFindTADs.get_tad_score_file(out_prefix)
+    zscore_matrix_file = out_prefix + "_zscore_matrix.h5"
+    if tad_score_file is not None and os.path.isfile(zscore_matrix_file):
+        log.info("Found existing TAD-separation score file: {}\n".format(tad_score_file))
+        ft = hicFindTADs.HicFindTads(zscore_matrix_file, num_processors=num_processors, **tad_parameters)
+        ft.load_tad_score_matrix(tad_score_file, tad_parameters['pChromosomes'])
+    else:
+        ft = hicFindTADs.HicFindTads(matrix_file, num_processors=num_processors, **tad_parameters)
+        ft.compute_spectra_matrix()
+        ft.hic_ma.save(zscore_matrix_file)
+        ft.save_tad_score_matrix(out_prefix + "_tad_score.h5")
+
+    chrom = toString(np.asarray(ft.bedgraph_matrix['chrom']))
+    try:
+        ft.find_boundaries()
+        boundaries, chr_end_idx = ft.filter_boundaries()
+        boundaries = np.array(boundaries, dtype=int)
+    except hicFindTADs.NoBoundariesError:
+        boundaries, chr_end_idx = np.array([], dtype=int), []
+
+    # as in the boundaries file of hicFindTADs, boundaries at the
+    # start or at the end of a chromosome are skipped
+    boundaries = boundaries[(boundaries > 0) & ~np.in1d(boundaries, chr_end_idx)]
+    boundaries = boundaries[chrom[boundaries] == chrom[boundaries - 1]]
+    log.info("{} boundaries found for {}\n".format(len(boundaries), matrix_file))
+
+    return {'chrom': chrom,
+            'chr_start': np.asarray(ft.bedgraph_matrix['chr_start']),
+            'chr_end': np.asarray(ft.bedgraph_matrix['chr_end']),
+            'score': ft.bedgraph_matrix['matrix'].mean(axis=1),
+            'boundaries': boundaries}
+
+
+def compute_sample_boundaries_wrapper(args):
+    return compute_sample_boundaries(*args)
+
+
+def merge_boundaries(samples, merge_distance):
+    """
+    Joins the boundaries of all samples. Boundaries of different samples that are in the
+    same chromosome and less than merge_distance bp apart from the first boundary of a
+    joint boundary are considered the same boundary. A joint boundary contains at most
+    one boundary per sample, and its position is the position found in most samples.
+
+    Parameters
+    ----------
+    samples list of dicts as returned by compute_sample_boundaries
+
+    Returns
+    -------
+    chrom, start and end arrays of the joint boundaries and a boolean array
+    (joint boundaries x samples) that is True if the sample has the boundary
+
+    >>> samples = [{'chrom': np.array(['a'] * 6), 'chr_start': np.arange(0, 60, 10),
+    ...             'chr_end': np.arange(10, 70, 10), 'boundaries': np.array([1, 4])},
+    ...            {'chrom': np.array(['a'] * 6), 'chr_start': np.arange(0, 60, 10),
+    ...             'chr_end': np.arange(10, 70, 10), 'boundaries': np.array([2, 4])},
+    ...            {'chrom': np.array(['a'] * 6), 'chr_start': np.arange(0, 60, 10),
+    ...             'chr_end': np.arange(10, 70, 10), 'boundaries': np.array([2])}]
+    >>> chrom, start, end, has_boundary = merge_boundaries(samples, 15)
+    >>> start, end
+    (array([20, 40]), array([30, 50]))
+    >>> has_boundary
+    array([[ True,  True,  True],
+           [ True,  True, False]])
+    """
+    chrom = np.concatenate([sample['chrom'][sample['boundaries']] for sample in samples])
+    start = np.concatenate([sample['chr_start'][sample['boundaries']] for sample in samples])
+    end = np.concatenate([sample['chr_end'][sample['boundaries']] for sample in samples])
+    sample_id = np.concatenate([np.repeat(idx, len(sample['boundaries'])) for idx, sample in enumerate(samples)])
+    if len(chrom) == 0:
+        return chrom, start, end, np.zeros((0, len(samples)), dtype=bool)
+
+    order = np.lexsort((start, chrom))
+    chrom, start, end, sample_id = chrom[order], start[order], end[order], sample_id[order]
+
+    # a new joint boundary starts at each chromosome change, at merge_distance bp from the first
+    # boundary of the current joint boundary or if the sample already has a boundary in it
+    joint_id = np.zeros(len(start), dtype=int)
+    anchor = 0
+    joint_samples = set()
+    for idx in range(len(start)):
+        if chrom[idx] != chrom[anchor] or start[idx] - start[anchor] >= merge_distance or \
+                sample_id[idx] in joint_samples:
+            joint_id[idx] = joint_id[anchor] + 1
+            anchor = idx
+            joint_samples = set()
+        else:
+            joint_id[idx] = joint_id[anchor]
+        joint_samples.add(sample_id[idx])
+    num_joint = joint_id[-1] + 1
+
+    has_boundary = np.zeros((num_joint, len(samples)), dtype=bool)
+    has_boundary[joint_id, sample_id] = True
+
+    # the most frequent start position of each joint boundary. In case of ties the smallest
+    # position is used.
+    positions, first_idx, counts = np.unique(np.vstack([joint_id, start]).T, axis=0,
+                                             return_index=True, return_counts=True)
+    order = np.lexsort((positions[:, 1], -counts, positions[:, 0]))
+    is_first = np.concatenate([[True], positions[order[1:], 0] != positions[order[:-1], 0]])
+    consensus = first_idx[order[is_first]]
+
+    return chrom[consensus], start[consensus], end[consensus], has_boundary
+
+
+def get_scores_at_positions(sample, chrom, position):
+    """
+    Returns the TAD-separation score of the sample at the bins containing the given
+    positions. The score is nan for positions not found in the sample.
+
+    >>> sample = {'chrom': np.array(['a', 'a', 'b', 'b']), 'chr_start': np.array([0, 10, 0, 10]),
+    ...           'chr_end': np.array([10, 20, 10, 20]), 'score': np.array([1., 2., 3., 4.])}
+    >>> get_scores_at_positions(sample, np.array(['b', 'a', 'a', 'c']), np.array([15, 5, 25, 5]))
+    array([ 4.,  1., nan, nan])
+    """
+    scores = np.full(len(chrom), np.nan)
+    for chrom_name in np.unique(chrom):
+        in_chrom = np.flatnonzero(chrom == chrom_name)
+        sample_rows = np.flatnonzero(sample['chrom'] == chrom_name)
+        if len(sample_rows) == 0:
+            continue
+        row = np.searchsorted(sample['chr_start'][sample_rows], position[in_chrom], side='right') - 1
+        is_found = (row >= 0) & (position[in_chrom] < sample['chr_end'][sample_rows[np.maximum(row, 0)]])
+        scores[in_chrom[is_found]] = sample['score'][sample_rows[row[is_found]]]
+
+    return scores
+
+
+def benjamini_hochberg(pvalues):
+    """
+    Returns the Benjamini-Hochberg q-values of the given p-values. nan values are ignored.
+
+    >>> benjamini_hochberg(np.array([0.01, 0.04, np.nan, 0.03]))
+    array([0.03, 0.04,  nan, 0.04])
+    """
+    qvalues = np.full(len(pvalues), np.nan)
+    is_valid = np.flatnonzero(~np.isnan(pvalues))
+    order = is_valid[np.argsort(pvalues[is_valid])]
+    qvalues_sorted = pvalues[order] * len(order) / np.arange(1, len(order) + 1)
+    qvalues[order] = np.minimum(1, np.minimum.accumulate(qvalues_sorted[::-1])[::-1])
+
+    return qvalues
+
+
+def compute_statistics(scores, groups=None):
+    """
+    Computes the statistics of the TAD-separation scores (boundaries x samples).
+    Without groups, the mean and standard deviation of all samples are computed.
+    For two groups, the mean of each group, the difference of the means (second group
+    minus first group) and the p-value (Welch's t-test) and q-value of the difference.
+
+    Returns
+    -------
+    OrderedDict with the name and values of each statistic
+    """
+    statistics = OrderedDict()
+    if groups is None:
+        statistics['mean'] = np.nanmean(scores, axis=1)
+        statistics['std'] = np.nanstd(scores, axis=1)
+        return statistics
+
+    groups = np.asarray(groups)
+    group_names = list(OrderedDict.fromkeys(groups))
+    first, second = [scores[:, groups == group_name] for group_name in group_names]
+    statistics['mean_' + group_names[0]] = np.nanmean(first, axis=1)
+    statistics['mean_' + group_names[1]] = np.nanmean(second, axis=1)
+    statistics['difference'] = statistics['mean_' + group_names[1]] - statistics['mean_' + group_names[0]]
+    if first.shape[1] > 1 and second.shape[1] > 1:
+        pvalues = stats.ttest_ind(first, second, axis=1, equal_var=False)[1]
+    else:
+        log.warning("At least two samples per group are needed to compute p-values.\n")
+        pvalues = np.full(len(scores), np.nan)
+    statistics['pvalue'] = pvalues
+    statistics['qvalue'] = benjamini_hochberg(pvalues)
+
+    return statistics
+
+
+def save_boundaries_table(file_name, labels, chrom, start, end, has_boundary, scores, statistics):
+    with open(file_name, 'w') as fh:
+        fh.write("#chrom\tstart\tend\tsamples\t{}\t{}\t{}\n".format(
+            "\t".join(["{}_score".format(label) for label in labels]),
+            "\t".join(["{}_boundary".format(label) for label in labels]),
+            "\t".join(statistics.keys())))
+        for idx in range(len(chrom)):
+            fh.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(
+                chrom[idx], start[idx], end[idx], has_boundary[idx].sum(),
+                "\t".join(["{:.12f}".format(score) for score in scores[idx]]),
+                "\t".join([str(int(value)) for value in has_boundary[idx]]),
+                "\t".join(["{:.12g}".format(values[idx]) for values in statistics.values()])))
+
+
+def main(args=None):
+
+    args = parse_arguments().parse_args(args)
+
+    labels = args.labels
+    if labels is None:
+        labels = [os.path.splitext(os.path.basename(matrix_file))[0] for matrix_file in args.matrices]
+    if len(labels) != len(args.matrices):
+        log.error("The number of labels ({}) does not match the number of matrices ({}).".format(len(labels), len(args.matrices)))
+        exit(1)
+    if len(set(labels)) != len(labels):
+        log.error("The labels of the samples are not unique: {}. Please use --labels.".format(" ".join(labels)))
+        exit(1)
+    if args.groups is not None:
+        if len(args.groups) != len(args.matrices):
+            log.error("The number of groups ({}) does not match the number of matrices ({}).".format(len(args.groups), len(args.matrices)))
+            exit(1)
+        if len(set(args.groups)) != 2:
+            log.error("Exactly two different groups are needed to compare the samples.")
+            exit(1)
+
+    tad_parameters = {'max_depth': args.maxDepth, 'min_depth': args.minDepth, 'step': args.step,
+                      'delta': args.delta, 'min_boundary_distance': args.minBoundaryDistance,
+                      'p_correct_for_multiple_testing': args.correctForMultipleTesting,
+                      'p_threshold_comparisons': args.thresholdComparisons,
+                      'pChromosomes': args.chromosomes}
+
+    # the samples are processed in parallel, unless there are enough processors to
+    # use several of them for each sample
+    if args.numberOfProcessors > len(args.matrices):
+        TASKS = [(matrix_file, "{}_{}".format(args.outPrefix, label), tad_parameters, args.numberOfProcessors)
+                 for matrix_file, label in zip(args.matrices, labels)]
+        samples = [compute_sample_boundaries(*task) for task in TASKS]
+    else:
+        TASKS = [(matrix_file, "{}_{}".format(args.outPrefix, label), tad_parameters)
+                 for matrix_file, label in zip(args.matrices, labels)]
+        if args.numberOfProcessors > 1:
+            pool = multiprocessing.Pool(args.numberOfProcessors)
+            samples = pool.map_async(compute_sample_boundaries_wrapper, TASKS).get(9999999)
+            pool.close()
+            pool.join()
+        else:
+            samples = [compute_sample_boundaries(*task) for task in TASKS]
+
+    merge_distance = args.mergeDistance
+    if merge_distance is None:
+        merge_distance = args.minBoundaryDistance
+    if merge_distance is None:
+        # same default as the minimum boundary distance of hicFindTADs
+        merge_distance = np.median(samples[0]['chr_end'] - samples[0]['chr_start']) * 4
+
+    chrom, start, end, has_boundary = merge_boundaries(samples, merge_distance)
+    scores = np.vstack([get_scores_at_positions(sample, chrom, start) for sample in samples]).T
+    statistics = compute_statistics(scores, args.groups)
+    log.info("{} joint boundaries found for {} samples\n".format(len(chrom), len(samples)))
+
+    save_boundaries_table(args.outPrefix + "_boundaries.tsv", labels, chrom, start, end,
+                          has_boundary, scores, statistics)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import division
+import sys
 import os.path
 import logging
 import argparse
@@ -9,10 +10,14 @@ from collections import OrderedDict
 from hicmatrix import HiCMatrix as hm
 from hicexplorer.utilities import enlarge_bins
 from scipy import sparse
+from scipy.stats import norm
 import numpy as np
+import pandas as pd
+import tables
 import multiprocessing
 from hicexplorer._version import __version__
-from hicexplorer.utilities import toString, check_chrom_str_bytes
+from hicexplorer.utilities import toString, toBytes, check_chrom_str_bytes
+from hicexplorer.utilities import share_arrays, get_shared_arrays
 
 # python 2 / 3 compatibility
 from past.builtins import zip
@@ -22,8 +27,22 @@ from past.builtins import map
 
 log = logging.getLogger(__name__)
 
-# this is a holder vor the
-hic_ma = None
+# these are holders for the band-limited Hi-C matrix and the bin positions
+# used by the processes that compute the TAD-separation score. In the
+# worker processes the arrays are views of shared memory (see share_arrays)
+shared_matrix = None
+shared_bin_starts = None
+shared_bin_ends = None
+
+# holder of the HicFindTads object used by the processes of a parameter sweep
+sweep_tads = None
+
+
+class NoBoundariesError(Exception):
+    """
+    Raised by HicFindTads.find_boundaries if no boundary is found.
+    """
+    pass
 
 
 def parse_arguments(args=None):
@@ -63,11 +82,13 @@ of information at certain bins, and depending on the parameters used with this t
                                 required=True)
 
     parserRequired.add_argument('--outPrefix',
-                                help='File prefix to save the resulting files: 1. <prefix>_tad_separation.bm '
-                                'The format of the output file is chrom start end TAD-sep1 TAD-sep2 TAD-sep3 .. etc. '
-                                'We call this format a bedgraph matrix and can be plotted using '
-                                '`hicPlotTADs`. Each of the TAD-separation scores in the file corresponds to '
-                                'a different window length starting from --minDepth to --maxDepth. '
+                                help='File prefix to save the resulting files: 1. <prefix>_tad_score.h5 '
+                                'The TAD-separation score of each bin in HDF5 format. Each of the TAD-separation '
+                                'scores of a bin corresponds to a different window length starting from --minDepth '
+                                'to --maxDepth. With --exportBedgraphMatrix the scores are also saved as '
+                                '<prefix>_tad_score.bm. The format of this file is chrom start end TAD-sep1 TAD-sep2 '
+                                'TAD-sep3 .. etc. We call this format a bedgraph matrix and can be plotted using '
+                                '`hicPlotTADs`. '
                                 '2. <prefix>_zscore_matrix.h5, the zscore matrix used for the computation of '
                                 'the TAD-separation score.  3. < prefix > _boundaries.bed, which'
                                 'contains the positions of boundaries. The genomic coordinates in this file '
@@ -127,6 +148,12 @@ of information at certain bins, and depending on the parameters used with this t
                            'not be used.',
                            required=False)
 
+    parserOpt.add_argument('--exportBedgraphMatrix',
+                           help='Save the TAD-separation score also as a text bedgraph matrix '
+                           '(<prefix>_tad_score.bm) that can be plotted with `hicPlotTADs`. Writing '
+                           'this file is slow for large matrices.',
+                           action='store_true')
+
     parserOpt.add_argument('--thresholdComparisons',
                            help='P-value threshold for the bonferroni correction / q-value for FDR. '
                            'The probability of a local minima to be a boundary '
@@ -135,9 +162,11 @@ of information at certain bins, and depending on the parameters used with this t
                            'regions (diamond) at the local minimum with the matrix zscores for a '
                            'diamond at --minDepth to the left and a diamond --minDepth to the right. '
                            'If --correctForMultipleTesting is \'None\' the threshold is applied on the '
-                           'raw p-values without any multiple testing correction. Set it to \'1\' if no threshold should be used.',
+                           'raw p-values without any multiple testing correction. Set it to \'1\' if no threshold should be used. '
+                           'Several values can be given for a parameter sweep (see below).',
                            type=float,
-                           default=0.01)
+                           nargs='+',
+                           default=[0.01])
 
     parserOpt.add_argument('--delta',
                            help='Minimum threshold of the difference between the TAD-separation score of a '
@@ -145,14 +174,38 @@ of information at certain bins, and depending on the parameters used with this t
                            'The delta value reduces spurious boundaries that are shallow, which usually '
                            'occur at the center of large TADs when the TAD-sep. score is flat. Higher '
                            'delta threshold values produce more conservative boundary estimations. By '
-                           'default a value of 0.01 is used.',
+                           'default a value of 0.01 is used. Several values can be given for a parameter '
+                           'sweep (see below).',
                            type=float,
-                           default=0.01)
+                           nargs='+',
+                           default=[0.01])
 
     parserOpt.add_argument('--minBoundaryDistance',
                            help='Minimum distance between boundaries (in bp). This parameter can be '
-                           'used to reduce spurious boundaries caused by noise.',
-                           type=int)
+                           'used to reduce spurious boundaries caused by noise. Several values can be given '
+                           'for a parameter sweep: if more than one value is given for --delta, '
+                           '--minBoundaryDistance or --thresholdComparisons, the TAD-separation score and '
+                           'the p-values are computed only once and the boundaries and domains are saved for each '
+                           'combination of values using the file prefix '
+                           '<prefix>_delta_<delta>_minBoundaryDistance_<distance>_thresholdComparisons_<threshold>. '
+                           'The number of boundaries of each combination is saved in <prefix>_parameter_sweep.txt',
+                           nargs='+',
+                           type=int,
+                           default=[None])
+
+    parserOpt.add_argument('--numberOfScales',
+                           help='Number of scales for nested TAD calls. The window lengths from --minDepth to '
+                           '--maxDepth are split into this number of consecutive bands and the boundaries '
+                           'of each band are called using the mean TAD-separation score of its window lengths. '
+                           'The --minBoundaryDistance grows with the window length of each band. Boundaries '
+                           'of coarser scales are linked to the closest boundary of the finer scales such that '
+                           'the domains of each scale are nested in the domains of the next coarser scale. The '
+                           'boundaries and domains of each scale are saved in <prefix>_scale_<n>_boundaries.bed '
+                           'and <prefix>_scale_<n>_domains.bed, being scale 1 the finest, and all domains '
+                           'are saved in <prefix>_nested_domains.bed. The TAD-separation score is computed only '
+                           'once for all scales.',
+                           type=int,
+                           default=1)
 
     parserOpt.add_argument('--chromosomes',
                            help='Chromosomes and order in which the '
@@ -309,54 +362,345 @@ def get_incremental_step_size(min_win_size, max_win_size, start_step_len):
     return incremental_step
 
 
-def compute_matrix(bins_list, min_win_size=8, max_win_size=50, step_len=2):
+def set_shared_arrays(shared, shape):
+    """
+    Initializer of the worker processes. Sets the module level holders
+    as views of the arrays of the csr matrix and the bin positions that
+    were put into shared memory by `share_arrays`
+    """
+    global shared_matrix, shared_bin_starts, shared_bin_ends
+    data, indices, indptr, shared_bin_starts, shared_bin_ends = get_shared_arrays(shared)
+    shared_matrix = sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+
+def get_bin_range_at_given_distance(bin_starts, bin_ends, cuts, window_len):
+    """
+    Vectorised version of `get_idx_of_bins_at_given_distance` for
+    the bins of a single chromosome.
+
+    Parameters
+    ----------
+    bin_starts start positions of the bins of the chromosome (sorted)
+    bin_ends end positions of the bins of the chromosome
+    cuts array of reference bin indices (relative to the chromosome)
+    window_len distance in bp
+
+    Returns
+    -------
+    tuple, with left and right bin indices and a boolean array which is
+    False if no bin exists at the left or right position
+    """
+    left_pos = np.maximum(0, bin_starts[cuts] - window_len)
+    right_pos = np.minimum(bin_ends[-1], bin_ends[cuts] + window_len) - 1
+
+    left_idx = np.searchsorted(bin_starts, left_pos, side='right') - 1
+    right_idx = np.searchsorted(bin_starts, right_pos, side='right') - 1
+
+    valid = (left_idx >= 0) & (right_idx >= 0)
+    left_idx[~valid] = 0
+    right_idx[~valid] = 0
+    valid &= (left_pos < bin_ends[left_idx]) & (right_pos < bin_ends[right_idx])
+
+    return left_idx, right_idx, valid
+
+
+def get_band_rectangle_sum(band, first_row, cut, right_idx):
+    """
+    Computes the sum of the rectangles band[first_row:cut, cut:right_idx]
+    of a matrix given in band-diagonal storage, i.e. band[i, k] contains
+    the matrix value at row i and column i + k.
+
+    All the sums are obtained from the summed areas of the band. First, the
+    cumulative sum of each row is computed and then the cumulative sum along the
+    anti-diagonals of the result. The sum of any rectangle not wider than the band
+    is then the combination of four values.
+
+    Parameters
+    ----------
+    band array of shape (number of rows, band width)
+    first_row array of the first row of each rectangle
+    cut array with the row (excluded) and column at which each rectangle ends and starts
+    right_idx array with the last column (excluded) of each rectangle
+
+    Returns
+    -------
+    array with the sum of each rectangle
+
+    >>> matrix = np.triu(np.arange(36, dtype=float).reshape(6, 6))
+    >>> band = np.array([[matrix[i, i + k] if i + k < 6 else 0 for k in range(4)] for i in range(6)])
+    >>> get_band_rectangle_sum(band, np.array([0, 1, 2]), np.array([2, 3, 4]), np.array([4, 5, 6]))
+    array([22., 50., 78.])
+    >>> np.array([matrix[0:2, 2:4].sum(), matrix[1:3, 3:5].sum(), matrix[2:4, 4:6].sum()])
+    array([22., 50., 78.])
+    """
+    num_rows, band_width = band.shape
+    # row_cumsum[i, k] is the sum of band[i, :k]
+    row_cumsum = np.zeros((num_rows, band_width + 1))
+    np.cumsum(band, axis=1, out=row_cumsum[:, 1:])
+
+    # skewed[i + k, k] = row_cumsum[i, k], such that each row of the skewed
+    # array contains one anti-diagonal. The last column is kept as zero.
+    skewed = np.zeros((num_rows + band_width + 1, band_width + 2))
+    diag_idx = np.arange(band_width + 1)
+    skewed[np.arange(num_rows)[:, None] + diag_idx, diag_idx] = row_cumsum
+    # anti_diag_cumsum[s, k] is the sum of row_cumsum[i, s - i] for i <= s - k
+    anti_diag_cumsum = np.cumsum(skewed[:, ::-1], axis=1)[:, ::-1]
+
+    def rows_sum(col_end):
+        # sum of row_cumsum[i, col_end - i] for i in [first_row, cut)
+        return anti_diag_cumsum[col_end, col_end - cut + 1] - anti_diag_cumsum[col_end, col_end - first_row + 1]
+
+    return rows_sum(right_idx) - rows_sum(cut)
+
+
+def get_diamond_mean(matrix, left_idx, cut, right_idx):
+    """
+    Vectorised version of `get_cut_weight` with `return_mean=True`. Computes
+    the mean of matrix[left_idx:cut, cut:right_idx] for each of the given indices.
+    Missing values (nan) in a diamond result in nan.
+
+    Parameters
+    ----------
+    matrix sparse matrix. Only the values above the diagonal are used.
+    left_idx array of left indices
+    cut array of bin indices
+    right_idx array of right indices (excluded)
+
+    Returns
+    -------
+    array with the mean of each diamond. Empty diamonds have a mean of 0.
+    """
+    left_idx, cut, right_idx = np.broadcast_arrays(left_idx, cut, right_idx)
+    area = (cut - left_idx) * (right_idx - cut)
+    diamond_mean = np.zeros(area.shape)
+    non_empty = area > 0
+    if not non_empty.any():
+        return diamond_mean
+
+    left_idx = left_idx[non_empty]
+    cut = cut[non_empty]
+    right_idx = right_idx[non_empty]
+
+    # get the part of the matrix needed for all the diamonds in band-diagonal storage
+    first_row = left_idx.min()
+    num_rows = cut.max() - first_row
+    band_width = (right_idx - left_idx).max()
+    submatrix = matrix[first_row:first_row + num_rows, first_row:first_row + num_rows + band_width].tocoo()
+    diagonal = submatrix.col - submatrix.row
+    in_band = (diagonal >= 0) & (diagonal < band_width)
+    band = np.zeros((num_rows, band_width))
+    band[submatrix.row[in_band], diagonal[in_band]] = submatrix.data[in_band]
+
+    missing = ~np.isfinite(band)
+    band[missing] = 0
+
+    left_idx -= first_row
+    cut -= first_row
+    right_idx -= first_row
+    diamond_sum = get_band_rectangle_sum(band, left_idx, cut, right_idx)
+    num_missing = get_band_rectangle_sum(missing.astype(float), left_idx, cut, right_idx)
+
+    diamond_sum /= area[non_empty]
+    diamond_sum[num_missing > 0] = np.nan
+    diamond_mean[non_empty] = diamond_sum
+
+    return diamond_mean
+
+
+def get_diamond_values(matrix, left_idx, cut, right_idx):
+    """
+    Vectorised version of `get_cut_weight` returning the values of
+    the diamonds matrix[left_idx:cut, cut:right_idx]. All diamonds must
+    have the same shape.
+
+    Returns
+    -------
+    array of shape (number of diamonds, number of values per diamond)
+    """
+    height = cut[0] - left_idx[0]
+    width = right_idx[0] - cut[0]
+    assert np.all(cut - left_idx == height) and np.all(right_idx - cut == width)
+    rows = left_idx[:, None, None] + np.arange(height)[None, :, None]
+    cols = cut[:, None, None] + np.arange(width)[None, None, :]
+    rows, cols = np.broadcast_arrays(rows, cols)
+    values = np.asarray(matrix[rows.ravel(), cols.ravel()]).ravel()
+
+    return values.reshape(len(cut), height * width)
+
+
+def ranksums_by_row(x_values, y_values):
+    """
+    Vectorised Wilcoxon rank-sum test (as `scipy.stats.ranksums`)
+    between each row of `x_values` and the same row of `y_values`.
+    Ties get the average rank.
+
+    >>> from scipy.stats import ranksums
+    >>> x = np.array([[1, 2, 2, 5], [0, 0, 0, 1]])
+    >>> y = np.array([[2, 3, 4], [0, 3, 3]])
+    >>> pvalues = ranksums_by_row(x, y)
+    >>> np.allclose(pvalues, [ranksums(x[0], y[0])[1], ranksums(x[1], y[1])[1]])
+    True
+    """
+    num_x = x_values.shape[1]
+    num_y = y_values.shape[1]
+    values = np.hstack([x_values, y_values]).astype(float)
+    num_rows, num_values = values.shape
+
+    order = np.argsort(values, axis=1, kind='mergesort')
+    sorted_values = values[np.arange(num_rows)[:, None], order]
+
+    # for each position in the sorted rows, find the first and last
+    # position having the same value. The rank of tied values is their average position.
+    positions = np.arange(num_values)
+    is_first = np.ones(sorted_values.shape, dtype=bool)
+    is_first[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+    is_last = np.ones(sorted_values.shape, dtype=bool)
+    is_last[:, :-1] = is_first[:, 1:]
+    first_position = np.maximum.accumulate(np.where(is_first, positions, 0), axis=1)
+    last_position = np.minimum.accumulate(np.where(is_last, positions, num_values - 1)[:, ::-1], axis=1)[:, ::-1]
+
+    ranks = np.zeros(values.shape)
+    ranks[np.arange(num_rows)[:, None], order] = (first_position + last_position) / 2.0 + 1
+
+    rank_sum = ranks[:, :num_x].sum(axis=1)
+    expected = num_x * (num_x + num_y + 1) / 2.0
+    z_score = (rank_sum - expected) / np.sqrt(num_x * num_y * (num_x + num_y + 1) / 12.0)
+    pvalues = 2 * norm.sf(np.abs(z_score))
+    pvalues[np.isnan(values).any(axis=1)] = np.nan
+
+    return pvalues
+
+
+def get_previous_candidate(y_axis, is_candidate, reduce_func):
+    """
+    For each position j of y_axis, finds the closest position k < j for which
+    is_candidate(y_axis[k], j) is True. The search is done for all positions
+    at once by skipping blocks of 2**p values that do not contain a candidate,
+    which are identified using the extremum (reduce_func) of the block. Thus,
+    is_candidate has to be True for the extremum of a block if it is True for any of
+    the values of the block.
+
+    Returns
+    -------
+    array with the position of the previous candidate or -1 if there is none
+
+    >>> y_axis = np.array([3, 1, 4, 1, 5, 9, 2, 6])
+    >>> get_previous_candidate(y_axis, lambda values, pos: values > y_axis[pos], np.maximum)
+    array([-1,  0, -1,  2, -1, -1,  5,  5])
+    """
+    positions = np.arange(len(y_axis))
+    # block_extremum[p][i] is the extremum of y_axis[i:i + 2**p]
+    block_extremum = [y_axis]
+    while 2 ** len(block_extremum) <= len(y_axis):
+        half = 2 ** (len(block_extremum) - 1)
+        block_extremum.append(reduce_func(block_extremum[-1][:-half], block_extremum[-1][half:]))
+
+    # start of the run of non candidates that ends before each position
+    run_start = positions.copy()
+    for power in reversed(range(len(block_extremum))):
+        block_start = run_start - 2 ** power
+        to_check = np.flatnonzero(block_start >= 0)
+        skip = ~is_candidate(block_extremum[power][block_start[to_check]], to_check)
+        run_start[to_check[skip]] = block_start[to_check[skip]]
+
+    return run_start - 1
+
+
+def get_first_trigger(previous_candidate, length):
+    """
+    Given the previous candidate of each position (see get_previous_candidate), returns
+    for each start position s the first position j with a candidate in the range [s, j).
+    `length` is returned if there is no such position.
+
+    >>> get_first_trigger(np.array([-1, 0, -1, 2, -1, -1, 5, 5]), 8)
+    array([1, 3, 3, 6, 6, 6, 8, 8, 8])
     """
-    Receives a number of bins for which the tad-score should be computed.
+    first_trigger = np.full(length + 1, length, dtype=int)
+    has_candidate = np.flatnonzero(previous_candidate >= 0)
+    np.minimum.at(first_trigger, previous_candidate[has_candidate], has_candidate)
+
+    return np.minimum.accumulate(first_trigger[::-1])[::-1]
+
+
+def compute_matrix(chrom_bin_range, bins_range, min_win_size=8, max_win_size=50, step_len=2):
+    """
+    Computes the TAD-separation score for a range of bins
+    of the same chromosome using the matrix in `shared_matrix`.
 
     Parameters
     ----------
-    hic_ma Hi-C matrix object
-    bins_list list of bins to process
+    chrom_bin_range tuple with the first and last (excluded) bin index of the chromosome
+    bins_range tuple with the first and last (excluded) bin index to process
     min_win_size
     max_win_size
     step_len
 
     Returns
     -------
-
+    array of the bin indices whose score could be computed and the
+    matrix of the TAD-separation scores, one row per bin and one column per window length
     """
+    chr_first_bin, chr_last_bin = chrom_bin_range
+    bin_starts = shared_bin_starts[chr_first_bin:chr_last_bin]
+    bin_ends = shared_bin_ends[chr_first_bin:chr_last_bin]
+    cuts = np.arange(*bins_range) - chr_first_bin
+
+    incremental_step = get_incremental_step_size(min_win_size, max_win_size, step_len)
+    left_idx, right_idx, valid = zip(*[get_bin_range_at_given_distance(bin_starts, bin_ends, cuts, depth)
+                                       for depth in incremental_step])
+    # arrays of shape (number of bins, number of window lengths)
+    left_idx = np.vstack(left_idx).T
+    right_idx = np.vstack(right_idx).T
+    valid_cuts = np.vstack(valid).all(axis=0)
+
+    cond_matrix = get_diamond_mean(shared_matrix, left_idx[valid_cuts] + chr_first_bin,
+                                   cuts[valid_cuts, None] + chr_first_bin,
+                                   right_idx[valid_cuts] + chr_first_bin)
+
+    # skip problematic cases
+    not_nan = ~np.isnan(cond_matrix).any(axis=1)
 
+    return cuts[valid_cuts][not_nan] + chr_first_bin, cond_matrix[not_nan, :]
+
+
+def link_boundaries(fine_boundaries, coarse_boundaries, chrom, max_distance):
     """
-    :param hic_ma: Hi-C matrix object from HiCMatrix
-    :param outfile: String, path of a file to save the conductance
-                matrix in *bedgraph matrix* format
-    :return: (chrom, start, end, matrix)
+    Links each boundary of a coarse scale to the closest boundary of a finer
+    scale that is in the same chromosome and at most `max_distance` bins away.
+
+    Parameters
+    ----------
+    fine_boundaries sorted indices of the boundaries of the finer scale
+    coarse_boundaries sorted indices of the boundaries of the coarse scale
+    chrom chromosome name of each index
+
+    Returns
+    -------
+    the linked coarse boundaries, which take the index of the fine boundary when
+    a link is found, and a boolean array that is True for the coarse boundaries without a link
+
+    >>> chrom = np.array(['a'] * 10 + ['b'] * 10)
+    >>> link_boundaries(np.array([2, 6, 12]), np.array([3, 8, 9, 16]), chrom, 2)
+    (array([ 2,  6,  9, 16]), array([False, False,  True,  True]))
     """
-    global hic_ma
-    positions_array = []
-    cond_matrix = []
-    incremental_step = get_incremental_step_size(min_win_size, max_win_size, step_len)
-    # if type(next(iter(self.interval_trees))) is np.bytes_:
-    #     chrname = toBytes(chrname)
-    # else:
-    #     chrname = toString(chrname)
-    # print("cut_intervals", hic_ma.cut_intervals)
-    for cut in bins_list:
-        chrom, chr_start, chr_end, _ = hic_ma.cut_intervals[cut]
-        # get conductance
-        # for multiple window lengths at a time
-        mult_matrix = [get_cut_weight(hic_ma, cut, depth, return_mean=True) for depth in incremental_step]
-        if any(x is None or np.isnan(x) for x in mult_matrix):
-            # skip problematic cases
-            continue
+    fine_boundaries = np.asarray(fine_boundaries, dtype=int)
+    linked = np.array(coarse_boundaries, dtype=int)
+    if len(fine_boundaries) == 0 or len(linked) == 0:
+        return linked, np.ones(len(linked), dtype=bool)
 
-        cond_matrix.append(mult_matrix)
+    # the closest fine boundaries to the left and to the right
+    right = np.clip(np.searchsorted(fine_boundaries, linked), 0, len(fine_boundaries) - 1)
+    left = np.clip(right - 1, 0, len(fine_boundaries) - 1)
+    candidates = np.vstack([fine_boundaries[left], fine_boundaries[right]])
+    distance = np.abs(candidates - linked).astype(float)
+    distance[chrom[candidates] != chrom[linked]] = np.inf
 
-        positions_array.append((chrom, chr_start, chr_end))
-    chrom, chr_start, chr_end = zip(*positions_array)
-    cond_matrix = np.vstack(cond_matrix)
+    closest = np.argmin(distance, axis=0)
+    columns = np.arange(len(linked))
+    is_linked = distance[closest, columns] <= max_distance
+    linked[is_linked] = candidates[closest, columns][is_linked]
 
-    return chrom, chr_start, chr_end, cond_matrix
+    return linked, ~is_linked
 
 
 class HicFindTads(object):
@@ -402,8 +746,12 @@ class HicFindTads(object):
         self.set_variables()
         self.correct_for_multiple_testing = p_correct_for_multiple_testing
         self.threshold_comparisons = p_threshold_comparisons
+        # maximum number of bins processed by each parallel task
+        self.task_size = 1000
 
     def set_matrix(self, pMatrix, pChromosomes):
+        # p-values computed for a previous matrix are not valid anymore
+        self.pvalues_cache = {}
         if isinstance(pMatrix, str):
             self.hic_ma = hm.hiCMatrix(pMatrix)
         else:
@@ -506,85 +854,106 @@ class HicFindTads(object):
             results to unpack one of the lists into x, y coordinates do:
             x, y = zip(*tab)
         """
-        max_peaks = []
-        min_peaks = []
-        dump = []   # Used to pop the first hit which almost always is false
-
         # check input data
+        y_axis = np.asarray(y_axis, dtype=float)
         if x_axis is None:
             x_axis = np.arange(len(y_axis))
 
         if len(y_axis) != len(x_axis):
             raise ValueError('Input vectors y_axis and x_axis must have same length')
 
-        # store data length for later use
-
         if not (np.isscalar(delta) and delta >= 0):
             raise ValueError("delta must be a positive number")
 
-        # maximum and minimum candidates are temporarily stored in
-        # min_x and min_y respectively
-        min_y, max_y = np.Inf, -np.Inf
-        max_pos, min_pos = None, None
-        search_for = None
-        # Only detect peak if there is 'lookahead' amount of points after it
-        prev_chrom = None
-        for index, (x, y) in enumerate(zip(x_axis[:-lookahead], y_axis[:-lookahead])):
-            assert -np.inf < y < np.inf, "Error, infinity value detected for value at position {}".format(index)
-            if prev_chrom is None:
-                prev_chrom = chrom[index]
-            if prev_chrom != chrom[index]:
-                # reset variables at the start of a chromosome
-                min_y, max_y = np.Inf, -np.Inf
-                max_pos, min_pos = None, None
-                search_for = None
-
-            prev_chrom = chrom[index]
-
-            if y > max_y:
-                max_y = y
-                max_pos = x
-            if y < min_y:
-                min_y = y
-                min_pos = x
-
-            # look for max
-            if y < max_y - delta and max_y != np.Inf and search_for != 'min':
-                # Maximum peak candidate found
-                # look ahead in signal to ensure that this is a peak and not jitter
-                if y_axis[index:index + lookahead].max() < max_y:
-                    max_peaks.append([max_pos, max_y])
-                    dump.append(True)
-                    # set algorithm to only find minimum now
-                    max_y = y
-                    min_y = y
-                    min_pos = x
-                    search_for = 'min'
-                    continue
+        max_peaks = []
+        min_peaks = []
 
-            # look for min
-            if y > min_y + delta and min_y != -np.Inf and search_for != 'max':
-                # Minimum peak candidate found
-                # look ahead in signal to ensure that this is a peak and not jitter
-                if y_axis[index:index + lookahead].min() > min_y:
-                    min_peaks.append([min_pos, min_y])
-                    dump.append(False)
-                    # set algorithm to only find maximum now
-                    min_y = y
-                    max_y = y
-                    max_pos = x
-                    search_for = 'max'
+        # Only detect peak if there is 'lookahead' amount of points after it
+        num_values = max(0, len(y_axis) - lookahead) if lookahead > 0 else 0
+        if num_values == 0:
+            return [max_peaks, min_peaks]
+        not_finite = np.flatnonzero(~np.isfinite(y_axis[:num_values]))
+        assert len(not_finite) == 0, "Error, infinity value detected for value at position {}".format(not_finite[:1])
+
+        # maximum and minimum of the 'lookahead' values starting at each position
+        lookahead_max = y_axis[:num_values].copy()
+        lookahead_min = y_axis[:num_values].copy()
+        for offset in range(1, lookahead):
+            lookahead_max = np.maximum(lookahead_max, y_axis[offset:num_values + offset])
+            lookahead_min = np.minimum(lookahead_min, y_axis[offset:num_values + offset])
+
+        # A maximum is found at position j once a value larger than the lookahead maximum
+        # at j, and larger than y_axis[j] by more than delta, has been seen since the search
+        # started. The same applies, inversely, to the minima. The position at which each
+        # search started is not known in advance. Thus, for each position the closest
+        # previous value that triggers a peak at j is found and, from it, the first
+        # position at which a peak is found for each start of the search.
+        y_axis_checked = y_axis[:num_values]
+        previous_max = get_previous_candidate(y_axis_checked,
+                                              lambda values, pos: (values > lookahead_max[pos]) &
+                                              (values - delta > y_axis_checked[pos]),
+                                              np.maximum)
+        previous_min = get_previous_candidate(y_axis_checked,
+                                              lambda values, pos: (values < lookahead_min[pos]) &
+                                              (values + delta < y_axis_checked[pos]),
+                                              np.minimum)
+        max_trigger = get_first_trigger(previous_max, num_values)
+        min_trigger = get_first_trigger(previous_min, num_values)
+
+        # the search is restarted at the start of each chromosome
+        if chrom is None:
+            chrom_starts = np.array([0])
+        else:
+            chrom = np.asarray(chrom)[:num_values]
+            chrom_starts = np.flatnonzero(np.concatenate([[True], chrom[1:] != chrom[:-1]]))
+        chrom_ends = np.append(chrom_starts[1:], num_values)
+
+        # the searches are followed from the start of each chromosome. Each search
+        # covers the range [search_start, trigger) in which the peak is located
+        max_trigger = max_trigger.tolist()
+        min_trigger = min_trigger.tolist()
+        search_start = []
+        search_end = []
+        search_is_max = []
+        for chrom_start, chrom_end in zip(chrom_starts.tolist(), chrom_ends.tolist()):
+            # at the start of the chromosome both peaks are searched for, the maximum is checked first.
+            search_max = max_trigger[chrom_start] <= min_trigger[chrom_start]
+            start = chrom_start
+            while True:
+                trigger = max_trigger[start] if search_max else min_trigger[start]
+                if trigger >= chrom_end:
+                    break
+                search_start.append(start)
+                search_end.append(trigger)
+                search_is_max.append(search_max)
+                # the search for the opposite peak starts at the trigger position
+                start = trigger
+                search_max = not search_max
+
+        if len(search_start) == 0:
+            return [max_peaks, min_peaks]
+
+        # the peak is the first position having the maximum (or minimum) value of the range
+        search_start = np.array(search_start)
+        search_len = np.array(search_end) - search_start
+        search_is_max = np.array(search_is_max)
+        search_id = np.repeat(np.arange(len(search_start)), search_len)
+        range_start = np.cumsum(search_len) - search_len
+        positions = np.arange(search_len.sum()) - range_start[search_id] + search_start[search_id]
+        values = np.where(search_is_max[search_id], -y_axis[positions], y_axis[positions])
+        peak_pos = positions[np.lexsort((positions, values, search_id))[range_start]]
+
+        for pos, is_max in zip(peak_pos, search_is_max):
+            if is_max:
+                max_peaks.append([x_axis[pos], y_axis[pos]])
+            else:
+                min_peaks.append([x_axis[pos], y_axis[pos]])
 
         # Remove the false hit on the first value of the y_axis
-        try:
-            if dump[0]:
-                max_peaks.pop(0)
-            else:
-                min_peaks.pop(0)
-            del dump
-        except IndexError:
-            # no peaks were found, should the function return empty lists?
-            pass
+        if search_is_max[0]:
+            max_peaks.pop(0)
+        else:
+            min_peaks.pop(0)
 
         return [max_peaks, min_peaks]
 
@@ -610,30 +979,31 @@ class HicFindTads(object):
         """
 
         # compute the start and end points of the chromosomes
-        # and store it as tuples in chrom_ranges list (e.g. chrom_ranges = [(0, 29254), (29254, 60006), ...]
+        # (e.g. chrom_ranges_idx = [0, 29254, 60006, ...]
         unique_chroms, chr_start_idx = np.unique(chrom, return_index=True)
-        chr_start_idx = np.concatenate([chr_start_idx, [len(chrom) - 1]])
-        chr_start_idx = np.sort(chr_start_idx)
-        chrom_ranges = [(chr_start_idx[x], chr_start_idx[x + 1]) for x in range(len(chr_start_idx) - 1)]
-
-        delta_to_mean = {}
-        for min_idx in min_idx_list:
-            # check that the min_idx is not to close to any of the chromosome boundaries
-            close_to_chrom_border = True
-            for start_range, end_range in chrom_ranges:
-                if start_range < min_idx < end_range:
-                    if min_idx - window_len >= start_range and min_idx + window_len < end_range:
-                        close_to_chrom_border = False
-                        continue
-            if close_to_chrom_border is True:
-                delta_to_mean[min_idx] = np.nan
+        chrom_ranges_idx = np.sort(np.concatenate([chr_start_idx, [len(chrom) - 1]]))
 
-            else:
-                local_tad_score = np.concatenate([matrix_avg[min_idx - window_len:min_idx + 3],
-                                                  matrix_avg[min_idx + 4: min_idx + window_len]])
-                delta_to_mean[min_idx] = local_tad_score.mean() - matrix_avg[min_idx]
+        min_idx = np.asarray(min_idx_list, dtype=int)
+        if len(min_idx) == 0:
+            return {}
 
-        return delta_to_mean
+        # check that the min_idx is not to close to any of the chromosome boundaries
+        range_id = np.searchsorted(chrom_ranges_idx, min_idx, side='left') - 1
+        in_range = (range_id >= 0) & (range_id < len(chrom_ranges_idx) - 1)
+        range_start = chrom_ranges_idx[np.clip(range_id, 0, len(chrom_ranges_idx) - 1)]
+        range_end = chrom_ranges_idx[np.clip(range_id + 1, 0, len(chrom_ranges_idx) - 1)]
+        not_close_to_border = in_range & (min_idx < range_end) & \
+            (min_idx - window_len >= range_start) & (min_idx + window_len < range_end)
+
+        # the TAD-separation scores from min_idx - window_len to min_idx + window_len, except
+        # for the position min_idx + 3, of each minima
+        offsets = np.concatenate([np.arange(-window_len, 3), np.arange(4, window_len)])
+        local_tad_score = matrix_avg[min_idx[not_close_to_border][:, np.newaxis] + offsets]
+
+        delta_to_mean = np.full(len(min_idx), np.nan)
+        delta_to_mean[not_close_to_border] = local_tad_score.mean(axis=1) - matrix_avg[min_idx[not_close_to_border]]
+
+        return dict(zip(min_idx_list, delta_to_mean))
 
     @staticmethod
     def find_consensus_minima(tad_score_matrix, lookahead=3, chrom=None):
@@ -876,6 +1246,26 @@ class HicFindTads(object):
 
         return domain_list
 
+    def get_tad_score_parameters(self):
+        """
+        Returns the parameters used to compute the TAD-separation score as
+        a json string. The string is saved as the header of the TAD-separation
+        score files.
+        """
+        params = OrderedDict()
+        params['step'] = self.step
+        params['minDepth'] = self.min_depth
+        params['maxDepth'] = self.max_depth
+        params['binsize'] = self.binsize
+        return json.dumps(params, separators=(',', ':'))
+
+    def set_tad_score_parameters(self, params_str):
+        parameters = json.loads(params_str)
+        self.min_depth = parameters['minDepth']
+        self.max_depth = parameters['maxDepth']
+        self.step = parameters['step']
+        self.binsize = parameters['binsize']
+
     def save_bedgraph_matrix(self, outfile):
         """
         Save matrix as chrom, start, end ,row, values separated by tab
@@ -886,12 +1276,7 @@ class HicFindTads(object):
         None
         """
         # get params to save as part of the bedgraph file
-        params = OrderedDict()
-        params['step'] = self.step
-        params['minDepth'] = self.min_depth
-        params['maxDepth'] = self.max_depth
-        params['binsize'] = self.binsize
-        params_str = json.dumps(params, separators=(',', ':'))
+        params_str = self.get_tad_score_parameters()
 
         with open(outfile, 'w') as f:
             f.write("#" + params_str + "\n")
@@ -903,6 +1288,40 @@ class HicFindTads(object):
                                                   toString(self.bedgraph_matrix['chr_end'][idx]),
                                                   toString(matrix_values)))
 
+    def save_tad_score_matrix(self, outfile):
+        """
+        Save the TAD-separation score matrix in HDF5 format. The file
+        contains the arrays chr_start, chr_end and matrix, the json string
+        of the parameters (as for the .bm file) in the 'parameters'
+        attribute and, in the chromosomes group, the name and row range
+        ('offsets') of each chromosome, such that single chromosomes
+        can be read without loading the whole file.
+
+        Returns
+        -------
+        None
+        """
+        chrom = toString(np.asarray(self.bedgraph_matrix['chrom']))
+        # rows at which a new chromosome starts
+        chrom_start_rows = np.flatnonzero(np.concatenate([[True], chrom[1:] != chrom[:-1]]))
+        offsets = np.append(chrom_start_rows, len(chrom)).astype(np.int64)
+        names = np.array(toBytes(chrom[chrom_start_rows].tolist()))
+
+        filters = tables.Filters(complevel=5, complib='blosc')
+        with tables.open_file(outfile, mode="w", title="HiCExplorer TAD-separation score") as h5file:
+            h5file.root._v_attrs.parameters = self.get_tad_score_parameters()
+            chrom_group = h5file.create_group("/", "chromosomes")
+            h5file.create_array(chrom_group, 'names', names)
+            h5file.create_array(chrom_group, 'offsets', offsets)
+
+            for part in ('chr_start', 'chr_end', 'matrix'):
+                arr = np.asarray(self.bedgraph_matrix[part])
+                atom = tables.Atom.from_dtype(arr.dtype)
+                ds = h5file.create_carray(h5file.root, part, atom,
+                                          shape=arr.shape,
+                                          filters=filters)
+                ds[:] = arr
+
     def save_clusters(clusters, file_prefix):
         """
 
@@ -917,15 +1336,20 @@ class HicFindTads(object):
             for chrom, start, end in intervals:
                 fileh.write("{}\t{}\t{}\t.\t0\t.\n".format(chrom, start, end))
 
-    def save_domains_and_boundaries(self, prefix):
+    def filter_boundaries(self):
+        """
+        Selects the boundaries whose delta and p-value pass the thresholds.
+
+        Returns
+        -------
+        the sorted list of boundaries (indices of the bedgraph matrix) and
+        the indices of the last bin of each chromosome
+        """
 
         # a boundary is added to the start and end of each chromosome
         # np.unique return index is used to quickly get
         # the indices at which the name of the chromosome changes (chrom, start, end should be  sorted)
         chrom = self.bedgraph_matrix['chrom']
-        chr_start = self.bedgraph_matrix['chr_start']
-        chr_end = self.bedgraph_matrix['chr_end']
-        matrix = self.bedgraph_matrix['matrix']
 
         min_idx = self.boundaries['min_idx']
         delta_of_min = self.boundaries['delta']
@@ -951,8 +1375,6 @@ class HicFindTads(object):
         # put all indices together and sort
         min_idx = np.sort(np.concatenate([chr_start_idx, chr_end_idx, min_idx]))
 
-        mean_mat_all = matrix.mean(axis=1)
-
         filtered_min_idx = []
 
         for idx in min_idx:
@@ -978,6 +1400,29 @@ class HicFindTads(object):
         else:
             log.info("No multiple testing correction. Number of boundaries for delta {}: {}, used threshold: {}".format(self.delta, len(filtered_min_idx), self.threshold_comparisons))
 
+        return filtered_min_idx, chr_end_idx
+
+    def save_domains_and_boundaries(self, prefix):
+        """
+        Saves the boundaries (bed and gff), domains and TAD-separation score
+        (bedgraph) files using the given prefix.
+
+        Returns
+        -------
+        the number of boundaries that pass the delta and p-value thresholds
+        """
+        chrom = self.bedgraph_matrix['chrom']
+        chr_start = self.bedgraph_matrix['chr_start']
+        chr_end = self.bedgraph_matrix['chr_end']
+        matrix = self.bedgraph_matrix['matrix']
+
+        delta_of_min = self.boundaries['delta']
+        pvalue_of_min = self.boundaries['pvalues']
+
+        filtered_min_idx, chr_end_idx = self.filter_boundaries()
+
+        mean_mat_all = matrix.mean(axis=1)
+
         count = 1
         with open(prefix + '_boundaries.bed', 'w') as file_boundary_bin, open(prefix + '_domains.bed', 'w') as file_domains, open(prefix + '_boundaries.gff', 'w') as gff:
             for idx, min_bin_id in enumerate(filtered_min_idx):
@@ -1046,6 +1491,8 @@ class HicFindTads(object):
                 tad_score.write("{}\t{}\t{}\t{:.12f}\n".format(toString(chrom[idx]), left_bin_center, right_bin_center,
                                                                mean_mat_all[idx]))
 
+        return len(filtered_min_idx)
+
     def compute_spectra_matrix(self, perchr=True):
         """
         Uses multiple processors to compute the TAD-score
@@ -1056,6 +1503,7 @@ class HicFindTads(object):
 
         """
 
+        self.pvalues_cache = {}
         # remove self counts
         log.info('removing diagonal values\n')
         self.hic_ma.diagflat(value=0)
@@ -1125,143 +1573,233 @@ class HicFindTads(object):
                                                                                               k=limit, format='csr')
         self.hic_ma.matrix.eliminate_zeros()
 
-        func = compute_matrix_wrapper
-        TASKS = []
-        bins_to_consider = []
-        # to speed up parallel computation the self.hic_ma (HiCMatrix object) is converted into a global object.
-        global hic_ma
-        hic_ma = self.hic_ma
-        for chrom in list(self.hic_ma.chrBinBoundaries):
-            bins_to_consider.extend(list(range(*self.hic_ma.chrBinBoundaries[chrom])))
+        chrom, chr_start, chr_end, _ = zip(*self.hic_ma.cut_intervals)
+        chr_start = np.array(chr_start).astype(int)
+        chr_end = np.array(chr_end).astype(int)
 
-        for idx_array in np.array_split(bins_to_consider, self.num_processors):
-            TASKS.append((idx_array, self.min_depth, self.max_depth, self.step))
+        # the work is split in many small tasks, each containing bins of a single chromosome,
+        # such that the processes are kept busy until the end.
+        num_bins = self.hic_ma.matrix.shape[0]
+        chunk_size = int(min(self.task_size, max(1, np.ceil(num_bins / (self.num_processors * 10)))))
+        TASKS = []
+        for chr_first_bin, chr_last_bin in self.hic_ma.chrBinBoundaries.values():
+            for first_bin in range(chr_first_bin, chr_last_bin, chunk_size):
+                TASKS.append(((chr_first_bin, chr_last_bin),
+                              (first_bin, min(first_bin + chunk_size, chr_last_bin)),
+                              self.min_depth, self.max_depth, self.step))
 
+        func = compute_matrix_wrapper
         if self.num_processors > 1:
-            pool = multiprocessing.Pool(self.num_processors)
+            # the matrix is put into shared memory to avoid that each process gets a copy
+            hic_matrix = self.hic_ma.matrix
+            shared_arrays = share_arrays([hic_matrix.data, hic_matrix.indices, hic_matrix.indptr, chr_start, chr_end])
+            pool = multiprocessing.Pool(self.num_processors, initializer=set_shared_arrays,
+                                        initargs=(shared_arrays, hic_matrix.shape))
             log.info("Using {} processors\n".format(self.num_processors))
-            res = pool.map_async(func, TASKS).get(9999999)
-            pool.close()
+            res = pool.imap_unordered(func, TASKS)
         else:
+            global shared_matrix, shared_bin_starts, shared_bin_ends
+            shared_matrix, shared_bin_starts, shared_bin_ends = self.hic_ma.matrix, chr_start, chr_end
             res = map(func, TASKS)
 
-        chrom = []
-        chr_start = []
-        chr_end = []
-        matrix = []
-        for _chrom, _chr_start, _chr_end, _matrix in res:
-            chrom.extend(toString(_chrom))
-            chr_start.extend(_chr_start)
-            chr_end.extend(_chr_end)
-            matrix.append(_matrix)
+        # the results are collected as they are produced
+        matrix = np.zeros((num_bins, len(incremental_step)))
+        valid_bins = np.zeros(num_bins, dtype=bool)
+        for _bin_ids, _matrix in res:
+            matrix[_bin_ids, :] = _matrix
+            valid_bins[_bin_ids] = True
 
-        matrix = np.vstack(matrix)
+        if self.num_processors > 1:
+            pool.close()
+            pool.join()
+        else:
+            shared_matrix, shared_bin_starts, shared_bin_ends = None, None, None
+
+        chrom = toString(np.array(chrom)[valid_bins])
+        chr_start = chr_start[valid_bins]
+        chr_end = chr_end[valid_bins]
+        matrix = matrix[valid_bins, :]
 
         self.bedgraph_matrix = {'chrom': np.array(chrom),
-                                'chr_start': np.array(chr_start).astype(int),
-                                'chr_end': np.array(chr_end).astype(int),
+                                'chr_start': chr_start,
+                                'chr_end': chr_end,
                                 'matrix': matrix}
 
     def load_bedgraph_matrix(self, filename, pChromosomes=None):
-        # load spectrum matrix:
-        matrix = []
-        chrom_list = []
-        start_list = []
-        end_list = []
+        """
+        Loads a TAD-separation score matrix saved in the text bedgraph
+        matrix format (.bm). If pChromosomes is given, only the rows of
+        these chromosomes are kept, in the given order.
+        """
         with open(filename, 'r') as fh:
-            for line in fh:
-                # if type(line)
-                if line.startswith("#"):
-                    # recover the parameters used to generate the spectrum_matrix
-                    parameters = json.loads(line[1:].strip())
-                    continue
-                fields = line.strip().split('\t')
-                chrom, start, end = fields[0:3]
-                if pChromosomes is not None:
-                    if chrom in pChromsomes:
-                        chrom_list.append(chrom)
-                        start_list.append(int(float(start)))
-                        end_list.append(int(float(end)))
-                        matrix.append(map(float, fields[3:]))
-                else:
-                    chrom_list.append(chrom)
-                    start_list.append(int(float(start)))
-                    end_list.append(int(float(end)))
-                    matrix.append(map(float, fields[3:]))
-        self.min_depth = parameters['minDepth']
-        self.max_depth = parameters['maxDepth']
-        self.step = parameters['step']
-        self.binsize = parameters['binsize']
+            # recover the parameters used to generate the spectrum_matrix
+            self.set_tad_score_parameters(fh.readline()[1:].strip())
 
-        matrix = np.vstack(matrix)
-        self.bedgraph_matrix = {'chrom': np.array(chrom_list),
-                                'chr_start': np.array(start_list).astype(int),
-                                'chr_end': np.array(end_list).astype(int),
-                                'matrix': matrix}
+        bedgraph_matrix = pd.read_csv(filename, sep='\t', header=None, comment='#', dtype={0: str},
+                                      float_precision='round_trip')
+        chrom = bedgraph_matrix[0].values.astype(str)
+        rows = np.arange(len(chrom))
+        if pChromosomes is not None:
+            rows = np.concatenate([np.flatnonzero(chrom == chrom_name) for chrom_name in toString(pChromosomes)])
 
-    def min_pvalue(self, min_idx):
+        self.bedgraph_matrix = {'chrom': chrom[rows],
+                                'chr_start': bedgraph_matrix[1].values[rows].astype(int),
+                                'chr_end': bedgraph_matrix[2].values[rows].astype(int),
+                                'matrix': bedgraph_matrix.values[rows, 3:].astype(float)}
+
+    def load_tad_score_matrix(self, filename, pChromosomes=None):
+        """
+        Loads a TAD-separation score matrix saved with save_tad_score_matrix.
+        If pChromosomes is given, only the rows of these chromosomes are read
+        from the file, in the given order. Files in the text bedgraph
+        matrix format (.bm) are loaded with load_bedgraph_matrix.
+        """
+        if filename.endswith('.bm'):
+            self.load_bedgraph_matrix(filename, pChromosomes)
+            return
+
+        with tables.open_file(filename) as h5file:
+            self.set_tad_score_parameters(h5file.root._v_attrs.parameters)
+            names = toString(h5file.root.chromosomes.names.read())
+            offsets = h5file.root.chromosomes.offsets.read()
+
+            if pChromosomes is None:
+                chrom_ranges = list(zip(names, offsets[:-1], offsets[1:]))
+            else:
+                chrom_ranges = []
+                for chrom_name in toString(pChromosomes):
+                    chrom_ranges.extend([(names[idx], offsets[idx], offsets[idx + 1])
+                                         for idx in np.flatnonzero(names == chrom_name)])
+
+            chrom = [np.repeat(chrom_name, end - start) for chrom_name, start, end in chrom_ranges]
+            self.bedgraph_matrix = {'chrom': np.concatenate(chrom) if len(chrom) else np.array([], dtype=str)}
+            for part in ('chr_start', 'chr_end', 'matrix'):
+                array = getattr(h5file.root, part)
+                if pChromosomes is None:
+                    self.bedgraph_matrix[part] = array.read()
+                elif len(chrom_ranges):
+                    self.bedgraph_matrix[part] = np.concatenate([array[start:end] for _, start, end in chrom_ranges])
+                else:
+                    self.bedgraph_matrix[part] = array[0:0]
+
+    def compute_boundary_pvalues(self, min_idx, window_len):
         """
         For each putative local minima, find the -window_len diammond and the +window_len diamond
-        and compare with the local minima using wilcoxon rank sum.
+        and compare with the local minima using wilcoxon rank sum. The diamonds
+        of all minima are extracted at once and the tests are computed in
+        batches of diamonds having the same size.
+
+        The p-values are cached per window length, thus, changing the threshold
+        or the multiple testing correction does not require a new computation.
 
         Parameters
         ----------
-        min_idx list of local minima
+        min_idx list of local minima (indices of the bedgraph matrix)
+        window_len window length in bp
 
         Returns
         -------
-        list of p-values per each local minima
-
+        OrderedDict of the uncorrected p-value per local minima. Minima not found in the
+        Hi-C matrix are skipped.
         """
-
-        log.info("Computing p-values for window length: {}\n".format(self.min_depth))
-        pvalues = []
-        chrom = self.bedgraph_matrix['chrom']
-        chr_start = self.bedgraph_matrix['chr_start']
-        chr_end = self.bedgraph_matrix['chr_end']
-        window_len = self.min_depth
-
-        from scipy.stats import ranksums
-
-        new_min_idx = []
-        for idx in min_idx:
-
-            matrix_idx = self.hic_ma.getRegionBinRange(chrom[idx], chr_start[idx], chr_end[idx])
-            if matrix_idx is None:
+        cache_key = (window_len, tuple(min_idx))
+        if cache_key in self.pvalues_cache:
+            return OrderedDict(self.pvalues_cache[cache_key])
+
+        log.info("Computing p-values for window length: {}\n".format(window_len))
+        min_idx = np.asarray(min_idx, dtype=int)
+        chrom = toString(self.bedgraph_matrix['chrom'][min_idx])
+        chr_start = self.bedgraph_matrix['chr_start'][min_idx]
+        chr_end = self.bedgraph_matrix['chr_end'][min_idx]
+
+        bin_chrom, bin_starts, bin_ends, _ = zip(*self.hic_ma.cut_intervals)
+        bin_chrom = toString(np.array(bin_chrom))
+        bin_starts = np.array(bin_starts).astype(int)
+        bin_ends = np.array(bin_ends).astype(int)
+
+        # for the boundary, left and right diamonds of each minima: the
+        # start, cut and end bin indices. -1 is used for missing diamonds.
+        num_min = len(min_idx)
+        found = np.zeros(num_min, dtype=bool)
+        diamonds = {name: np.full((num_min, 3), -1, dtype=int) for name in ['boundary', 'left', 'right']}
+
+        for chrname in np.unique(chrom):
+            chrname_bins = check_chrom_str_bytes(self.hic_ma.chrBinBoundaries, chrname)
+            if chrname_bins not in self.hic_ma.chrBinBoundaries:
                 continue
-            else:
-                matrix_idx = matrix_idx[0]
-
-            new_min_idx += [idx]
-            min_chr, min_start, min_end, _ = self.hic_ma.getBinPos(matrix_idx)
-            assert toString(chrom[idx]) == toString(min_chr) and chr_start[idx] == min_start and chr_end[idx] == min_end
-            left_idx, right_idx = get_idx_of_bins_at_given_distance(self.hic_ma, matrix_idx, window_len)
-
-            left = get_cut_weight(self.hic_ma, left_idx, window_len)
-            right = get_cut_weight(self.hic_ma, right_idx, window_len)
-            boundary = get_cut_weight(self.hic_ma, matrix_idx, window_len)
-
-            if left is None:
-                left = []
-            if right is None:
-                right = []
+            chr_first_bin, chr_last_bin = self.hic_ma.chrBinBoundaries[chrname_bins]
+            starts = bin_starts[chr_first_bin:chr_last_bin]
+            ends = bin_ends[chr_first_bin:chr_last_bin]
+
+            in_chrom = np.flatnonzero(chrom == chrname)
+            # bin of the matrix containing the start of the minima
+            matrix_idx = np.searchsorted(starts, chr_start[in_chrom], side='right') - 1
+            is_found = (matrix_idx >= 0) & (chr_start[in_chrom] < ends[np.maximum(matrix_idx, 0)])
+            in_chrom = in_chrom[is_found]
+            matrix_idx = matrix_idx[is_found]
+            found[in_chrom] = True
+            assert np.all(starts[matrix_idx] == chr_start[in_chrom]) and np.all(ends[matrix_idx] == chr_end[in_chrom])
+
+            left_idx, right_idx, valid = get_bin_range_at_given_distance(starts, ends, matrix_idx, window_len)
+            assert valid.all(), "Bins at {} bp of the minima could not be found".format(window_len)
+
+            for name, cut in [('boundary', matrix_idx), ('left', left_idx), ('right', right_idx)]:
+                _left, _right, valid = get_bin_range_at_given_distance(starts, ends, cut, window_len)
+                diamonds[name][in_chrom[valid], :] = np.vstack([_left, cut, _right]).T[valid] + chr_first_bin
+
+        # the diamond values are extracted for groups of diamonds
+        # with the same shape
+        def shape_id(name):
+            height = diamonds[name][:, 1] - diamonds[name][:, 0]
+            width = diamonds[name][:, 2] - diamonds[name][:, 1]
+            size = height * width
+            size[diamonds[name][:, 0] == -1] = 0
+            return height, width, size
+
+        pvalues = np.full(num_min, np.nan)
+        shapes = {name: shape_id(name) for name in diamonds}
+        boundary_size = shapes['boundary'][2]
+        has_values = (boundary_size > 0) & (shapes['left'][2] > 0) & (shapes['right'][2] > 0)
+        groups = np.vstack([shapes[name][dim] for name in ['boundary', 'left', 'right'] for dim in [0, 1]]).T
+        unique_groups, group_ids = np.unique(groups[has_values], axis=0, return_inverse=True)
+        group_ids = group_ids.ravel()
+        candidates = np.flatnonzero(has_values)
+        for group_id in range(len(unique_groups)):
+            in_group = candidates[group_ids == group_id]
+            values = {}
+            for name in diamonds:
+                start, cut, end = diamonds[name][in_group].T
+                values[name] = get_diamond_values(self.hic_ma.matrix, start, cut, end)
+            pvalues[in_group] = np.minimum(ranksums_by_row(values['boundary'], values['left']),
+                                           ranksums_by_row(values['boundary'], values['right']))
+
+        pvalues = OrderedDict(zip(min_idx[found].tolist(), pvalues[found]))
+        self.pvalues_cache[cache_key] = pvalues
+
+        return OrderedDict(pvalues)
+
+    def min_pvalue(self, min_idx, window_len=None):
+        """
+        For each putative local minima, find the -window_len diammond and the +window_len diamond
+        and compare with the local minima using wilcoxon rank sum (see compute_boundary_pvalues).
+        The p-values are corrected using the selected multiple testing method.
 
-            if len(left) == 0 and len(right) == 0:
-                pval = np.nan
+        Parameters
+        ----------
+        min_idx list of local minima
+        window_len window length in bp, by default the min_depth is used
 
-            elif boundary is None or len(boundary) == 0 or len(left) == 0 or len(right) == 0:
-                pval = np.nan
+        Returns
+        -------
+        list of p-values per each local minima
 
-            else:
+        """
 
-                try:
-                    pval1 = ranksums(boundary, left)[1]
-                    pval2 = ranksums(boundary, right)[1]
-                    pval = min(pval1, pval2)
-                except ValueError:
-                    # this condition happens when boundary, left and right are only composed of 'zeros'
-                    pval = np.nan
-            pvalues += [pval]
+        if window_len is None:
+            window_len = self.min_depth
+        raw_pvalues = self.compute_boundary_pvalues(min_idx, window_len)
+        new_min_idx = list(raw_pvalues)
+        pvalues = np.array(list(raw_pvalues.values()))
 
         assert len(pvalues) == len(new_min_idx)
 
@@ -1269,13 +1807,9 @@ class HicFindTads(object):
         if self.correct_for_multiple_testing == 'fdr':
 
             pvalues = np.array([e if ~np.isnan(e) else 1 for e in pvalues])
-            pvalues_ = sorted(pvalues)
-            largest_p_i = 0
-            for i, p in enumerate(pvalues_):
-                if p <= (self.threshold_comparisons * (i + 1) / len(pvalues_)):
-                    if p >= largest_p_i:
-                        largest_p_i = p
-            self.pvalueFDR = largest_p_i
+            pvalues_ = np.sort(pvalues)
+            is_below = pvalues_ <= self.threshold_comparisons * np.arange(1, len(pvalues_) + 1) / len(pvalues_)
+            self.pvalueFDR = pvalues_[is_below].max() if is_below.any() else 0
         elif self.correct_for_multiple_testing == 'bonferroni':
             # bonferroni correction
             pvalues = np.array(pvalues) * len(pvalues)
@@ -1285,7 +1819,12 @@ class HicFindTads(object):
 
         return OrderedDict(zip(new_min_idx, pvalues))
 
-    def find_boundaries(self):
+    def find_boundaries(self, window_len=None):
+        """
+        Finds the local minima of the mean TAD-separation score and computes their
+        delta and p-value. The p-values are computed using diamonds of `window_len` bp,
+        by default the min_depth. NoBoundariesError is raised if no minimum is found.
+        """
 
         # perform some checks
         avg_bin_size = np.median(self.bedgraph_matrix['chr_end'] - self.bedgraph_matrix['chr_start'])
@@ -1301,7 +1840,7 @@ class HicFindTads(object):
         min_idx, delta = HicFindTads.find_consensus_minima(self.bedgraph_matrix['matrix'], lookahead=lookahead,
                                                            chrom=self.bedgraph_matrix['chrom'])
 
-        pvalues = self.min_pvalue(min_idx)
+        pvalues = self.min_pvalue(min_idx, window_len)
 
         if len(min_idx) <= 10:
             mat_mean = self.bedgraph_matrix['matrix'].mean(axis=1)
@@ -1321,8 +1860,7 @@ class HicFindTads(object):
                                                     m_mean, m_median, m_25, m_75))
 
             if len(min_idx) == 0:
-                log.error("\n*ERROR*\nNo boundaries were found. {}".format(msg))
-                exit(1)
+                raise NoBoundariesError("No boundaries were found. {}".format(msg))
             else:
                 log.info("Only {} boundaries found. {}".format(len(min_idx), msg))
 
@@ -1330,6 +1868,209 @@ class HicFindTads(object):
                            'delta': delta,
                            'pvalues': pvalues}
 
+    def find_multiscale_boundaries(self, number_of_scales):
+        """
+        Calls boundaries at several scales using the TAD-separation score that
+        was already computed. The window lengths of the score are split into
+        `number_of_scales` consecutive bands and the boundaries of each band are found
+        using the mean of the TAD-separation scores of its window lengths. The p-values
+        use diamonds of the smallest window length of the band and the minimum boundary
+        distance grows proportionally to it.
+
+        The scales are linked from the finest to the coarsest: each boundary of a scale
+        is moved to the closest boundary of the next finer scale if it is closer than
+        the minimum boundary distance of the finer scale, otherwise, the boundary is
+        added to all finer scales. Thus, each domain of a scale is nested in a domain of
+        the next coarser scale. Scales without boundaries are skipped.
+
+        Returns
+        -------
+        list of dicts, from the finest to the coarsest scale, with the 'window_len' of
+        the scale, the sorted 'boundaries' (indices of the bedgraph matrix) and the
+        TAD-separation 'score'
+        """
+        window_lengths = np.array(get_incremental_step_size(self.min_depth, self.max_depth, self.step))
+        matrix = self.bedgraph_matrix['matrix']
+        if len(window_lengths) != matrix.shape[1]:
+            log.error("The number of TAD-separation scores per bin ({}) does not match the window lengths "
+                      "for minDepth {}, maxDepth {} and step {}".format(matrix.shape[1], self.min_depth,
+                                                                        self.max_depth, self.step))
+            exit(1)
+        if number_of_scales > len(window_lengths):
+            log.error("The TAD-separation score was computed for {} window lengths. At most {} scales "
+                      "can be used.".format(len(window_lengths), len(window_lengths)))
+            exit(1)
+
+        avg_bin_size = np.median(self.bedgraph_matrix['chr_end'] - self.bedgraph_matrix['chr_start'])
+        min_boundary_distance = self.min_boundary_distance
+        if min_boundary_distance is None:
+            min_boundary_distance = avg_bin_size * 4
+        boundaries = self.boundaries
+
+        scales = []
+        try:
+            for columns in np.array_split(np.arange(len(window_lengths)), number_of_scales):
+                log.info("Finding boundaries for window lengths {}\n".format(window_lengths[columns]))
+                self.bedgraph_matrix['matrix'] = matrix[:, columns]
+                self.min_boundary_distance = min_boundary_distance * window_lengths[columns[0]] / window_lengths[0]
+                try:
+                    self.find_boundaries(window_len=window_lengths[columns[0]])
+                except NoBoundariesError:
+                    log.warning("No boundaries were found for window lengths {}. This scale is "
+                                "skipped.\n".format(window_lengths[columns]))
+                    continue
+                filtered_min_idx, _ = self.filter_boundaries()
+                scales.append({'window_len': window_lengths[columns],
+                               'boundaries': np.array(filtered_min_idx, dtype=int),
+                               'score': self.bedgraph_matrix['matrix'].mean(axis=1),
+                               'lookahead': int(self.min_boundary_distance / avg_bin_size)})
+        finally:
+            self.bedgraph_matrix['matrix'] = matrix
+            self.min_boundary_distance = min_boundary_distance
+            self.boundaries = boundaries
+
+        for level in range(1, len(scales)):
+            linked, not_linked = link_boundaries(scales[level - 1]['boundaries'], scales[level]['boundaries'],
+                                                 self.bedgraph_matrix['chrom'], scales[level - 1]['lookahead'])
+            scales[level]['boundaries'] = np.unique(linked)
+            for finer_scale in scales[:level]:
+                finer_scale['boundaries'] = np.union1d(finer_scale['boundaries'], linked[not_linked])
+
+        return scales
+
+    def save_multiscale_domains(self, scales, prefix):
+        """
+        Saves the boundaries and domains of each scale (see find_multiscale_boundaries)
+        as <prefix>_scale_<n>_boundaries.bed and <prefix>_scale_<n>_domains.bed, being
+        scale 1 the finest. The domains of all scales are also saved, colored by scale,
+        in <prefix>_nested_domains.bed. In this file, each domain comes after the
+        domains of the coarser scales that contain it.
+        """
+        chrom = self.bedgraph_matrix['chrom']
+        chr_start = self.bedgraph_matrix['chr_start']
+        chr_end = self.bedgraph_matrix['chr_end']
+        bin_center = chr_start + ((chr_end - chr_start) / 2).astype(int)
+        # boundaries at the first or last bin of a chromosome are skipped
+        is_border = np.ones(len(chrom), dtype=bool)
+        is_border[1:-1] = (chrom[1:-1] != chrom[:-2]) | (chrom[1:-1] != chrom[2:])
+
+        scale_rgb = ['31,120,180', '51,160,44', '227,26,28', '255,127,0', '106,61,154', '177,89,40']
+        nested_domains = []
+        for level, scale in enumerate(scales, 1):
+            boundaries = scale['boundaries'][~is_border[scale['boundaries']]]
+            score = scale['score']
+            scale_prefix = "{}_scale_{}".format(prefix, level)
+            log.info("Scale {}: {} boundaries for window lengths {}\n".format(level, len(boundaries), scale['window_len']))
+            with open(scale_prefix + '_boundaries.bed', 'w') as file_boundary_bin:
+                for min_bin_id in boundaries:
+                    file_boundary_bin.write("{}\t{}\t{}\tB{:05d}\t{:.12f}\t.\n".format(toString(chrom[min_bin_id]),
+                                                                                       bin_center[min_bin_id - 1],
+                                                                                       bin_center[min_bin_id],
+                                                                                       min_bin_id,
+                                                                                       score[min_bin_id]))
+
+            # a domain is defined between consecutive boundaries of the same chromosome
+            domain_start = boundaries[:-1][chrom[boundaries[:-1]] == chrom[boundaries[1:]]]
+            domain_end = boundaries[1:][chrom[boundaries[:-1]] == chrom[boundaries[1:]]]
+            with open(scale_prefix + '_domains.bed', 'w') as file_domains:
+                for count, (start, end) in enumerate(zip(domain_start, domain_end), 1):
+                    rgb = '51,160,44' if count % 2 == 0 else '31,120,180'
+                    file_domains.write("{0}\t{1}\t{2}\tID_scale{6}_{3}\t{4:.12f}\t.\t{1}\t{2}\t{5}\n".format(
+                        toString(chrom[start]), chr_start[start], chr_start[end], count, score[start], rgb, level))
+                    nested_domains.append((start, -level, end, count, score[start]))
+
+        with open(prefix + '_nested_domains.bed', 'w') as file_domains:
+            for start, level, end, count, score in sorted(nested_domains):
+                file_domains.write("{0}\t{1}\t{2}\tID_scale{6}_{3}\t{4:.12f}\t.\t{1}\t{2}\t{5}\n".format(
+                    toString(chrom[start]), chr_start[start], chr_start[end], count, score,
+                    scale_rgb[(-level - 1) % len(scale_rgb)], -level))
+
+
+def set_sweep_tads(tads):
+    """
+    Initializer of the parameter sweep processes.
+    """
+    global sweep_tads
+    sweep_tads = tads
+
+
+def find_boundaries_for_parameters(min_boundary_distance, threshold_comparisons_list, delta_list, prefix):
+    """
+    Finds and saves the boundaries of the HicFindTads object in `sweep_tads` for
+    the given minimum boundary distance and each of the thresholds and delta values.
+    The thresholds are processed one after the other, such that the p-values
+    computed for the first threshold are reused for the others.
+
+    Returns
+    -------
+    list of (delta, min_boundary_distance, threshold_comparisons, number of boundaries) tuples
+    """
+    tads = sweep_tads
+    results = []
+    for threshold_comparisons in threshold_comparisons_list:
+        tads.min_boundary_distance = min_boundary_distance
+        tads.threshold_comparisons = threshold_comparisons
+        try:
+            tads.find_boundaries()
+        except NoBoundariesError:
+            results.extend([(delta, min_boundary_distance, threshold_comparisons, 0) for delta in delta_list])
+            continue
+
+        for delta in delta_list:
+            tads.delta = delta
+            file_prefix = "{}_delta_{}_minBoundaryDistance_{}_thresholdComparisons_{}".format(
+                prefix, delta, 'default' if min_boundary_distance is None else min_boundary_distance,
+                threshold_comparisons)
+            num_boundaries = tads.save_domains_and_boundaries(file_prefix)
+            results.append((delta, min_boundary_distance, threshold_comparisons, num_boundaries))
+
+    return results
+
+
+def find_boundaries_for_parameters_wrapper(args):
+    return find_boundaries_for_parameters(*args)
+
+
+def run_parameter_sweep(tads, delta_list, min_boundary_distance_list, threshold_comparisons_list, prefix):
+    """
+    Saves the boundaries and domains for all the combinations of the given
+    parameters. The TAD-separation score of `tads` is computed only once and the p-values
+    are reused for all thresholds with the same minimum boundary distance.
+    The minimum boundary distances are processed in parallel using `tads.num_processors`,
+    each process computing the thresholds of its distance one after the other.
+    """
+    TASKS = [(min_boundary_distance, threshold_comparisons_list, delta_list, prefix)
+             for min_boundary_distance in min_boundary_distance_list]
+
+    if tads.num_processors > 1 and len(TASKS) > 1:
+        pool = multiprocessing.Pool(min(tads.num_processors, len(TASKS)), initializer=set_sweep_tads,
+                                    initargs=(tads,))
+        res = pool.map_async(find_boundaries_for_parameters_wrapper, TASKS).get(9999999)
+        pool.close()
+        pool.join()
+    else:
+        set_sweep_tads(tads)
+        res = [find_boundaries_for_parameters(*task) for task in TASKS]
+        set_sweep_tads(None)
+
+    with open(prefix + '_parameter_sweep.txt', 'w') as fh:
+        fh.write("#delta\tminBoundaryDistance\tthresholdComparisons\tnumber of boundaries\n")
+        for results in res:
+            for delta, min_boundary_distance, threshold_comparisons, num_boundaries in results:
+                fh.write("{}\t{}\t{}\t{}\n".format(delta, 'default' if min_boundary_distance is None else min_boundary_distance,
+                                                   threshold_comparisons, num_boundaries))
+
+
+def get_tad_score_file(prefix):
+    """
+    Returns the TAD-separation score file saved with the given prefix. The HDF5
+    file is preferred over the text bedgraph matrix. If no file exists, None is returned.
+    """
+    for suffix in ['_tad_score.h5', '_tad_score.bm']:
+        if os.path.isfile(prefix + suffix):
+            return prefix + suffix
+    return None
+
 
 def print_args(args):
     """
@@ -1349,52 +2090,63 @@ def print_args(args):
 def main(args=None):
 
     args = parse_arguments().parse_args(args)
+    is_parameter_sweep = len(args.delta) > 1 or len(args.minBoundaryDistance) > 1 or len(args.thresholdComparisons) > 1
+    if is_parameter_sweep and args.numberOfScales > 1:
+        log.error("--numberOfScales can not be used with several values of --delta, --minBoundaryDistance "
+                  "or --thresholdComparisons.")
+        exit(1)
+
     ft = HicFindTads(args.matrix, num_processors=args.numberOfProcessors, max_depth=args.maxDepth,
-                     min_depth=args.minDepth, step=args.step, delta=args.delta,
-                     min_boundary_distance=args.minBoundaryDistance, use_zscore=True,
-                     p_correct_for_multiple_testing=args.correctForMultipleTesting, p_threshold_comparisons=args.thresholdComparisons,
+                     min_depth=args.minDepth, step=args.step, delta=args.delta[0],
+                     min_boundary_distance=args.minBoundaryDistance[0], use_zscore=True,
+                     p_correct_for_multiple_testing=args.correctForMultipleTesting, p_threshold_comparisons=args.thresholdComparisons[0],
                      pChromosomes=args.chromosomes)
 
-    tad_score_file = args.outPrefix + "_tad_score.bm"
+    tad_score_file = get_tad_score_file(args.outPrefix)
     zscore_matrix_file = args.outPrefix + "_zscore_matrix.h5"
 
     if args.TAD_sep_score_prefix is not None:
-        tad_score_file = args.TAD_sep_score_prefix + "_tad_score.bm"
+        tad_score_file = get_tad_score_file(args.TAD_sep_score_prefix)
         zscore_matrix_file = args.TAD_sep_score_prefix + "_zscore_matrix.h5"
         # check that the given file exists
-        if not os.path.isfile(tad_score_file):
+        if tad_score_file is None:
             log.error("The given TAD_sep_score_prefix does not contain a valid TAD-separation score. Please check.\n"
-                      "Could not find file {}".format(tad_score_file))
+                      "Could not find file {0}_tad_score.h5 or {0}_tad_score.bm".format(args.TAD_sep_score_prefix))
             exit(1)
         if not os.path.isfile(zscore_matrix_file):
             log.error("The given TAD_sep_score_prefix does not contain a valid z-score matrix. Please check.\n"
                       "Could not find file {}".format(zscore_matrix_file))
             exit(1)
         log.info("\nUsing existing TAD-separation score file: {}\n".format(tad_score_file))
-        ft.set_matrix(zscore_matrix_file, pChromosomes)
-        ft.load_bedgraph_matrix(tad_score_file, pChromosomes)
+        ft.set_matrix(zscore_matrix_file, args.chromosomes)
+        ft.load_tad_score_matrix(tad_score_file, args.chromosomes)
 
-    elif not os.path.isfile(tad_score_file):
+    elif tad_score_file is None:
         ft.compute_spectra_matrix()
         # save z-score matrix that is needed for find TADs algorithm
         ft.hic_ma.save(args.outPrefix + "_zscore_matrix.h5")
-        ft.save_bedgraph_matrix(tad_score_file)
+        tad_score_file = args.outPrefix + "_tad_score.h5"
+        ft.save_tad_score_matrix(tad_score_file)
     else:
         log.info("\nFound existing TAD-separation score file: {}\n".format(tad_score_file))
         log.info("This file will be used\n")
-        ft.set_matrix(zscore_matrix_file, pChromosomes)
-        # ft.hic_ma = hm.hiCMatrix(zscore_matrix_file)
-        ft.load_bedgraph_matrix(tad_score_file, pChromsomes)
-
-    ft.find_boundaries()
-    ft.save_domains_and_boundaries(args.outPrefix)
+        ft.set_matrix(zscore_matrix_file, args.chromosomes)
+        ft.load_tad_score_matrix(tad_score_file, args.chromosomes)
 
-    # turn of hierarchical clustering which is apparently not working.
+    if args.exportBedgraphMatrix and tad_score_file != args.outPrefix + "_tad_score.bm":
+        ft.save_bedgraph_matrix(args.outPrefix + "_tad_score.bm")
 
-    # if 2 == 1:
-    #     boundary_list = [(hic_ma.cut_intervals[min_][0], hic_ma.cut_intervals[min_][2], mean_mat[min_]) for min_ in min_idx]
-
-    #     Z, clusters = hierarchical_clustering(boundary_list, clusters_cutoff=[0.4, 0.3, 0.2])
+    if is_parameter_sweep:
+        run_parameter_sweep(ft, args.delta, args.minBoundaryDistance, args.thresholdComparisons, args.outPrefix)
+    else:
+        try:
+            ft.find_boundaries()
+        except NoBoundariesError as error:
+            log.error("\n*ERROR*\n{}".format(error))
+            exit(1)
+        ft.save_domains_and_boundaries(args.outPrefix)
 
-    #     save_linkage(Z, args.outPrefix + '_linkage.bed')
-    #     save_clusters(clusters, args.outPrefix)
+        if args.numberOfScales > 1:
+            # nested domains are called using the same TAD-separation score
+            scales = ft.find_multiscale_boundaries(args.numberOfScales)
+            ft.save_multiscale_domains(scales, args.outPrefix)
@@ -1,8 +1,10 @@
 from __future__ import division
 
 import argparse
+import multiprocessing
 
-from scipy.sparse import csr_matrix, lil_matrix
+from scipy.sparse import csr_matrix, coo_matrix
+from scipy.sparse.linalg import LinearOperator, eigsh
 from scipy import linalg
 from scipy.stats import pearsonr
 import numpy as np
@@ -12,6 +14,7 @@ from hicmatrix import HiCMatrix as hm
 from hicexplorer._version import __version__
 from hicexplorer.utilities import exp_obs_matrix_lieberman, exp_obs_matrix_norm
 from hicexplorer.utilities import convertNansToZeros, convertInfsToZeros
+from hicexplorer.utilities import pearson_correlation
 from hicexplorer.parserCommon import CustomFormatter
 from hicexplorer.utilities import toString
 from hicexplorer.utilities import opener
@@ -82,6 +85,19 @@ Computes PCA eigenvectors for a Hi-C matrix.
     parserOpt.add_argument('--obsexpMatrix', '-oem',
                            help='Writes the obs/exp which was used to compute the PCA to a file.'
                            )          
+    parserOpt.add_argument('--eigenvectorSolver',
+                           help='dense: the eigenvectors are computed from the full covariance matrix '
+                           'of the Pearson matrix. lanczos: only the requested eigenvectors with the '
+                           'largest eigenvalues are computed using the Lanczos method. Neither the Pearson '
+                           'nor the covariance matrix are computed, only their products with vectors '
+                           'using the sparse obs/exp matrix. This is much faster and needs much less memory '
+                           'for chromosomes with many bins.',
+                           choices=['dense', 'lanczos'],
+                           default='dense')
+    parserOpt.add_argument('--numberOfProcessors', '-p',
+                           help='Number of processors to use. The chromosomes are processed in parallel.',
+                           type=int,
+                           default=1)
     parserOpt.add_argument('--help', '-h', action='help', help='show this help message and exit')
 
     parserOpt.add_argument('--version', action='version',
@@ -134,6 +150,125 @@ def correlateEigenvectorWithGeneTrack(pMatrix, pEigenvector, pGeneTrack):
     return np.array(pEigenvector).transpose()
 
 
+def getPearsonCovarianceOperator(pObsExpMatrix):
+    """
+    Returns a linear operator that multiplies a vector with the covariance
+    matrix of the Pearson correlation matrix of the rows of the given sparse
+    matrix. Neither the Pearson nor the covariance matrix are computed, such
+    that each product only needs a few products with the sparse matrix.
+
+    The Pearson matrix is P = S * X_c * X_c.T * S, with X_c the matrix with
+    centered rows and S the inverse of the standard deviation of each row.
+    As with np.corrcoef and convertNansToZeros, rows without variance are zero.
+    The covariance matrix is P_c * P_c.T / (n - 1), with P_c the Pearson
+    matrix with centered rows.
+    """
+    matrix = csr_matrix(pObsExpMatrix)
+    num_bins = matrix.shape[0]
+    row_mean = np.asarray(matrix.sum(axis=1)).flatten() / num_bins
+    row_sum_of_squares = np.asarray(matrix.multiply(matrix).sum(axis=1)).flatten() - num_bins * row_mean ** 2
+    scale = np.zeros(num_bins)
+    has_variance = row_sum_of_squares > 0
+    scale[has_variance] = 1 / np.sqrt(row_sum_of_squares[has_variance])
+    matrix_transposed = matrix.T.tocsr()
+
+    def pearson_dot(vector):
+        vector = scale * vector
+        # X_c.T * v
+        vector = matrix_transposed.dot(vector) - row_mean.dot(vector)
+        # X_c * v
+        vector = matrix.dot(vector) - row_mean * vector.sum()
+        return scale * vector
+
+    pearson_row_mean = pearson_dot(np.ones(num_bins)) / num_bins
+
+    def covariance_dot(vector):
+        vector = np.ravel(vector)
+        # P_c.T * v, the Pearson matrix is symmetric
+        vector = pearson_dot(vector) - pearson_row_mean.dot(vector)
+        # P_c * v
+        vector = pearson_dot(vector) - pearson_row_mean * vector.sum()
+        return vector / (num_bins - 1)
+
+    return LinearOperator((num_bins, num_bins), matvec=covariance_dot, dtype=float)
+
+
+def computeEigenvectors(pSubmatrix, pLengthChromosome, pChromosomeCount, pNorm, pNumberOfEigenvectors,
+                        pSolver='dense', pReturnMatrices=False):
+    """
+    Computes the eigenvectors of the covariance matrix of the Pearson correlation
+    of the obs/exp matrix of a chromosome.
+
+    Returns
+    -------
+    array with the first pNumberOfEigenvectors eigenvectors as columns. If pReturnMatrices is set, also
+    the obs/exp and the Pearson matrix (as csr matrices) are returned.
+    """
+    if pNorm:
+        exp_obs_matrix_ = exp_obs_matrix_norm(pSubmatrix, pLengthChromosome, pChromosomeCount)
+    else:
+        exp_obs_matrix_ = exp_obs_matrix_lieberman(pSubmatrix, pLengthChromosome, pChromosomeCount)
+    exp_obs_matrix_ = convertInfsToZeros(convertNansToZeros(csr_matrix(exp_obs_matrix_)))
+
+    k = pNumberOfEigenvectors
+    num_bins = exp_obs_matrix_.shape[0]
+    use_lanczos = pSolver == 'lanczos' and k < num_bins - 1
+    pearson_correlation_matrix = None
+    if not use_lanczos or pReturnMatrices:
+        pearson_correlation_matrix = pearson_correlation(exp_obs_matrix_)
+
+    if use_lanczos:
+        evals, eigs = eigsh(getPearsonCovarianceOperator(exp_obs_matrix_), k=k, which='LA')
+        eigs = eigs[:, np.argsort(evals)[::-1]]
+    else:
+        corrmatrix = np.cov(pearson_correlation_matrix)
+        corrmatrix[~np.isfinite(corrmatrix)] = 0
+        if pSolver == 'lanczos':
+            # too few bins for the Lanczos method
+            evals, eigs = linalg.eigh(corrmatrix)
+            eigs = eigs[:, np.argsort(evals)[::-1]]
+        else:
+            evals, eigs = linalg.eig(corrmatrix)
+        eigs = eigs[:, :k]
+
+    if pReturnMatrices:
+        return eigs, exp_obs_matrix_, csr_matrix(pearson_correlation_matrix)
+    return eigs
+
+
+def computeEigenvectors_wrapper(pArgs):
+    return computeEigenvectors(*pArgs)
+
+
+def saveChromosomeMatrices(pHiCMatrix, pMatrices, pFileName):
+    """
+    Saves the given per chromosome matrices as the blocks of the diagonal of a matrix
+    with the bins of pHiCMatrix.
+    """
+    rows = []
+    cols = []
+    data = []
+    for chrname, matrix in zip(pHiCMatrix.getChrNames(), pMatrices):
+        chr_range = pHiCMatrix.getChrBinRange(chrname)
+        matrix = matrix.tocoo()
+        rows.append(matrix.row + chr_range[0])
+        cols.append(matrix.col + chr_range[0])
+        data.append(matrix.data)
+    matrix = coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                        shape=pHiCMatrix.matrix.shape).tocsr()
+
+    file_type = 'cool'
+    if pFileName.endswith('.h5'):
+        file_type = 'h5'
+    matrixFileHandlerOutput = MatrixFileHandler(pFileType=file_type)
+    matrixFileHandlerOutput.set_matrix_variables(matrix,
+                                                 pHiCMatrix.cut_intervals,
+                                                 pHiCMatrix.nan_bins,
+                                                 pHiCMatrix.correction_factors,
+                                                 pHiCMatrix.distance_counts)
+    matrixFileHandlerOutput.save(pFileName, pSymmetric=True, pApplyCorrection=False)
+
+
 def main(args=None):
     args = parse_arguments().parse_args(args)
     if int(args.numberOfEigenvectors) != len(args.outputFileName):
@@ -155,77 +290,44 @@ def main(args=None):
     # PCA is computed per chromosome
     length_chromosome = 0
     chromosome_count = len(ma.getChrNames())
-    if args.pearsonMatrix:
-        trasf_matrix_pearson = lil_matrix(ma.matrix.shape)
-        
-    if args.obsexpMatrix:
-        trasf_matrix_obsexp = lil_matrix(ma.matrix.shape)
+    return_matrices = bool(args.pearsonMatrix or args.obsexpMatrix)
 
     for chrname in ma.getChrNames():
         chr_range = ma.getChrBinRange(chrname)
         length_chromosome += chr_range[1] - chr_range[0]
+
+    TASKS = []
     for chrname in ma.getChrNames():
         chr_range = ma.getChrBinRange(chrname)
-
         submatrix = ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
-        if args.norm:
-            exp_obs_matrix_ = exp_obs_matrix_norm(submatrix, length_chromosome, chromosome_count)
-            exp_obs_matrix_ = convertNansToZeros(csr_matrix(exp_obs_matrix_)).todense()
-            exp_obs_matrix_ = convertInfsToZeros(csr_matrix(exp_obs_matrix_)).todense()
-            
-        else:
-            exp_obs_matrix_ = exp_obs_matrix_lieberman(submatrix, length_chromosome, chromosome_count)
-            exp_obs_matrix_ = convertNansToZeros(csr_matrix(exp_obs_matrix_)).todense()
-            exp_obs_matrix_ = convertInfsToZeros(csr_matrix(exp_obs_matrix_)).todense()
-
-        if args.obsexpMatrix:
-            trasf_matrix_obsexp[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = lil_matrix(exp_obs_matrix_)
-
-        pearson_correlation_matrix = np.corrcoef(exp_obs_matrix_)
-        pearson_correlation_matrix = convertNansToZeros(csr_matrix(pearson_correlation_matrix)).todense()
-        pearson_correlation_matrix = convertInfsToZeros(csr_matrix(pearson_correlation_matrix)).todense()
-        
-        if args.pearsonMatrix:
-            trasf_matrix_pearson[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = lil_matrix(pearson_correlation_matrix)
-
+        TASKS.append((submatrix, length_chromosome, chromosome_count, args.norm, args.numberOfEigenvectors,
+                      args.eigenvectorSolver, return_matrices))
+
+    if args.numberOfProcessors > 1 and len(TASKS) > 1:
+        pool = multiprocessing.Pool(min(args.numberOfProcessors, len(TASKS)))
+        results = pool.map_async(computeEigenvectors_wrapper, TASKS).get(9999999)
+        pool.close()
+        pool.join()
+    else:
+        results = [computeEigenvectors(*task) for task in TASKS]
 
-        corrmatrix = np.cov(pearson_correlation_matrix)
-        corrmatrix = convertNansToZeros(csr_matrix(corrmatrix)).todense()
-        corrmatrix = convertInfsToZeros(csr_matrix(corrmatrix)).todense()
-        evals, eigs = linalg.eig(corrmatrix)
-        k = args.numberOfEigenvectors
+    if return_matrices:
+        results, obs_exp_matrices, pearson_matrices = zip(*results)
 
+    for chrname, eigs in zip(ma.getChrNames(), results):
+        chr_range = ma.getChrBinRange(chrname)
         chrom, start, end, _ = zip(*ma.cut_intervals[chr_range[0]:chr_range[1]])
-        vecs_list += eigs[:, :k].tolist()
+        vecs_list += eigs.tolist()
 
         chrom_list += chrom
         start_list += start
         end_list += end
 
-        
     if args.pearsonMatrix:
-        file_type = 'cool'
-        if args.pearsonMatrix.endswith('.h5'):
-            file_type = 'h5'
-        matrixFileHandlerOutput = MatrixFileHandler(pFileType=file_type)
-        matrixFileHandlerOutput.set_matrix_variables(trasf_matrix_pearson.tocsr(),
-                                                        ma.cut_intervals,
-                                                        ma.nan_bins,
-                                                        ma.correction_factors,
-                                                        ma.distance_counts)
-        matrixFileHandlerOutput.save(args.pearsonMatrix, pSymmetric=True, pApplyCorrection=False)
+        saveChromosomeMatrices(ma, pearson_matrices, args.pearsonMatrix)
 
     if args.obsexpMatrix:
-        file_type = 'cool'
-        if args.obsexpMatrix.endswith('.h5'):
-            file_type = 'h5'
-        matrixFileHandlerOutput = MatrixFileHandler(pFileType=file_type)
-        matrixFileHandlerOutput.set_matrix_variables(trasf_matrix_obsexp.tocsr(),
-                                                        ma.cut_intervals,
-                                                        ma.nan_bins,
-                                                        ma.correction_factors,
-                                                        ma.distance_counts)
-        matrixFileHandlerOutput.save(args.obsexpMatrix, pSymmetric=True, pApplyCorrection=False)
+        saveChromosomeMatrices(ma, obs_exp_matrices, args.obsexpMatrix)
 
     if args.geneTrack:
         vecs_list = correlateEigenvectorWithGeneTrack(ma, vecs_list, args.geneTrack)
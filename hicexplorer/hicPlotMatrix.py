@@ -1,6 +1,9 @@
 from __future__ import division
 
 import sys
+import os
+import multiprocessing
+from copy import copy
 from hicmatrix import HiCMatrix
 from hicexplorer.utilities import writableFile
 from hicexplorer.utilities import toString, toBytes
@@ -9,10 +12,14 @@ from hicexplorer.utilities import change_chrom_names
 from hicexplorer.utilities import remove_non_ascii
 from hicexplorer.utilities import check_chrom_str_bytes
 from hicexplorer.utilities import check_cooler
+from hicexplorer.utilities import convertNansToOnes
 
 
 from hicexplorer._version import __version__
 import numpy as np
+from scipy.sparse import csr_matrix
+import tables
+import cooler
 import pyBigWig
 from past.builtins import zip
 
@@ -89,6 +96,19 @@ def parse_arguments(args=None):
                            'is the same as --region1.'
                            )
 
+    parserOpt.add_argument('--regionsFile',
+                           help='BED file with regions, or file with pairs of regions in the columns '
+                           'chrom, start, end, chrom2, start2, end2 (like BEDPE), to plot one after the other. '
+                           'The matrix is read once and each region is plotted into its own file, named as '
+                           '--outFileName with the region(s) added before the file extension, for example '
+                           'plot_chrX_3000000-3500000.png. This option is not compatible with '
+                           '--region, --region2, --chromosomeOrder and --perChromosome.')
+
+    parserOpt.add_argument('--numberOfProcessors', '-p',
+                           help='Number of processors to use to plot the regions of --regionsFile.',
+                           type=int,
+                           default=1)
+
     parserOpt.add_argument('--log1p',
                            help='Plot the log1p of the matrix values.',
                            action='store_true')
@@ -119,6 +139,16 @@ def parse_arguments(args=None):
                            type=int,
                            default=72)
 
+    parserOpt.add_argument('--displayResolution',
+                           help='Plot the whole matrix coarsened to about the pixel resolution of the '
+                           'image, given by --dpi, instead of plotting each bin. Each pixel is the mean of '
+                           'the bins it contains, and the memory and time of the plot depend on the '
+                           'resolution of the image rather than on the size of the matrix. This is done by '
+                           'default for matrices with more than 10000 bins. For a multi-resolution .mcool '
+                           'file without a given resolution, the coarsest resolution with enough bins '
+                           'is loaded.',
+                           action='store_true')
+
     parserOpt.add_argument('--bigwig',
                            help='Bigwig file to plot below the matrix. This can for '
                            'example be used to visualize A/B compartments or '
@@ -132,6 +162,7 @@ def parse_arguments(args=None):
 
     parserOpt.add_argument('--vMaxBigWig',
                            help='Maximum score value for bigwig',
+                           dest='vMaxBigwig',
                            type=float,
                            default=None)
     parserOpt.add_argument('--flipBigwigSign',
@@ -191,9 +222,16 @@ def plotHeatmap(ma, chrBinBoundaries, fig, position, args, cmap, xlabel=None,
     if start_pos2 is None:
         start_pos2 = start_pos
 
-    xmesh, ymesh = np.meshgrid(start_pos, start_pos2)
+    if args.displayResolution and not args.region:
+        # the bins of the downsampled matrix have the same size, like the pixels of an image
+        bin_size = start_pos[1] - start_pos[0]
+        img3 = axHeat2.imshow(ma.T, origin='lower', aspect='auto', interpolation='nearest',
+                              extent=(start_pos[0], start_pos[-1] + bin_size, start_pos2[0], start_pos2[-1] + bin_size),
+                              vmin=args.vMin, vmax=args.vMax, cmap=cmap, norm=pNorm)
+    else:
+        xmesh, ymesh = np.meshgrid(start_pos, start_pos2)
 
-    img3 = axHeat2.pcolormesh(xmesh.T, ymesh.T, ma, vmin=args.vMin, vmax=args.vMax, cmap=cmap, norm=pNorm)
+        img3 = axHeat2.pcolormesh(xmesh.T, ymesh.T, ma, vmin=args.vMin, vmax=args.vMax, cmap=cmap, norm=pNorm)
     axHeat2.invert_yaxis()
     img3.set_rasterized(True)
 
@@ -381,6 +419,32 @@ def plotPerChr(hic_matrix, cmap, args, pBigwig):
     return fig
 
 
+def get_region_bin_ids(pStarts, pEnds, pRegionStart, pRegionEnd, pIsCooler):
+    """
+    Returns the ids of the bins of a chromosome, given by their sorted start
+    and end positions, that are plotted for a region. These are the bins
+    inside of the region and, for cooler files, also the bins overlapping the
+    region borders. Only the bins between the first bin ending after the region
+    start and the last bin starting before the region end are checked.
+
+    >>> starts = np.array([0, 10, 20, 30])
+    >>> ends = np.array([10, 20, 30, 40])
+    >>> get_region_bin_ids(starts, ends, 10, 35, False)
+    array([1, 2])
+    >>> get_region_bin_ids(starts, ends, 5, 35, True)
+    array([0, 1, 2, 3])
+    """
+    first = np.searchsorted(pEnds, pRegionStart, side='left')
+    last = np.searchsorted(pStarts, pRegionEnd, side='left')
+    starts = pStarts[first:last]
+    ends = pEnds[first:last]
+    keep = (starts >= pRegionStart) & (ends < pRegionEnd)
+    if pIsCooler:
+        keep |= (starts < pRegionEnd) & (ends < pRegionEnd) & (ends > pRegionStart)
+        keep |= (starts > pRegionStart) & (starts < pRegionEnd)
+    return first + np.flatnonzero(keep)
+
+
 def getRegion(args, ma):
     chrom = region_start = region_end = idx1 = start_pos1 = chrom2 = region_start2 = region_end2 = idx2 = start_pos2 = None
     chrom, region_start, region_end = translate_region(args.region)
@@ -403,14 +467,7 @@ def getRegion(args, ma):
 
     args.region = [chrom, region_start, region_end]
     is_cooler = check_cooler(args.matrix)
-    if is_cooler:
-        idx1, start_pos1 = zip(*[(idx, x[1]) for idx, x in enumerate(ma.cut_intervals) if x[0] == chrom and
-                                 ((x[1] >= region_start and x[2] < region_end) or
-                                  (x[1] < region_end and x[2] < region_end and x[2] > region_start) or
-                                  (x[1] > region_start and x[1] < region_end))])
-    else:
-        idx1, start_pos1 = zip(*[(idx, x[1]) for idx, x in enumerate(ma.cut_intervals) if x[0] == chrom and
-                                 x[1] >= region_start and x[2] < region_end])
+    idx1, start_pos1 = get_chromosome_region(ma, chrom, region_start, region_end, is_cooler)
     if args.region2:
         chrom2, region_start2, region_end2 = translate_region(args.region2)
         chrom2 = check_chrom_str_bytes(ma.interval_trees, chrom2)
@@ -425,14 +482,7 @@ def getRegion(args, ma):
             #     chrom2 = toBytes(chrom)
             if chrom2 not in list(ma.interval_trees):
                 exit("Chromosome name {} in --region2 not in matrix".format(change_chrom_names(chrom2)))
-        if is_cooler:
-            idx2, start_pos2 = zip(*[(idx, x[1]) for idx, x in enumerate(ma.cut_intervals) if x[0] == chrom2 and
-                                     ((x[1] >= region_start2 and x[2] < region_end2) or
-                                      (x[1] < region_end2 and x[2] < region_end2 and x[2] > region_start2) or
-                                      (x[1] > region_start2 and x[1] < region_end2))])
-        else:
-            idx2, start_pos2 = zip(*[(idx, x[1]) for idx, x in enumerate(ma.cut_intervals) if x[0] == chrom2 and
-                                     x[1] >= region_start2 and x[2] < region_end2])
+        idx2, start_pos2 = get_chromosome_region(ma, chrom2, region_start2, region_end2, is_cooler)
     else:
         idx2 = idx1
         chrom2 = chrom
@@ -441,23 +491,268 @@ def getRegion(args, ma):
     return chrom, region_start, region_end, idx1, start_pos1, chrom2, region_start2, region_end2, idx2, start_pos2
 
 
-def main(args=None):
-    args = parse_arguments().parse_args(args)
-    if args.title:
-        args.title = remove_non_ascii(args.title)
+def get_chromosome_region(pHiCMatrix, pChrom, pRegionStart, pRegionEnd, pIsCooler):
+    """
+    Returns the matrix ids and the start positions of the bins of
+    the region of a loaded matrix.
+    """
+    chrom_start, chrom_end = pHiCMatrix.getChrBinRange(pChrom)
+    _, starts, ends, _ = zip(*pHiCMatrix.cut_intervals[chrom_start:chrom_end])
+    starts = np.array(starts)
+    bin_ids = get_region_bin_ids(starts, np.array(ends), pRegionStart, pRegionEnd, pIsCooler)
+    return bin_ids + chrom_start, starts[bin_ids]
+
+
+def enlarge_chromosome_bins(pStarts, pEnds):
+    """
+    Like enlarge_bins, for the start and end positions of the bins of one
+    chromosome: the first bin starts at 0 and the gaps between consecutive
+    bins are split between them.
+
+    >>> enlarge_chromosome_bins(np.array([10, 70, 95]), np.array([60, 90, 100]))
+    (array([ 0, 65, 93]), array([ 65,  93, 100]))
+    """
+    starts = np.array(pStarts, dtype=np.int64)
+    ends = np.array(pEnds, dtype=np.int64)
+    gap = ends[:-1] != starts[1:]
+    middle = starts[1:] - np.trunc((starts[1:] - ends[:-1]) / 2).astype(np.int64)
+    ends[:-1][gap] = middle[gap]
+    starts[1:][gap] = middle[gap]
+    starts[0] = 0
+    return starts, ends
+
+
+def read_bin_table(pMatrixFile, pClearMaskedBins=False):
+    """
+    Reads the bins of a h5 or cool matrix file, without the matrix, for
+    load_region. If pClearMaskedBins is set, the nan bins of a h5 file are
+    removed.
+
+    Returns
+    -------
+    tuple with the ids of the (not removed) bins, their chromosome names,
+    the first and last + 1 bin of each chromosome, the start and end positions
+    of all bins, the chromosome sizes, the nan bins and the correction factors
+    of a cool file
+    """
+    correction_factors = None
+    if check_cooler(pMatrixFile):
+        cooler_file = cooler.Cooler(pMatrixFile)
+        bins = cooler_file.bins()[:]
+        chrom_list = np.array(toString(list(bins['chrom'].values)))
+        start_list = bins['start'].values
+        end_list = bins['end'].values
+        nan_bins = np.array([], dtype=int)
+        if 'weight' in bins.columns:
+            correction_factors = convertNansToOnes(np.array(bins['weight'].values).flatten())
+    else:
+        with tables.open_file(pMatrixFile) as f:
+            chrom_list = np.array(toString(list(f.root.intervals.chr_list.read())))
+            start_list = f.root.intervals.start_list.read()
+            end_list = f.root.intervals.end_list.read()
+            nan_bins = f.root.nan_bins.read().astype(int) if hasattr(f.root, 'nan_bins') else np.array([], dtype=int)
+
+    # the bins of the matrix (without the nan bins if they are cleared),
+    # in the order of the file
+    bin_ids = np.arange(len(chrom_list))
+    if pClearMaskedBins and len(nan_bins):
+        bin_ids = np.delete(bin_ids, nan_bins)
+    chrom_list = chrom_list[bin_ids]
+    chrom_change = np.flatnonzero(chrom_list[1:] != chrom_list[:-1]) + 1
+    chrom_starts = np.concatenate([[0], chrom_change])
+    chrom_ends = np.concatenate([chrom_change, [len(chrom_list)]])
+    chrom_names = list(chrom_list[chrom_starts])
+    chrom_sizes = OrderedDict(zip(chrom_names, end_list[bin_ids[chrom_ends - 1]]))
+    return bin_ids, chrom_names, chrom_starts, chrom_ends, start_list, end_list, chrom_sizes, nan_bins, \
+        correction_factors
+
+
+def load_region(pMatrixFile, pRegion, pRegion2=None, pClearMaskedBins=False, pBinTable=None):
+    """
+    Loads only the values between the bins of the region and the second region
+    (or the region itself) of a h5 or cool matrix, instead of the whole matrix.
+    The bins are taken from the bin table of the file, or from pBinTable as
+    returned by read_bin_table. For h5 files, only the rows of the stored
+    upper triangle of the two regions are read, and for cool files the block
+    of the two regions is fetched with its correction factors applied. If
+    pClearMaskedBins is set, the nan bins of a h5 file are removed and the
+    remaining bins are enlarged as by --clearMaskedBins.
+
+    Returns
+    -------
+    dense matrix, region, chromosome and start positions of the bins of both
+    regions, chromosome sizes and nan bins
+    """
+    is_cooler = check_cooler(pMatrixFile)
+    if pBinTable is None:
+        pBinTable = read_bin_table(pMatrixFile, pClearMaskedBins)
+    bin_ids, chrom_names, chrom_starts, chrom_ends, start_list, end_list, chrom_sizes, nan_bins, \
+        correction_factors = pBinTable
+
+    regions = []
+    for region, option in [(pRegion, '--region'), (pRegion2 or pRegion, '--region2')]:
+        chrom, region_start, region_end = translate_region(region)
+        if chrom not in chrom_sizes:
+            chrom = change_chrom_names(chrom)
+            if chrom not in chrom_sizes:
+                exit("Chromosome name {} in {} not in matrix".format(change_chrom_names(chrom), option))
+        index = chrom_names.index(chrom)
+        chrom_bin_ids = bin_ids[chrom_starts[index]:chrom_ends[index]]
+        starts = start_list[chrom_bin_ids]
+        ends = end_list[chrom_bin_ids]
+        if pClearMaskedBins:
+            # enlarge_bins does not change the start of the last bin of the matrix
+            starts, ends = enlarge_chromosome_bins(starts, ends)
+            if index == len(chrom_names) - 1 and len(starts) == 1:
+                starts = start_list[chrom_bin_ids]
+        region_ids = get_region_bin_ids(starts, ends, region_start, region_end, is_cooler)
+        regions.append(([chrom, region_start, region_end], chrom_bin_ids[region_ids], starts[region_ids]))
+
+    (region, rows, start_pos1), (region2, cols, start_pos2) = regions
+    if is_cooler:
+        matrix = get_cooler_block(cooler.Cooler(pMatrixFile), rows, cols, correction_factors)
+    else:
+        matrix = get_h5_block(pMatrixFile, rows, cols)
+
+    return matrix, region, start_pos1, region2, start_pos2, chrom_sizes, nan_bins
+
+
+def get_h5_block(pMatrixFile, pRows, pCols):
+    """
+    Returns the dense block of the given rows and columns of a h5 matrix. Only
+    the rows between the first and the last of pRows and pCols are read. As
+    by hiCMatrix, the lower triangle is filled if only the upper triangle of
+    the matrix was saved.
+    """
+    def read_rows(pBinIds, pColumns, pFile):
+        first, last = pBinIds.min(), pBinIds.max() + 1
+        indptr = pFile.root.matrix.indptr[first:last + 1]
+        indices = pFile.root.matrix.indices[indptr[0]:indptr[-1]]
+        data = pFile.root.matrix.data[indptr[0]:indptr[-1]]
+        rows = csr_matrix((data, indices, indptr - indptr[0]),
+                          shape=(last - first, pFile.root.matrix.shape[1]))
+        # the values below the main diagonal show that the whole matrix was saved
+        lower_triangle = (np.repeat(np.arange(first, last), np.diff(indptr)) > indices).any()
+        return rows[pBinIds - first, :][:, pColumns].tocoo(), lower_triangle
+
+    with tables.open_file(pMatrixFile) as f:
+        block, lower_triangle = read_rows(pRows, pCols, f)
+        block_transposed, lower_triangle2 = read_rows(pCols, pRows, f)
+    matrix = np.asarray(block.todense().astype(float))
+    if not (lower_triangle or lower_triangle2):
+        # add the values of the upper triangle, without the main diagonal,
+        # at the transposed positions
+        upper = pCols[block_transposed.row] < pRows[block_transposed.col]
+        matrix[block_transposed.col[upper], block_transposed.row[upper]] += block_transposed.data[upper]
+    return matrix
+
+
+def get_cooler_block(pCooler, pRows, pCols, pCorrectionFactors=None):
+    """
+    Returns the dense block of the given consecutive rows and columns of a
+    cool matrix, with the correction factors applied like hiCMatrix does.
+    """
+    block = pCooler.matrix(balance=False, sparse=True)[pRows[0]:pRows[-1] + 1, pCols[0]:pCols[-1] + 1].tocsr()
+    block = block[pRows - pRows[0], :][:, pCols - pCols[0]].tocoo()
+    block.data = block.data.astype(float)
+    if pCorrectionFactors is not None and np.sum(pCorrectionFactors) != len(pCorrectionFactors):
+        block.data *= pCorrectionFactors[pRows[block.row]] * pCorrectionFactors[pCols[block.col]]
+    return np.asarray(block.todense())
+
 
+def downsample_matrix(pMatrix, pStartPos, pGenomeSize, pNumPixels, pNanBins=None):
+    """
+    Coarsens the sparse matrix to pNumPixels bins of the same size. Each of
+    them is the mean of the bins that start in it, as in an image of the
+    matrix with pNumPixels pixels per axis. The masked bins, pNanBins, are
+    not part of the mean, and pixels with only masked bins are nan.
+
+    Returns
+    -------
+    dense matrix and start positions of the coarse bins
+
+    >>> matrix = csr_matrix(np.arange(16, dtype=float).reshape(4, 4))
+    >>> matrix, start_pos = downsample_matrix(matrix, [0, 10, 20, 30], 40, 2)
+    >>> matrix
+    array([[ 2.5,  4.5],
+           [10.5, 12.5]])
+    >>> start_pos
+    array([ 0., 20.])
+    >>> downsample_matrix(csr_matrix(np.arange(16, dtype=float).reshape(4, 4)), [0, 10, 20, 30], 40, 2,
+    ...                   pNanBins=[1, 2, 3])[0]
+    array([[ 0., nan],
+           [nan, nan]])
+    """
+    bin_size = float(pGenomeSize) / pNumPixels
+    pixels = np.minimum((np.asarray(pStartPos) // bin_size).astype(int), pNumPixels - 1)
+    num_bins = len(pixels)
+    bin_ids = np.arange(num_bins)
+    if pNanBins is not None and len(pNanBins):
+        bin_ids = np.delete(bin_ids, pNanBins)
+    # sums up the rows and columns of each pixel, without the masked bins
+    pixel_matrix = csr_matrix((np.ones(len(bin_ids)), (pixels[bin_ids], bin_ids)), shape=(pNumPixels, num_bins))
+    matrix = (pixel_matrix * pMatrix * pixel_matrix.T).toarray()
+
+    # pixels without bins are nan
+    bins_per_pixel = np.bincount(pixels[bin_ids], minlength=pNumPixels).astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        matrix /= np.outer(bins_per_pixel, bins_per_pixel)
+    return matrix, np.arange(pNumPixels) * bin_size
+
+
+def get_display_resolution_uri(pMatrixFile, pNumPixels):
+    """
+    Returns the uri of the coarsest matrix of a multi-resolution cool file
+    that has at least pNumPixels bins, or of its finest matrix if none of
+    them has as many bins.
+    """
+    resolutions = []
+    for node in cooler.io.ls(pMatrixFile):
+        uri = pMatrixFile + '::' + node
+        resolutions.append((cooler.Cooler(uri).info['nbins'], uri))
+    resolutions.sort()
+    for num_bins, uri in resolutions:
+        if num_bins >= pNumPixels:
+            return uri
+    return resolutions[-1][1]
+
+
+def get_whole_matrix(pHiCMatrix, args):
+    """
+    Returns the dense matrix and the start positions of its bins to plot the
+    whole matrix. For --displayResolution, or if the matrix has more than
+    10000 bins, the matrix is downsampled to about the pixels of the image,
+    and args.displayResolution is set accordingly.
+    """
+    start_pos = make_start_pos_array(pHiCMatrix)
+    # the width of the figure of plot_matrix in pixels
+    num_pixels = 8 * args.dpi
+    num_bins = pHiCMatrix.matrix.shape[0]
+    args.displayResolution = (args.displayResolution or num_bins > 10000) and num_bins > num_pixels and \
+        not args.perChromosome
+    if not args.displayResolution:
+        return np.asarray(pHiCMatrix.getMatrix().astype(float)), start_pos
+
+    log.info("Downsample the matrix from {} to {} bins to plot it.".format(num_bins, num_pixels))
+    genome_size = sum(pHiCMatrix.get_chromosome_sizes().values())
+    return downsample_matrix(pHiCMatrix.matrix, start_pos, genome_size, num_pixels, pHiCMatrix.nan_bins)
+
+
+def load_matrix(args, pBinTable=None):
+    """
+    Loads the matrix, or only the region(s) of it, that is plotted.
+
+    Returns
+    -------
+    hiCMatrix object (None if only the region was loaded from the file), dense
+    matrix to plot, chromosome and start positions of the bins of both axis,
+    chromosome sizes and nan bins
+    """
     chrom = None
     start_pos1 = None
     chrom2 = None
     start_pos2 = None
 
-    if args.perChromosome and args.region:
-        log.error('ERROR, choose from the option '
-                  '--perChromosome or --region, the two '
-                  'options at the same time are not '
-                  'compatible.')
-        exit(1)
-
     # if args.region and args.region2 and args.bigwig:
     #     log.error("Inter-chromosomal pca is not supported.")
     #     exit(1)
@@ -469,7 +764,26 @@ def main(args=None):
     if args.chromosomeOrder is not None and len(args.chromosomeOrder) > 1:
         open_cooler_chromosome_order = False
 
-    if is_cooler and not args.region2 and open_cooler_chromosome_order:
+    # without --chromosomeOrder, a region is loaded directly from the file,
+    # except for single regions of cool files that hiCMatrix can already load
+    # by region (unless the bins were already read for many regions) and for
+    # the masked bins of cool files, which are only known for the whole matrix
+    load_only_region = args.region and not args.perChromosome and not args.chromosomeOrder and \
+        (not is_cooler or ((args.region2 or pBinTable is not None) and not args.clearMaskedBins))
+    if is_cooler and not args.region and not args.perChromosome and '::' not in args.matrix and \
+            len(cooler.io.ls(args.matrix)) > 1:
+        # the width of the figure of plot_matrix in pixels
+        args.matrix = get_display_resolution_uri(args.matrix, 8 * args.dpi)
+        args.displayResolution = True
+        log.info("Plot the matrix {}".format(args.matrix))
+    ma = None
+    if load_only_region:
+        log.debug("Load only the region from the matrix file.")
+        matrix, args.region, start_pos1, region2, start_pos2, chrom_sizes, nan_bins = \
+            load_region(args.matrix, args.region, args.region2, args.clearMaskedBins, pBinTable)
+        chrom = args.region[0]
+        chrom2 = region2[0]
+    elif is_cooler and not args.region2 and open_cooler_chromosome_order:
         log.debug("Retrieve data from cooler format and use its benefits.")
         regionsToRetrieve = None
         if args.region:
@@ -494,8 +808,9 @@ def main(args=None):
 
         if args.region:
             chrom, region_start, region_end, idx1, start_pos1, chrom2, region_start2, region_end2, idx2, start_pos2 = getRegion(args, ma)
-
-        matrix = np.asarray(ma.matrix.todense().astype(float))
+            matrix = np.asarray(ma.matrix.todense().astype(float))
+        else:
+            matrix, start_pos1 = get_whole_matrix(ma, args)
         matrix_length = len(matrix[0])
         log.debug("Number of data points matrix_cool: {}".format(matrix_length))
     else:
@@ -535,82 +850,85 @@ def main(args=None):
 
         else:
             log.debug("Else branch")
-            matrix = np.asarray(ma.getMatrix().astype(float))
+            matrix, start_pos1 = get_whole_matrix(ma, args)
 
-    matrix_length = len(matrix[0])
-    log.debug("Number of data points matrix: {}".format(matrix_length))
-
-    for matrix_ in matrix:
-        if not matrix_length == len(matrix_):
-            log.error("Matrices do not have the same length: {} , {}".format(matrix_length, len(matrix_)))
+    if ma is not None:
+        chrom_sizes = ma.get_chromosome_sizes()
+        nan_bins = ma.nan_bins
+    return ma, matrix, chrom, start_pos1, chrom2, start_pos2, chrom_sizes, nan_bins
 
-    cmap = cm.get_cmap(args.colorMap)
-    log.debug("Nan values set to black\n")
-    cmap.set_bad('black')
 
+def plot_matrix(pMatrix, pChromSizes, pNanBins, pChrom, pChrom2, pStartPos1, pStartPos2, args, cmap,
+                pFigure=None):
+    """
+    Plots the matrix, with the bigwig track if given, into a new figure or,
+    after clearing it, into pFigure.
+    """
     bigwig_info = None
     if args.bigwig:
-        bigwig_info = {'args': args, 'axis': None, 'axis_colorbar': None, 'nan_bins': ma.nan_bins}
-
-    if args.perChromosome:
-        fig = plotPerChr(ma, cmap, args, pBigwig=bigwig_info)
+        bigwig_info = {'args': args, 'axis': None, 'axis_colorbar': None, 'nan_bins': pNanBins}
+
+    norm = None
+
+    if args.log or args.log1p:
+        mask = pMatrix == 0
+        pMatrix[mask] = np.nanmin(pMatrix[mask == False])
+
+        if np.isnan(pMatrix).any() or np.isinf(pMatrix).any():
+            log.debug("any nan {}".format(np.isnan(pMatrix).any()))
+            log.debug("any inf {}".format(np.isinf(pMatrix).any()))
+            mask_nan = np.isnan(pMatrix)
+            mask_inf = np.isinf(pMatrix)
+            pMatrix[mask_nan] = np.nanmin(pMatrix[mask_nan == False])
+            pMatrix[mask_inf] = np.nanmin(pMatrix[mask_inf == False])
+
+    log.debug("any nan after remove of nan: {}".format(np.isnan(pMatrix).any()))
+    log.debug("any inf after remove of inf: {}".format(np.isinf(pMatrix).any()))
+    if args.log1p:
+        pMatrix += 1
+        norm = LogNorm()
+    elif args.log:
+        norm = LogNorm()
 
+    if args.bigwig:
+        # increase figure height to accommodate bigwig track
+        fig_height = 8.5
     else:
-        norm = None
-
-        if args.log or args.log1p:
-            mask = matrix == 0
-            matrix[mask] = np.nanmin(matrix[mask == False])
+        fig_height = 7
+    height = 4.8 / fig_height
 
-            if np.isnan(matrix).any() or np.isinf(matrix).any():
-                log.debug("any nan {}".format(np.isnan(matrix).any()))
-                log.debug("any inf {}".format(np.isinf(matrix).any()))
-                mask_nan = np.isnan(matrix)
-                mask_inf = np.isinf(matrix)
-                matrix[mask_nan] = np.nanmin(matrix[mask_nan == False])
-                matrix[mask_inf] = np.nanmin(matrix[mask_inf == False])
-
-        log.debug("any nan after remove of nan: {}".format(np.isnan(matrix).any()))
-        log.debug("any inf after remove of inf: {}".format(np.isinf(matrix).any()))
-        if args.log1p:
-            matrix += 1
-            norm = LogNorm()
-        elif args.log:
-            norm = LogNorm()
-
-        if args.bigwig:
-            # increase figure height to accommodate bigwig track
-            fig_height = 8.5
-        else:
-            fig_height = 7
-        height = 4.8 / fig_height
-
-        fig_width = 8
-        width = 5.0 / fig_width
-        left_margin = (1.0 - width) * 0.5
+    fig_width = 8
+    width = 5.0 / fig_width
+    left_margin = (1.0 - width) * 0.5
 
+    if pFigure is None:
         fig = plt.figure(figsize=(fig_width, fig_height), dpi=args.dpi)
+    else:
+        # reuse the figure of the previous plot
+        fig = pFigure
+        fig.clf()
+        plt.figure(fig.number)
 
-        if args.bigwig:
-            gs = gridspec.GridSpec(2, 2, height_ratios=[0.90, 0.1], width_ratios=[0.97, 0.03])
-            gs.update(hspace=0.05, wspace=0.05)
-            ax1 = plt.subplot(gs[0, 0])
-            ax2 = plt.subplot(gs[1, 0])
-            ax3 = plt.subplot(gs[0, 1])
-            bigwig_info['axis'] = ax2
-            bigwig_info['axis_colorbar'] = ax3
-        else:
-            ax1 = None
-        bottom = 1.3 / fig_height
+    if args.bigwig:
+        gs = gridspec.GridSpec(2, 2, height_ratios=[0.90, 0.1], width_ratios=[0.97, 0.03])
+        gs.update(hspace=0.05, wspace=0.05)
+        ax1 = plt.subplot(gs[0, 0])
+        ax2 = plt.subplot(gs[1, 0])
+        ax3 = plt.subplot(gs[0, 1])
+        bigwig_info['axis'] = ax2
+        bigwig_info['axis_colorbar'] = ax3
+    else:
+        ax1 = None
+    bottom = 1.3 / fig_height
 
-        if start_pos1 is None:
-            start_pos1 = make_start_pos_array(ma)
+    position = [left_margin, bottom, width, height]
+    plotHeatmap(pMatrix, pChromSizes, fig, position,
+                args, cmap, xlabel=pChrom, ylabel=pChrom2,
+                start_pos=pStartPos1, start_pos2=pStartPos2, pNorm=norm, pAxis=ax1, pBigwig=bigwig_info)
+    return fig
 
-        position = [left_margin, bottom, width, height]
-        plotHeatmap(matrix, ma.get_chromosome_sizes(), fig, position,
-                    args, cmap, xlabel=chrom, ylabel=chrom2,
-                    start_pos=start_pos1, start_pos2=start_pos2, pNorm=norm, pAxis=ax1, pBigwig=bigwig_info)
 
+def save_figure(pFigure, args):
     if not args.disable_tight_layout:
         if args.perChromosome or args.bigwig:
             try:
@@ -620,7 +938,168 @@ def main(args=None):
             except ValueError:
                 log.info("Failed to tight layout. Using regular plot.")
 
-    plt.savefig(args.outFileName, dpi=args.dpi)
+    pFigure.savefig(args.outFileName, dpi=args.dpi)
+
+
+def read_regions_file(pFileName):
+    """
+    Reads the regions of a BED file, or the pairs of regions of a file with
+    the columns chrom, start, end, chrom2, start2, end2 (like BEDPE).
+
+    Returns
+    -------
+    list of (region, region2) in the format of --region, region2 is None
+    if the line has no second region
+    """
+    regions = []
+    with open(pFileName) as fh:
+        for line in fh:
+            if line.startswith(('#', 'track', 'browser')) or not line.strip():
+                continue
+            fields = line.strip().split()
+            region = "{}:{}-{}".format(*fields[:3])
+            region2 = None
+            if len(fields) >= 6 and fields[4].isdigit() and fields[5].isdigit():
+                region2 = "{}:{}-{}".format(*fields[3:6])
+            regions.append((region, region2))
+    return regions
+
+
+def get_region_file_name(pFileName, pRegion, pRegion2=None):
+    """
+    Adds the regions to the file name, before the file extension.
+
+    >>> get_region_file_name('plots/loop.png', 'chrX:1000-2000', 'chrX:5000-6000')
+    'plots/loop_chrX_1000-2000_chrX_5000-6000.png'
+    """
+    root, extension = os.path.splitext(pFileName)
+    for region in [pRegion, pRegion2]:
+        if region is not None:
+            root += "_" + region.replace(":", "_")
+    return root + extension
+
+
+def set_plot_regions_data(pArgs, pBinTable):
+    """
+    Initializes the process that plots the regions with the arguments, the
+    bins of the matrix, the color map and the figure it reuses for every plot.
+    """
+    global plotArgs, plotBinTable, plotColorMap, plotFigure
+    plotArgs = pArgs
+    plotBinTable = pBinTable
+    plotColorMap = cm.get_cmap(pArgs.colorMap)
+    plotColorMap.set_bad('black')
+    plotFigure = None
+
+
+def plot_region(pRegions):
+    """
+    Plots a region, or a pair of regions, of the matrix given to
+    set_plot_regions_data and returns the file name of the plot.
+    """
+    global plotFigure
+    region, region2, file_name = pRegions
+    args = copy(plotArgs)
+    args.region = region
+    args.region2 = region2
+    args.outFileName = file_name
+    _, matrix, chrom, start_pos1, chrom2, start_pos2, chrom_sizes, nan_bins = load_matrix(args, plotBinTable)
+    plotFigure = plot_matrix(matrix, chrom_sizes, nan_bins, chrom, chrom2, start_pos1, start_pos2, args,
+                             plotColorMap, plotFigure)
+    save_figure(plotFigure, args)
+    return file_name
+
+
+def plot_regions(args):
+    """
+    Plots each region of --regionsFile into its own file. The bins of the
+    matrix are read once, and the regions are loaded and plotted by
+    --numberOfProcessors processes, each of them reusing its figure.
+    """
+    regions = read_regions_file(args.regionsFile)
+    if check_cooler(args.matrix) and args.clearMaskedBins and \
+            any(region2 is not None for _, region2 in regions):
+        log.error("--clearMaskedBins is not supported for pairs of regions of cool files in --regionsFile.")
+        exit(1)
+
+    bin_table = None
+    if not (check_cooler(args.matrix) and args.clearMaskedBins):
+        bin_table = read_bin_table(args.matrix, args.clearMaskedBins)
+    TASKS = [(region, region2, get_region_file_name(args.outFileName, region, region2))
+             for region, region2 in regions]
+    if len(TASKS) == 0:
+        log.error("No regions found in {}".format(args.regionsFile))
+        exit(1)
+    # check the chromosomes before plotting, an exit within a worker process would stall the pool
+    chrom_sizes = (bin_table or read_bin_table(args.matrix))[6]
+    for region, region2, _ in TASKS:
+        for chrom in set(translate_region(region_)[0] for region_ in [region, region2] if region_ is not None):
+            if chrom not in chrom_sizes and change_chrom_names(chrom) not in chrom_sizes:
+                log.error("Chromosome name {} in {} not in matrix".format(chrom, args.regionsFile))
+                exit(1)
+
+    if args.numberOfProcessors > 1 and len(TASKS) > 1:
+        pool = multiprocessing.Pool(min(args.numberOfProcessors, len(TASKS)),
+                                    initializer=set_plot_regions_data, initargs=(args, bin_table))
+        file_names = pool.imap_unordered(plot_region, TASKS)
+    else:
+        pool = None
+        set_plot_regions_data(args, bin_table)
+        file_names = (plot_region(task) for task in TASKS)
+
+    for i, file_name in enumerate(file_names):
+        log.info("{}/{} plots done: {}".format(i + 1, len(TASKS), file_name))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def main(args=None):
+    args = parse_arguments().parse_args(args)
+    if args.title:
+        args.title = remove_non_ascii(args.title)
+
+    if args.perChromosome and args.region:
+        log.error('ERROR, choose from the option '
+                  '--perChromosome or --region, the two '
+                  'options at the same time are not '
+                  'compatible.')
+        exit(1)
+
+    if args.regionsFile:
+        if args.perChromosome or args.region or args.region2 or args.chromosomeOrder:
+            log.error('ERROR, --regionsFile is not compatible with the options --perChromosome, '
+                      '--region, --region2 and --chromosomeOrder.')
+            exit(1)
+        plot_regions(args)
+        return
+
+    ma, matrix, chrom, start_pos1, chrom2, start_pos2, chrom_sizes, nan_bins = load_matrix(args)
+
+    matrix_length = len(matrix[0])
+    log.debug("Number of data points matrix: {}".format(matrix_length))
+
+    for matrix_ in matrix:
+        if not matrix_length == len(matrix_):
+            log.error("Matrices do not have the same length: {} , {}".format(matrix_length, len(matrix_)))
+
+    cmap = cm.get_cmap(args.colorMap)
+    log.debug("Nan values set to black\n")
+    cmap.set_bad('black')
+
+    if args.perChromosome:
+        bigwig_info = None
+        if args.bigwig:
+            bigwig_info = {'args': args, 'axis': None, 'axis_colorbar': None, 'nan_bins': nan_bins}
+        fig = plotPerChr(ma, cmap, args, pBigwig=bigwig_info)
+
+    else:
+        if start_pos1 is None:
+            start_pos1 = make_start_pos_array(ma)
+        fig = plot_matrix(matrix, chrom_sizes, nan_bins, chrom, chrom2, start_pos1, start_pos2, args, cmap)
+
+    save_figure(fig, args)
     plt.close(fig)
 
 
@@ -736,8 +1215,8 @@ def plotBigwig(pAxis, pNameOfBigwigList, pChromosomeSizes=None, pRegion=None, pX
                 log.info("Scaling bigwig values.")
                 bigwig_scores = np.array(bigwig_scores)
                 bigwig_scores *= pScaleFactorBigwig
-            if pValueMin is not None or pValueMax is not None
-                bigwig_scores = bigwig_scores.clip(pValueMin, pValueMax)
+            if pValueMin is not None or pValueMax is not None:
+                bigwig_scores = np.array(bigwig_scores).clip(pValueMin, pValueMax)
 
     # else:
     #     for i, bigwigFile in enumerate(pNameOfBigwigList):
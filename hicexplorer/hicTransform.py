@@ -1,14 +1,16 @@
 from __future__ import division
 import argparse
+import multiprocessing
 from os.path import basename, dirname
 
-from scipy.sparse import csr_matrix, lil_matrix
+from scipy.sparse import csr_matrix, block_diag
 import numpy as np
 
 from hicmatrix import HiCMatrix as hm
 from hicexplorer._version import __version__
 from hicexplorer.utilities import exp_obs_matrix_lieberman, exp_obs_matrix_norm
 from hicexplorer.utilities import convertNansToZeros, convertInfsToZeros
+from hicexplorer.utilities import pearson_correlation
 
 
 import logging
@@ -49,8 +51,21 @@ def parse_arguments(args=None):
                            default=None,
                            nargs='+')
    
+    parserOpt.add_argument('--maxDistance',
+                           help='Only for the methods pearson and norm: only the correlations of bins that are '
+                           'at most this distance (in bp) apart are computed and saved. This reduces the size of '
+                           'the result for large chromosomes.',
+                           metavar='INT bp',
+                           type=int)
+
+    parserOpt.add_argument('--blockSize',
+                           help='The pearson correlation is computed in tiles of this number of bins x bins. '
+                           'Smaller tiles need less memory.',
+                           default=1000,
+                           type=int)
+
     parserOpt.add_argument('--threads', '-t',
-                           help='Number of threads for pearson correlation.',
+                           help='Number of processes to use. The chromosomes are processed in parallel.',
                            required=False,
                            default=4,
                            type=int)
@@ -66,24 +81,59 @@ def parse_arguments(args=None):
 def __obs_exp(pSubmatrix, pLengthChromosome, pChromosomeCount):
 
     exp_obs_matrix_ = exp_obs_matrix_lieberman(pSubmatrix, pLengthChromosome, pChromosomeCount)
-    exp_obs_matrix_ = convertNansToZeros(csr_matrix(exp_obs_matrix_))
-    exp_obs_matrix_ = convertInfsToZeros(csr_matrix(exp_obs_matrix_)).todense()
+    exp_obs_matrix_ = convertInfsToZeros(convertNansToZeros(csr_matrix(exp_obs_matrix_)))
+    exp_obs_matrix_.eliminate_zeros()
     return exp_obs_matrix_
 
 
-def __pearson(pSubmatrix):
-    pearson_correlation_matrix = np.corrcoef(pSubmatrix)
-    pearson_correlation_matrix = convertNansToZeros(csr_matrix(pearson_correlation_matrix))
-    pearson_correlation_matrix = convertInfsToZeros(csr_matrix(pearson_correlation_matrix)).todense()
-    return pearson_correlation_matrix
+def __pearson(pSubmatrix, pBlockSize=1000, pMaxDistance=None):
+    return pearson_correlation(pSubmatrix, pBlockSize=pBlockSize, pMaxDistance=pMaxDistance)
+
 
 def _obs_exp_norm(pSubmatrix, pLengthChromosome, pChromosomeCount):
-    
+
     exp_obs_matrix_ = exp_obs_matrix_norm(pSubmatrix, pLengthChromosome, pChromosomeCount)
-    exp_obs_matrix_ = convertNansToZeros(csr_matrix(exp_obs_matrix_))
-    exp_obs_matrix_ = convertInfsToZeros(csr_matrix(exp_obs_matrix_)).todense()
+    exp_obs_matrix_ = convertInfsToZeros(convertNansToZeros(csr_matrix(exp_obs_matrix_)))
+    exp_obs_matrix_.eliminate_zeros()
     return exp_obs_matrix_
 
+
+def _transform_chromosome(pSubmatrix, pMethod, pLengthChromosome, pChromosomeCount, pBlockSize=1000,
+                          pMaxDistance=None):
+    """
+    Computes the transformation of the matrix of one chromosome. With the method 'all',
+    the pearson matrix is computed from the obs_exp matrix and the covariance matrix
+    from the pearson matrix. pMaxDistance (in bins) restricts the pearson correlation
+    of the methods 'pearson' and 'norm' to a band around the diagonal.
+
+    Returns
+    -------
+    list of csr matrices, one per output matrix of the method
+    """
+    if pMethod == 'norm':
+        matrices = [__pearson(_obs_exp_norm(pSubmatrix, pLengthChromosome, pChromosomeCount),
+                              pBlockSize, pMaxDistance)]
+    elif pMethod == 'obs_exp':
+        matrices = [__obs_exp(pSubmatrix, pLengthChromosome, pChromosomeCount)]
+    elif pMethod == 'pearson':
+        matrices = [__pearson(pSubmatrix, pBlockSize, pMaxDistance)]
+    elif pMethod == 'covariance':
+        matrices = [np.cov(pSubmatrix.toarray())]
+    elif pMethod == 'all':
+        obs_exp = __obs_exp(pSubmatrix, pLengthChromosome, pChromosomeCount)
+        pearson = __pearson(obs_exp, pBlockSize)
+        matrices = [obs_exp, pearson, np.cov(pearson)]
+
+    # only one dense matrix of the chromosome is kept at once
+    for idx, matrix in enumerate(matrices):
+        matrices[idx] = csr_matrix(matrix, dtype=float)
+    return matrices
+
+
+def _transform_chromosome_wrapper(pArgs):
+    return _transform_chromosome(*pArgs)
+
+
 def main(args=None):
 
     args = parse_arguments().parse_args(args)
@@ -101,96 +151,56 @@ def main(args=None):
 
     length_chromosome = 0
     chromosome_count = len(hic_ma.getChrNames())
-    for chrname in hic_ma.getChrNames():
-        chr_range = hic_ma.getChrBinRange(chrname)
+    chr_ranges = [hic_ma.getChrBinRange(chrname) for chrname in hic_ma.getChrNames()]
+    for chr_range in chr_ranges:
         length_chromosome += chr_range[1] - chr_range[0]
-    trasf_matrix = lil_matrix(hic_ma.matrix.shape)
-
-    if args.method == 'norm':
-        trasf_matrix = lil_matrix(hic_ma.matrix.shape)
-        # trasf_matrix_pearson = lil_matrix(hic_ma.matrix.shape)
-        # trasf_matrix_corr = lil_matrix(hic_ma.matrix.shape)
-
-        for chrname in hic_ma.getChrNames():
-            chr_range = hic_ma.getChrBinRange(chrname)
-            submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
-
-            submatrix.astype(float)
-            submatrix = _obs_exp_norm(submatrix, length_chromosome, chromosome_count)
-
-            submatrix = __pearson(submatrix)
-            trasf_matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = lil_matrix(submatrix)
-
-        # hic_ma.setMatrix(trasf_matrix.tocsr(), cut_intervals=hic_ma.cut_intervals)
-        # hic_ma.save('obs_norm_pearson.'+ args.outFileName, pSymmetric=False, pApplyCorrection=False)
-
-    elif args.method == 'obs_exp':
-        for chrname in hic_ma.getChrNames():
-            chr_range = hic_ma.getChrBinRange(chrname)
-            submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
-            submatrix.astype(float)
-            trasf_matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = lil_matrix(__obs_exp(submatrix, length_chromosome, chromosome_count))
-
-    elif args.method == 'pearson':
-        for chrname in hic_ma.getChrNames():
-            chr_range = hic_ma.getChrBinRange(chrname)
-            submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
-            log.debug("shape: {}".format(submatrix.shape))
-
-            submatrix.astype(float)
-            log.debug("shape: {}".format(submatrix.shape))
-
-            trasf_matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = lil_matrix(__pearson(submatrix.todense()))
-
-    elif args.method == 'covariance':
-        for chrname in hic_ma.getChrNames():
-            chr_range = hic_ma.getChrBinRange(chrname)
-            submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
-            log.debug("shape: {}".format(submatrix.shape))
-
-            submatrix.astype(float)
-            log.debug("shape: {}".format(submatrix.shape))
-
-            corrmatrix = np.cov(submatrix.todense())
-            trasf_matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = lil_matrix(corrmatrix)
-
-    elif args.method == 'all':
-        trasf_matrix_obs_exp = lil_matrix(hic_ma.matrix.shape)
-        trasf_matrix_pearson = lil_matrix(hic_ma.matrix.shape)
-        trasf_matrix_corr = lil_matrix(hic_ma.matrix.shape)
-
-        for chrname in hic_ma.getChrNames():
-            chr_range = hic_ma.getChrBinRange(chrname)
-            submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
-
-            submatrix.astype(float)
-            submatrix = __obs_exp(submatrix, length_chromosome, chromosome_count)
-
-            trasf_matrix_obs_exp[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = lil_matrix(submatrix)
-            submatrix = __pearson(submatrix)
-
-            trasf_matrix_pearson[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = lil_matrix(submatrix)
-            corrmatrix = np.cov(submatrix)
-            trasf_matrix_corr[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = lil_matrix(corrmatrix)
-
-        hic_ma.setMatrix(trasf_matrix_obs_exp.tocsr(), cut_intervals=hic_ma.cut_intervals)
+    # the transformed matrix is assembled from the blocks of each chromosome
+    chr_starts = [chr_range[0] for chr_range in chr_ranges]
+    chr_ends = [chr_range[1] for chr_range in chr_ranges]
+    if chr_starts != [0] + chr_ends[:-1] or chr_ends[-1] != hic_ma.matrix.shape[0]:
+        log.error("The bins of the chromosomes should be sorted.")
+        exit(1)
 
+    max_distance = None
+    if args.maxDistance is not None:
+        if args.method not in ['pearson', 'norm']:
+            log.error("--maxDistance can only be used with the methods pearson and norm.")
+            exit(1)
+        max_distance = args.maxDistance // hic_ma.getBinSize()
+
+    TASKS = [(hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]], args.method,
+              length_chromosome, chromosome_count, args.blockSize, max_distance) for chr_range in chr_ranges]
+
+    # the results of each chromosome are collected in order, as soon as they are computed
+    if args.threads > 1 and len(TASKS) > 1:
+        pool = multiprocessing.Pool(min(args.threads, len(TASKS)))
+        results = pool.imap(_transform_chromosome_wrapper, TASKS)
+    else:
+        results = map(_transform_chromosome_wrapper, TASKS)
+
+    blocks = None
+    for matrices in results:
+        if blocks is None:
+            blocks = [[] for _ in matrices]
+        for idx, matrix in enumerate(matrices):
+            blocks[idx].append(matrix)
+
+    if args.threads > 1 and len(TASKS) > 1:
+        pool.close()
+        pool.join()
+
+    if args.method == 'all':
         basename_outFileName = basename(args.outFileName)
-        basename_obs_exp = "obs_exp_" + basename_outFileName
-        basename_pearson = "pearson_" + basename_outFileName
-        basename_covariance = "covariance_" + basename_outFileName
         path = dirname(args.outFileName)
         if path != '':
             path += '/'
-
-        hic_ma.save(path + basename_obs_exp, pSymmetric=False, pApplyCorrection=False)
-
-        hic_ma.setMatrix(trasf_matrix_pearson.tocsr(), cut_intervals=hic_ma.cut_intervals)
-        hic_ma.save(path + basename_pearson, pSymmetric=False, pApplyCorrection=False)
-
-        hic_ma.setMatrix(trasf_matrix_corr.tocsr(), cut_intervals=hic_ma.cut_intervals)
-        hic_ma.save(path + basename_covariance, pSymmetric=False, pApplyCorrection=False)
-
-    if not args.method == 'all':
-        hic_ma.setMatrix(trasf_matrix.tocsr(), cut_intervals=hic_ma.cut_intervals)
-        hic_ma.save(args.outFileName, pSymmetric=False, pApplyCorrection=False)
+        out_file_names = [path + prefix + basename_outFileName for prefix in ["obs_exp_", "pearson_", "covariance_"]]
+    else:
+        out_file_names = [args.outFileName]
+
+    for idx, out_file_name in enumerate(out_file_names):
+        # the matrix of each chromosome is a block of the diagonal. hiCMatrix.save
+        # writes the whole matrix, thus the blocks are kept until all are computed
+        hic_ma.setMatrix(block_diag(blocks[idx], format='csr'), cut_intervals=hic_ma.cut_intervals)
+        blocks[idx] = None
+        hic_ma.save(out_file_name, pSymmetric=False, pApplyCorrection=False)
@@ -34,6 +34,7 @@ The following is the list of tools:
    hicFindEnrichedContacts  Identifies enriched Hi-C contacts
    hicCorrelate             Computes and visualises the correlation of Hi-C matrices
    hicFindTADs	            Identifies Topologically Associating Domains (TADs)
+   hicDifferentialBoundaries Compares the TAD boundaries and TAD-separation scores of several samples
    hicMergeMatrixBins	    Merges consecutives bins on a Hi-C matrix to reduce resolution
    hicPCA                   Computes the principal components (eigenvectors) for A/B compartment analysis
    hicTransform             Computes obs_exp (like Lieberman-Aiden), pearson and covariance matrix for A/B compartment analysis
@@ -44,6 +45,7 @@ The following is the list of tools:
    hicSumMatrices	        Adds Hi-C matrices of the same size
    hicPlotDistVsCounts	    Plots distance vs. Hi-C counts of corrected data
    hicExport	            Export matrix to text formats
+   hicComputeSaturation     Estimates if a Hi-C library was sequenced deep enough by subsampling its reads
    hicInfo                  Shows information about a Hi-C matrix (no. of bins, bin length, sum, max, min, etc)
    hicCompareMatrices       Computes difference or ratio between two matrices
 
@@ -120,6 +120,20 @@ def test_hicAggregateContacts_clustering_cool():
     os.remove(outfile_heatmaps.name)
 
 
+def test_hicAggregateContacts_hclust_centroids_without_hclust():
+
+    outfile_aggregate_plots = NamedTemporaryFile(suffix='.png', prefix='hicaggregate_test_', delete=False)
+
+    args = "--matrix {root}/Li_et_al_2015.cool --BED {root}/hicAggregateContacts/test_regions.bed " \
+           "--outFileName {out_agg} --numberOfBins 30 --range 50000:900000 --kmeans 4 " \
+           "--hclustCentroids 10".format(root=ROOT, out_agg=outfile_aggregate_plots.name)
+
+    with pytest.raises(SystemExit):
+        hicexplorer.hicAggregateContacts.main(args.split())
+
+    os.remove(outfile_aggregate_plots.name)
+
+
 @pytest.mark.skipif(MID_MEMORY > memory,
                     reason="Travis has too less memory to run it.")
 def test_hicAggregateContacts_3d():
@@ -161,3 +175,91 @@ def test_hicAggregateContacts_3d_cooler():
     assert res is None, res
 
     os.remove(outfile_aggregate_3d.name)
+
+
+@pytest.mark.skipif(LOW_MEMORY > memory,
+                    reason="Travis has too less memory to run it.")
+def test_hicAggregateContacts_contact_pairs():
+    from hicmatrix import HiCMatrix as hm
+    import numpy as np
+    outfile_aggregate_plots = NamedTemporaryFile(suffix='.png', prefix='hicaggregate_test_', delete=False)
+    outfile_pairs = NamedTemporaryFile(prefix='hicaggregate_test_', delete=False)
+
+    args = "--matrix {root}/Li_et_al_2015.cool --BED {root}/hicAggregateContacts/test_regions.bed " \
+           "--outFileName {out_agg} --numberOfBins 30 --range 50000:900000 --outFileContactPairs {out_pairs}".\
+        format(root=ROOT, out_agg=outfile_aggregate_plots.name, out_pairs=outfile_pairs.name)
+    hicexplorer.hicAggregateContacts.main(args.split())
+
+    pairs = np.loadtxt(outfile_pairs.name + "_X_cluster_1.tab", usecols=(1, 4))
+
+    # all pairs of regions whose bins are in range, once per pair of bins, with the full
+    # submatrix inside of the chromosome
+    ma = hm.hiCMatrix(ROOT + "Li_et_al_2015.cool")
+    bin_size = ma.getBinSize()
+    with open(ROOT + "hicAggregateContacts/test_regions.bed") as fh:
+        starts = [int(line.split()[1]) for line in fh if line.split()[0] == 'X']
+    chrom_start, chrom_end = ma.getChrBinRange('X')
+    bin_ids = [ma.getRegionBinRange('X', start, start + 1)[0] for start in starts]
+    expected = set()
+    for bin_id in bin_ids:
+        for bin_id2 in bin_ids:
+            idx1, idx2 = sorted([bin_id, bin_id2])
+            if 50000 // bin_size <= idx2 - idx1 <= 900000 // bin_size and idx2 > idx1 and \
+                    idx1 - 15 >= chrom_start and idx2 + 16 <= chrom_end:
+                expected.add((idx1, idx2))
+    found = set()
+    for start, start2 in pairs:
+        idx1, idx2 = sorted([ma.getRegionBinRange('X', start, start + 1)[0],
+                             ma.getRegionBinRange('X', start2, start2 + 1)[0]])
+        found.add((idx1, idx2))
+    assert len(found) == len(pairs)
+    # pairs without any contact in their submatrix are not reported
+    assert found <= expected
+    # as found by the former loop over all pairs of regions
+    assert len(found) == 276
+
+    os.remove(outfile_aggregate_plots.name)
+    os.remove(outfile_pairs.name + "_X_cluster_1.tab")
+
+
+def test_submatrix_aggregator():
+    import numpy as np
+    import numpy.testing as nt
+    submatrices = np.random.RandomState(0).poisson(2, size=(250, 5, 5)).astype(float)
+
+    aggregator = hicexplorer.hicAggregateContacts.SubmatrixAggregator((5, 5), 1000)
+    sample = hicexplorer.hicAggregateContacts.SubmatrixAggregator((5, 5), 20)
+    for start in range(0, 250, 30):
+        aggregator.add(submatrices[start:start + 30])
+        sample.add(submatrices[start:start + 30])
+
+    assert aggregator.count == sample.count == 250
+    nt.assert_almost_equal(aggregator.mean(), submatrices.mean(axis=0))
+    nt.assert_almost_equal(aggregator.std(), submatrices.std(axis=0))
+    # all submatrices fit into the reservoir, thus the median is exact
+    nt.assert_equal(aggregator.median(), np.median(submatrices, axis=0))
+
+    # otherwise the reservoir is a sample of the submatrices
+    nt.assert_almost_equal(sample.mean(), submatrices.mean(axis=0))
+    assert sample.reservoir.shape == (20, 5, 5)
+    for submatrix in sample.reservoir:
+        assert (submatrices == submatrix).all(axis=(1, 2)).any()
+
+
+def test_cluster_matrices_scalable():
+    import numpy as np
+    # two groups of submatrices, with and without a contact at the center
+    random_state = np.random.RandomState(0)
+    submatrices = random_state.uniform(0.5, 1.5, size=(3000, 11, 11))
+    submatrices[:1000, 4:7, 4:7] += 1
+    expected = [set(range(1000)), set(range(1000, 3000))]
+
+    for kwargs in [dict(method='kmeans', batch_size=200),
+                   dict(method='kmeans', batch_size=200, pca_components=5),
+                   dict(method='hierarchical', num_centroids=50, pca_components=5)]:
+        clusters = hicexplorer.hicAggregateContacts.cluster_matrices({'chr1': submatrices}, 2, **kwargs)
+        found = sorted([set(cluster) for cluster in clusters['chr1']], key=len)
+        assert found == expected, kwargs
+        # the clustering is reproducible
+        clusters_again = hicexplorer.hicAggregateContacts.cluster_matrices({'chr1': submatrices}, 2, **kwargs)
+        assert [list(cluster) for cluster in clusters['chr1']] == [list(cluster) for cluster in clusters_again['chr1']]
@@ -0,0 +1,50 @@
+from hicexplorer import hicComputeSaturation
+from tempfile import mkdtemp
+import shutil
+import os
+import numpy as np
+import numpy.testing as nt
+
+
+ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_data/")
+
+
+def test_compute_saturation():
+    outfolder = mkdtemp(prefix="test_case_compute_saturation")
+    args = "--matrix {0}small_test_matrix_50kb_res.h5 --outPrefix {1}/test --fractions 0.5 0.25 " \
+           "--filterThreshold -1 5 --numberOfProcessors 2".format(ROOT, outfolder).split()
+    hicComputeSaturation.main(args)
+
+    assert os.path.isfile(outfolder + "/test_saturation.png")
+    with open(outfolder + "/test_saturation.tsv") as fh:
+        header = fh.readline().strip().split('\t')
+        rows = np.array([line.strip().split('\t') for line in fh], dtype=float)
+    assert header == ['#fraction', 'contacts', 'non_zero_pixels', 'pearson', 'spearman',
+                      'boundaries', 'boundary_recall', 'boundary_precision']
+    nt.assert_equal(rows[:, 0], [0.25, 0.5, 1])
+    # the whole matrix is the reference
+    nt.assert_equal(rows[-1, 3:5], [1, 1])
+    nt.assert_equal(rows[-1, 6:], [1, 1])
+    # the number of reads and the correlation grow with the fraction
+    assert np.all(np.diff(rows[:, 1]) > 0)
+    assert np.all(np.diff(rows[:, 3]) > 0)
+    nt.assert_allclose(rows[:2, 1] / rows[-1, 1], [0.25, 0.5], rtol=0.05)
+
+    # the subsamples do not depend on the number of processors
+    hicComputeSaturation.main(args[:-1] + ['1'])
+    with open(outfolder + "/test_saturation.tsv") as fh:
+        fh.readline()
+        nt.assert_equal(np.array([line.strip().split('\t') for line in fh], dtype=float), rows)
+
+    shutil.rmtree(outfolder)
+
+
+def test_subsample_counts():
+    counts = np.random.RandomState(0).randint(0, 100, size=10000)
+    sub = hicComputeSaturation.subsample_counts(counts, 0.3, 'binomial', np.random.RandomState(1))
+    assert np.all(sub <= counts)
+    nt.assert_allclose(sub.sum() / counts.sum(), 0.3, rtol=0.01)
+
+    sub = hicComputeSaturation.subsample_counts(counts, 0.3, 'multinomial', np.random.RandomState(1))
+    assert sub.sum() == int(round(0.3 * counts.sum()))
+    assert np.all(sub[counts == 0] == 0)
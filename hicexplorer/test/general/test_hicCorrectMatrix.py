@@ -2,7 +2,9 @@ from hicexplorer import hicCorrectMatrix
 from hicmatrix import HiCMatrix as hm
 from tempfile import NamedTemporaryFile
 import os
+import numpy as np
 import numpy.testing as nt
+from scipy.sparse import csr_matrix
 from matplotlib.testing.compare import compare_images
 
 
@@ -37,3 +39,59 @@ def test_correct_matrix_diagnostic_plot():
     res = compare_images(ROOT + "hicCorrectMatrix" + '/diagnostic_plot.png', outfile.name, tol=40)
     assert res is None, res
     os.remove(outfile.name)
+
+
+def test_fill_gaps():
+    hic = hm.hiCMatrix()
+    hic.matrix = csr_matrix(np.array([[1, 2, 3, 4, 5, 6],
+                                      [2, 0, 0, 0, 0, 7],
+                                      [3, 0, 8, 9, 0, 1],
+                                      [4, 0, 9, 2, 0, 3],
+                                      [5, 0, 0, 0, 0, 4],
+                                      [6, 7, 1, 3, 4, 5]], dtype=float))
+
+    matrix, to_remove = hicCorrectMatrix.fill_gaps(hic, np.array([1, 4]))
+
+    # (i, j) of a failed bin is the mean of (i - 1, j - 1) and (i + 1, j + 1),
+    # the neighbors of intersections of failed bins get the mean
+    # of the four diagonal neighbors of the intersection
+    expected = np.array([[1, 3.75, 3, 4, 5, 6],
+                         [3.75, 4.5, 3.75, 5, 2.5, 5],
+                         [3, 3.75, 8, 9, 5, 1],
+                         [4, 5, 9, 2, 3.25, 3],
+                         [5, 2.5, 5, 3.25, 3.5, 3.25],
+                         [6, 5, 1, 3, 3.25, 5]])
+    nt.assert_almost_equal(matrix.todense(), expected)
+    nt.assert_equal(to_remove, [])
+
+    # consecutive failed bins can not be filled
+    matrix, to_remove = hicCorrectMatrix.fill_gaps(hic, np.array([1, 2, 4]))
+    nt.assert_equal(to_remove, [1, 2])
+
+
+def test_correct_matrix_fill_gaps():
+    outfile = NamedTemporaryFile(suffix='.h5', delete=False)
+    outfile.close()
+
+    args = "correct --matrix {} --chromosomes chrUextra chr3LHet --iterNum 500 " \
+        " --outFileName {} --filterThreshold -1.5 5.0 --sequencedCountCutoff 0.5 " \
+        "--fillGaps".format(ROOT + "small_test_matrix.h5", outfile.name).split()
+    hicCorrectMatrix.main(args)
+
+    new = hm.hiCMatrix(outfile.name)
+    assert new.matrix.shape[0] > 0
+    assert not np.isnan(new.matrix.data).any()
+
+    os.unlink(outfile.name)
+
+
+def test_get_row_sums():
+    hic = hm.hiCMatrix(ROOT + "small_test_matrix.h5")
+
+    row_sum, row_sum_per_chr = hicCorrectMatrix.get_row_sums(hic)
+    nt.assert_almost_equal(row_sum, np.asarray(hic.matrix.sum(axis=1)).flatten() - hic.matrix.diagonal())
+    for chrname in hic.getChrNames():
+        start, end = hic.getChrBinRange(chrname)
+        chr_submatrix = hic.matrix[start:end, start:end]
+        nt.assert_almost_equal(row_sum_per_chr[chrname],
+                               np.asarray(chr_submatrix.sum(axis=1)).flatten() - chr_submatrix.diagonal())
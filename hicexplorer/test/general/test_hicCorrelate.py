@@ -1,4 +1,9 @@
 from hicexplorer import hicCorrelate
+from hicmatrix import HiCMatrix as hm
+from scipy.sparse import triu
+from scipy.stats import pearsonr, spearmanr, rankdata
+import numpy as np
+import numpy.testing as nt
 from tempfile import NamedTemporaryFile
 import os
 from matplotlib.testing.compare import compare_images
@@ -46,3 +51,88 @@ def test_correlate_chromosomes():
     assert res is None, res
     os.remove(outfile_heatmap.name)
     os.remove(outfile_scatter.name)
+
+
+def test_get_pixel_matrix():
+    matrix = ROOT + "small_test_matrix_50kb_res.h5"
+    pixel_matrix, bin_size, distances, chromosome_ranges = hicCorrelate.get_pixel_matrix(
+        [matrix, matrix], None, "0:1000000", False, 2)
+    assert bin_size == 50000
+    assert pixel_matrix.flags['F_CONTIGUOUS']
+    nt.assert_equal(pixel_matrix[:, 0], pixel_matrix[:, 1])
+
+    # all intra-chromosomal pixels of the upper triangle, without the main diagonal, within 1 Mb
+    hic_ma = hm.hiCMatrix(matrix)
+    hic_ma.filterOutInterChrCounts()
+    upper = triu(hic_ma.matrix, k=1, format='coo')
+    in_range = (upper.col - upper.row < 20) & (upper.data != 0)
+    assert pixel_matrix.shape[0] == in_range.sum()
+    nt.assert_almost_equal(pixel_matrix[:, 0].sum(), upper.data[in_range].sum())
+
+    assert distances.min() == 1 and distances.max() == 19
+    assert chromosome_ranges[-1][2] == pixel_matrix.shape[0]
+
+    memory_map = hicCorrelate.get_pixel_matrix([matrix, matrix], None, "0:1000000", False, 2, pMemoryMap=True)[0]
+    nt.assert_equal(np.asarray(memory_map), pixel_matrix)
+    file_name = memory_map.filename
+    del memory_map
+    os.remove(file_name)
+
+
+def test_compute_correlation_matrix():
+    pixels = np.random.RandomState(0).poisson(1, size=(1000, 4)).astype(float)
+    for method, correlation_function in [('pearson', pearsonr), ('spearman', spearmanr)]:
+        correlation = hicCorrelate.compute_correlation_matrix(pixels, method, pChunkSize=300)
+        for row in range(4):
+            for col in range(4):
+                keep = (pixels[:, row] != 0) | (pixels[:, col] != 0)
+                expected = 1 if row == col else correlation_function(pixels[keep, row], pixels[keep, col])[0]
+                nt.assert_almost_equal(correlation[row, col], expected)
+
+
+def test_compute_scc_matrix():
+    random_state = np.random.RandomState(0)
+    pixels = random_state.poisson(2, size=(600, 3)).astype(float)
+    distances = np.tile(np.arange(1, 7), 100)
+    chromosome_ranges = [('chr1', 0, 300), ('chr2', 300, 600)]
+    scc = hicCorrelate.compute_scc_matrix(pixels, distances, chromosome_ranges, 2)
+
+    # the weighted mean of the correlations of each diagonal of each chromosome
+    weighted_correlation = 0
+    weights = 0
+    for _, start, end in chromosome_ranges:
+        for distance in range(1, 7):
+            diagonal = pixels[start:end][distances[start:end] == distance][:, :2]
+            diagonal = diagonal[(diagonal != 0).any(axis=1)]
+            num_pixels = len(diagonal)
+            weight = num_pixels * np.sqrt(np.var(rankdata(diagonal[:, 0]) / num_pixels) *
+                                          np.var(rankdata(diagonal[:, 1]) / num_pixels))
+            weighted_correlation += weight * pearsonr(diagonal[:, 0], diagonal[:, 1])[0]
+            weights += weight
+    nt.assert_almost_equal(scc[0, 1], weighted_correlation / weights)
+    nt.assert_almost_equal(scc, scc.T)
+    nt.assert_equal(np.diag(scc), 1)
+
+
+def test_correlate_table():
+    outfile_heatmap = NamedTemporaryFile(suffix='heatmap.png', prefix='hicexplorer_test', delete=False)
+    outfile_table = NamedTemporaryFile(suffix='.tsv', prefix='hicexplorer_test', delete=False)
+    outfile_npy = NamedTemporaryFile(suffix='.npy', prefix='hicexplorer_test', delete=False)
+    matrix = ROOT + "hicCorrectMatrix/small_test_matrix_corrected_chrUextra_chr3LHet.h5"
+
+    args = "--matrices {0} {0} {0} --labels first second third --method pearson " \
+        "--outFileNameHeatmap {1} --outFileNameCorrelation {2}".format(matrix, outfile_heatmap.name,
+                                                                       outfile_table.name).split()
+    hicCorrelate.main(args)
+    hicCorrelate.main(args[:-1] + [outfile_npy.name])
+
+    with open(outfile_table.name) as file:
+        assert file.readline().strip().split('\t') == ['#', 'first', 'second', 'third']
+        lines = [line.strip().split('\t') for line in file]
+    assert [line[0] for line in lines] == ['first', 'second', 'third']
+    nt.assert_almost_equal(np.array([line[1:] for line in lines], dtype=float), np.ones((3, 3)))
+    nt.assert_almost_equal(np.load(outfile_npy.name), np.ones((3, 3)))
+
+    os.remove(outfile_heatmap.name)
+    os.remove(outfile_table.name)
+    os.remove(outfile_npy.name)
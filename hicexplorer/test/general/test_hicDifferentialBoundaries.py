@@ -0,0 +1,69 @@
+from hicexplorer import hicDifferentialBoundaries
+from tempfile import mkdtemp
+import shutil
+import os
+import numpy as np
+import numpy.testing as nt
+from scipy import stats
+
+
+ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_data/")
+
+
+def test_differential_boundaries():
+    outfolder = mkdtemp(prefix="test_case_differential_boundaries")
+    args = "--matrices {0}small_test_matrix.h5 {0}small_test_matrix_parallel.h5 --labels sample1 sample2 " \
+           "--outPrefix {1}/test --minDepth 60000 --maxDepth 180000 --step 20000 --correctForMultipleTesting None " \
+           "--thresholdComparisons 1.0 --chromosomes chrX --numberOfProcessors 2".format(ROOT, outfolder).split()
+    hicDifferentialBoundaries.main(args)
+
+    for label in ['sample1', 'sample2']:
+        assert os.path.isfile("{}/test_{}_tad_score.h5".format(outfolder, label))
+        assert os.path.isfile("{}/test_{}_zscore_matrix.h5".format(outfolder, label))
+
+    with open(outfolder + "/test_boundaries.tsv") as fh:
+        header = fh.readline().strip().split('\t')
+        rows = [line.strip().split('\t') for line in fh]
+    assert header == ['#chrom', 'start', 'end', 'samples', 'sample1_score', 'sample2_score',
+                      'sample1_boundary', 'sample2_boundary', 'mean', 'std']
+    assert len(rows) > 100
+    for row in rows:
+        assert row[0] == 'chrX'
+        assert int(row[3]) == int(row[6]) + int(row[7])
+    starts = [int(row[1]) for row in rows]
+    assert starts == sorted(starts)
+
+    # the files of each sample are reused
+    hicDifferentialBoundaries.main(args)
+    with open(outfolder + "/test_boundaries.tsv") as fh:
+        assert len(fh.readlines()) == len(rows) + 1
+
+    shutil.rmtree(outfolder)
+
+
+def test_compute_statistics():
+    scores = np.array([[-0.5, -0.4, -0.1, 0.0, -0.2],
+                       [-0.3, -0.3, -0.2, -0.4, -0.3]])
+    groups = ['wt', 'wt', 'ko', 'ko', 'ko']
+    statistics = hicDifferentialBoundaries.compute_statistics(scores, groups)
+    assert list(statistics.keys()) == ['mean_wt', 'mean_ko', 'difference', 'pvalue', 'qvalue']
+    nt.assert_almost_equal(statistics['mean_wt'], [-0.45, -0.3])
+    nt.assert_almost_equal(statistics['difference'], [0.35, 0.0])
+    nt.assert_almost_equal(statistics['pvalue'][0],
+                           stats.ttest_ind(scores[0, :2], scores[0, 2:], equal_var=False)[1])
+    nt.assert_almost_equal(statistics['qvalue'], np.minimum(1, statistics['pvalue'] * 2))
+
+
+def test_merge_boundaries_chained():
+    # boundaries of consecutive bins are not chained into one joint boundary
+    def sample(boundaries):
+        return {'chrom': np.array(['chr1'] * 10), 'chr_start': np.arange(0, 100000, 10000),
+                'chr_end': np.arange(10000, 110000, 10000), 'boundaries': np.array(boundaries)}
+
+    chrom, start, end, has_boundary = hicDifferentialBoundaries.merge_boundaries(
+        [sample([2, 5]), sample([3]), sample([4])], 20000)
+    nt.assert_equal(start, [20000, 40000])
+    nt.assert_equal(has_boundary, [[True, True, False],
+                                   [True, False, True]])
+    # each boundary of each sample is in one joint boundary
+    assert has_boundary.sum() == 4
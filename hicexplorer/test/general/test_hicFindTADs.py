@@ -2,8 +2,11 @@ from hicexplorer import hicFindTADs
 from hicmatrix import HiCMatrix as hm
 from tempfile import mkdtemp
 import shutil
+import pytest
 import os
+import numpy as np
 import numpy.testing as nt
+from scipy import sparse
 
 
 ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_data/")
@@ -29,7 +32,7 @@ def test_find_TADs_fdr():
     tad_folder = mkdtemp(prefix="test_case_find_tads_fdr")
     args = "--matrix {} --minDepth 60000 --maxDepth 180000 --numberOfProcessors 2 --step 20000 \
     --outPrefix {}/test_multiFDR --minBoundaryDistance 20000 \
-    --correctForMultipleTesting fdr --thresholdComparisons 0.1".format(matrix, tad_folder).split()
+    --correctForMultipleTesting fdr --thresholdComparisons 0.1 --exportBedgraphMatrix".format(matrix, tad_folder).split()
 
     hicFindTADs.main(args)
 
@@ -113,3 +116,152 @@ def test_find_TADs_none():
     assert are_files_equal(ROOT + "find_TADs/None/multiNone_score.bedgraph", tad_folder + "/test_multiNone_score.bedgraph")
 
     shutil.rmtree(tad_folder)
+
+
+def test_tad_score_matrix_h5():
+    tad_folder = mkdtemp(prefix="test_case_tad_score_h5")
+    ft = hicFindTADs.HicFindTads(ROOT + 'find_TADs/None/multiNone_zscore_matrix.h5')
+    ft.load_tad_score_matrix(ROOT + "find_TADs/None/multiNone_tad_score.bm")
+    bedgraph_matrix = ft.bedgraph_matrix
+    ft.save_tad_score_matrix(tad_folder + "/test_tad_score.h5")
+
+    ft.load_tad_score_matrix(tad_folder + "/test_tad_score.h5")
+    for key in ['chrom', 'chr_start', 'chr_end', 'matrix']:
+        nt.assert_equal(ft.bedgraph_matrix[key], bedgraph_matrix[key])
+    assert (ft.min_depth, ft.max_depth, ft.step, ft.binsize) == (60000, 180000, 20000, 5000)
+
+    # only the given chromosomes are read, in the given order
+    for filename in [tad_folder + "/test_tad_score.h5", ROOT + "find_TADs/None/multiNone_tad_score.bm"]:
+        ft.load_tad_score_matrix(filename, pChromosomes=['chrX', 'chr3L'])
+        assert list(np.unique(ft.bedgraph_matrix['chrom'], return_index=True)[0]) == ['chr3L', 'chrX']
+        assert ft.bedgraph_matrix['chrom'][0] == 'chrX'
+        for key in ['chr_start', 'chr_end', 'matrix']:
+            nt.assert_equal(ft.bedgraph_matrix[key][ft.bedgraph_matrix['chrom'] == 'chr3L'],
+                            bedgraph_matrix[key][bedgraph_matrix['chrom'] == 'chr3L'])
+
+    shutil.rmtree(tad_folder)
+
+
+def test_peakdetect():
+    y_axis = np.array([0., 1, 3, 2, 1, 0.5, 2, 4, 3, 3, 1, 0, 2, 1, 1, 2, 5, 4, 3, 3])
+    chrom = np.array(['a'] * 12 + ['b'] * 8)
+    max_peaks, min_peaks = hicFindTADs.HicFindTads.peakdetect(y_axis, lookahead=2, chrom=chrom)
+    assert max_peaks == [[2, 3.0], [7, 4.0], [12, 2.0], [16, 5.0]]
+    assert min_peaks == [[5, 0.5], [13, 1.0]]
+
+    max_peaks, min_peaks = hicFindTADs.HicFindTads.peakdetect(y_axis, lookahead=2, delta=1.5, chrom=chrom)
+    assert max_peaks == [[2, 3.0], [7, 4.0]]
+    assert min_peaks == [[5, 0.5], [13, 1.0]]
+
+
+def test_find_consensus_minima():
+    ft = hicFindTADs.HicFindTads(ROOT + 'find_TADs/None/multiNone_zscore_matrix.h5')
+    ft.load_tad_score_matrix(ROOT + "find_TADs/None/multiNone_tad_score.bm")
+    min_idx, delta = hicFindTADs.HicFindTads.find_consensus_minima(ft.bedgraph_matrix['matrix'], lookahead=4,
+                                                                   chrom=ft.bedgraph_matrix['chrom'])
+    assert len(min_idx) == 1612
+    assert list(min_idx[:5]) == [11, 43, 62, 77, 82]
+    assert list(min_idx[-3:]) == [23791, 23795, 23821]
+    nt.assert_equal([delta[idx] for idx in min_idx[:5]],
+                    [np.nan, 0.06451073684210526, 0.03838480263157895, 0.033145842105263154, 0.05464511842105264])
+    assert np.isnan(list(delta.values())).sum() == 9
+
+
+def test_find_TADs_multiscale():
+    tad_folder = mkdtemp(prefix="test_case_find_tads_multiscale")
+    ft = hicFindTADs.HicFindTads(ROOT + 'find_TADs/None/multiNone_zscore_matrix.h5', min_boundary_distance=20000,
+                                 p_correct_for_multiple_testing='None', p_threshold_comparisons=1.0)
+    ft.load_tad_score_matrix(ROOT + "find_TADs/None/multiNone_tad_score.bm")
+
+    scales = ft.find_multiscale_boundaries(2)
+    assert len(scales) == 2
+    nt.assert_equal(scales[0]['window_len'], [60000, 80000])
+    nt.assert_equal(scales[1]['window_len'], [116568, 163923])
+    # the boundaries of the coarse scale are also boundaries of the fine scale
+    assert len(scales[1]['boundaries']) < len(scales[0]['boundaries'])
+    assert np.all(np.in1d(scales[1]['boundaries'], scales[0]['boundaries']))
+    # the TAD-separation score of all window lengths is kept
+    assert ft.bedgraph_matrix['matrix'].shape[1] == 4
+
+    ft.save_multiscale_domains(scales, tad_folder + "/test_multiscale")
+    with open(tad_folder + "/test_multiscale_nested_domains.bed") as fh:
+        domains = [line.split('\t') for line in fh]
+    scale_domains = [[(chrom, int(start), int(end)) for chrom, start, end, name in [domain[:4] for domain in domains]
+                      if name.startswith('ID_scale{}_'.format(level))] for level in [1, 2]]
+    assert len(domains) == len(scale_domains[0]) + len(scale_domains[1])
+    for chrom, start, end in scale_domains[0]:
+        # each domain is either inside a coarse domain or does not overlap with any
+        overlap = [(_start, _end) for _chrom, _start, _end in scale_domains[1] if _chrom == chrom and _start < end and start < _end]
+        assert len(overlap) == 0 or (len(overlap) == 1 and overlap[0][0] <= start and end <= overlap[0][1])
+    assert os.path.isfile(tad_folder + "/test_multiscale_scale_2_domains.bed")
+
+    # a scale without local minima is skipped
+    ft.bedgraph_matrix['matrix'][:, 2:] = 1.0
+    scales = ft.find_multiscale_boundaries(2)
+    assert len(scales) == 1
+    nt.assert_equal(scales[0]['window_len'], [60000, 80000])
+
+    # without local minima, find_boundaries raises an error instead of exiting
+    ft.bedgraph_matrix['matrix'][:] = 1.0
+    with pytest.raises(hicFindTADs.NoBoundariesError):
+        ft.find_boundaries()
+
+    shutil.rmtree(tad_folder)
+
+
+def test_get_diamond_mean():
+    matrix = hm.hiCMatrix(ROOT + "small_test_matrix.h5").matrix
+    matrix = sparse.triu(matrix[:200, :200], k=0, format='csr')
+    cut = np.arange(200)
+    for depth in [1, 5, 20]:
+        left_idx = np.maximum(0, cut - depth)
+        right_idx = np.minimum(200, cut + depth)
+        expected = [hicFindTADs.get_cut_weight_by_bin_id(matrix, x, depth, return_mean=True) for x in cut]
+        expected = np.nan_to_num(np.array(expected, dtype=float))
+        nt.assert_almost_equal(hicFindTADs.get_diamond_mean(matrix, left_idx, cut, right_idx), expected)
+
+
+def test_boundary_pvalues_are_reused():
+    ft = hicFindTADs.HicFindTads(ROOT + 'find_TADs/None/multiNone_zscore_matrix.h5',
+                                 p_correct_for_multiple_testing='None')
+    ft.load_bedgraph_matrix(ROOT + "find_TADs/None/multiNone_tad_score.bm")
+    min_idx, _ = hicFindTADs.HicFindTads.find_consensus_minima(ft.bedgraph_matrix['matrix'], lookahead=4,
+                                                               chrom=ft.bedgraph_matrix['chrom'])
+    raw_pvalues = ft.min_pvalue(min_idx)
+    assert len(ft.pvalues_cache) == 1
+
+    ft.correct_for_multiple_testing = 'bonferroni'
+    bonferroni_pvalues = ft.min_pvalue(min_idx)
+    assert len(ft.pvalues_cache) == 1
+    expected = np.minimum(1, np.array(list(raw_pvalues.values())) * len(raw_pvalues))
+    nt.assert_almost_equal(list(bonferroni_pvalues.values()), expected)
+
+
+def test_find_TADs_parameter_sweep():
+    tad_folder = mkdtemp(prefix="test_case_find_tads_sweep")
+    ft = hicFindTADs.HicFindTads(ROOT + 'find_TADs/None/multiNone_zscore_matrix.h5',
+                                 p_correct_for_multiple_testing='None', num_processors=2)
+    ft.load_bedgraph_matrix(ROOT + "find_TADs/None/multiNone_tad_score.bm")
+
+    hicFindTADs.run_parameter_sweep(ft, [0.01, 0.05], [20000], [1.0, 0.01], tad_folder + "/test_sweep")
+
+    # the combination used by test_find_TADs_none gives the same result
+    prefix = tad_folder + "/test_sweep_delta_0.01_minBoundaryDistance_20000_thresholdComparisons_1.0"
+    assert are_files_equal(ROOT + "find_TADs/None/multiNone_boundaries.bed", prefix + "_boundaries.bed")
+    assert are_files_equal(ROOT + "find_TADs/None/multiNone_domains.bed", prefix + "_domains.bed")
+
+    with open(tad_folder + "/test_sweep_parameter_sweep.txt") as fh:
+        lines = fh.readlines()
+    assert len(lines) == 5
+    for line in lines[1:]:
+        delta, distance, threshold, num_boundaries = line.strip().split('\t')
+        assert os.path.isfile("{}/test_sweep_delta_{}_minBoundaryDistance_{}_thresholdComparisons_{}_boundaries.bed".format(
+            tad_folder, delta, distance, threshold))
+
+    # the p-values of a minimum boundary distance are computed once for all thresholds
+    ft.num_processors = 1
+    ft.pvalues_cache = {}
+    hicFindTADs.run_parameter_sweep(ft, [0.01], [20000], [1.0, 0.01, 0.05], tad_folder + "/test_sweep_cache")
+    assert len(ft.pvalues_cache) == 1
+
+    shutil.rmtree(tad_folder)
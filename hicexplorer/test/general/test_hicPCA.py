@@ -132,3 +132,24 @@ def test_pca_bigwig_gene_density():
 
     os.unlink(pca1.name)
     os.unlink(pca2.name)
+
+
+def test_pca_lanczos():
+    matrix = ROOT + "small_test_matrix_50kb_res.h5"
+    chromosomes = 'chr2L chr3L chrX'
+    pca_files = {}
+    for solver in ['dense', 'lanczos']:
+        pca_files[solver] = [NamedTemporaryFile(suffix='.bedgraph', delete=False) for _ in range(2)]
+        for pca in pca_files[solver]:
+            pca.close()
+        args = "--matrix {} --outputFileName {} {} -f bedgraph -noe 2 --chromosomes {} --eigenvectorSolver {} " \
+               "--numberOfProcessors 2".format(matrix, pca_files[solver][0].name, pca_files[solver][1].name,
+                                               chromosomes, solver).split()
+        hicPCA.main(args)
+
+    for pca_dense, pca_lanczos in zip(pca_files['dense'], pca_files['lanczos']):
+        values_dense = np.loadtxt(pca_dense.name, usecols=3)
+        values_lanczos = np.loadtxt(pca_lanczos.name, usecols=3)
+        nt.assert_allclose(np.absolute(values_dense), np.absolute(values_lanczos), atol=1e-6)
+        os.unlink(pca_dense.name)
+        os.unlink(pca_lanczos.name)
@@ -1,9 +1,10 @@
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkdtemp
 
 import matplotlib as mpl
 mpl.use('agg')
 from matplotlib.testing.compare import compare_images
 import os.path
+import shutil
 import pytest
 from psutil import virtual_memory
 mem = virtual_memory()
@@ -439,3 +440,104 @@ def test_hicPlotMatrix_region_start_end_pca1_colormap_bigwig():
     assert res is None, res
     if REMOVE_OUTPUT:
         os.remove(outfile.name)
+
+
+def test_hicPlotMatrix_load_region():
+    import numpy as np
+    import numpy.testing as nt
+    from hicmatrix import HiCMatrix as hm
+    from hicexplorer.utilities import enlarge_bins
+
+    matrix_file = ROOT + "small_test_matrix_50kb_res.h5"
+    for clear_masked_bins in [False, True]:
+        matrix, region, start_pos1, region2, start_pos2, chrom_sizes, _ = hicexplorer.hicPlotMatrix.load_region(
+            matrix_file, "chrU:4000000-6000000", "chr2L:0-3000000", clear_masked_bins)
+
+        # the same block of the whole matrix
+        ma = hm.hiCMatrix(matrix_file)
+        if clear_masked_bins:
+            ma.maskBins(ma.nan_bins)
+            ma.setCutIntervals(enlarge_bins(ma.cut_intervals))
+        rows = [idx for idx, (chrom, start, end, _) in enumerate(ma.cut_intervals)
+                if chrom == 'chrU' and start >= 4000000 and end < 6000000]
+        cols = [idx for idx, (chrom, start, end, _) in enumerate(ma.cut_intervals)
+                if chrom == 'chr2L' and start >= 0 and end < 3000000]
+        nt.assert_equal(matrix, ma.matrix[rows, :][:, cols].todense())
+        nt.assert_equal(start_pos1, [ma.cut_intervals[idx][1] for idx in rows])
+        nt.assert_equal(start_pos2, [ma.cut_intervals[idx][1] for idx in cols])
+        assert region == ['chrU', 4000000, 6000000]
+        assert region2 == ['chr2L', 0, 3000000]
+        assert chrom_sizes == ma.get_chromosome_sizes()
+
+
+def test_hicPlotMatrix_regions_file():
+    regions_file = NamedTemporaryFile(suffix='.bed', prefix='hicexplorer_test', delete=False, mode='w')
+    regions_file.write("X\t3000000\t3500000\n"
+                       "X\t3000000\t3500000\tX\t3100000\t3600000\n"
+                       "X\t10000000\t10400000\n")
+    regions_file.close()
+    outfolder = mkdtemp(prefix='hicexplorer_test')
+    outfile = os.path.join(outfolder, 'region.png')
+    single_outfile = NamedTemporaryFile(suffix='.png', prefix='hicexplorer_test', delete=False)
+
+    args = "--matrix {0} --outFileName {1} --regionsFile {2} --log1p --numberOfProcessors 2".format(
+        ROOT + "Li_et_al_2015.cool", outfile, regions_file.name).split()
+    hicexplorer.hicPlotMatrix.main(args)
+    # the batch mode writes one file per region instead of the given file name
+    assert os.path.getsize(outfile) == 0
+
+    for region, region2 in [('X:3000000-3500000', None),
+                            ('X:3000000-3500000', 'X:3100000-3600000'),
+                            ('X:10000000-10400000', None)]:
+        region_outfile = hicexplorer.hicPlotMatrix.get_region_file_name(outfile, region, region2)
+        args = "--matrix {0} --outFileName {1} --region {2} --log1p".format(
+            ROOT + "Li_et_al_2015.cool", single_outfile.name, region).split()
+        if region2 is not None:
+            args += ['--region2', region2]
+        hicexplorer.hicPlotMatrix.main(args)
+        res = compare_images(single_outfile.name, region_outfile, tolerance)
+        assert res is None, res
+        os.remove(region_outfile)
+
+    shutil.rmtree(outfolder)
+    os.remove(single_outfile.name)
+    os.remove(regions_file.name)
+
+
+def test_hicPlotMatrix_display_resolution():
+    import numpy as np
+    import numpy.testing as nt
+    from hicmatrix import HiCMatrix as hm
+
+    ma = hm.hiCMatrix(ROOT + "small_test_matrix_50kb_res.h5")
+    start_pos = hicexplorer.hicPlotMatrix.make_start_pos_array(ma)
+    genome_size = sum(ma.get_chromosome_sizes().values())
+    matrix, display_start_pos = hicexplorer.hicPlotMatrix.downsample_matrix(ma.matrix, start_pos, genome_size, 500)
+    assert matrix.shape == (500, 500)
+    nt.assert_almost_equal(display_start_pos[1] - display_start_pos[0], genome_size / 500.0)
+    # each pixel is the mean of its bins
+    bins_per_pixel = np.bincount(np.searchsorted(display_start_pos, start_pos, side='right') - 1, minlength=500)
+    nt.assert_almost_equal((matrix * np.outer(bins_per_pixel, bins_per_pixel)).sum(), ma.matrix.sum())
+
+    # the masked bins are left out of the mean, pixels with only masked bins are nan
+    matrix, _ = hicexplorer.hicPlotMatrix.downsample_matrix(ma.matrix, start_pos, genome_size, 500, ma.nan_bins)
+    valid_bins = np.delete(np.arange(len(start_pos)), ma.nan_bins)
+    bins_per_pixel = np.bincount(np.searchsorted(display_start_pos, np.asarray(start_pos)[valid_bins], side='right') - 1,
+                                 minlength=500)
+    nt.assert_equal(np.isnan(matrix).all(axis=1), bins_per_pixel == 0)
+    nt.assert_almost_equal(np.nansum(matrix * np.outer(bins_per_pixel, bins_per_pixel)),
+                           ma.matrix[valid_bins, :][:, valid_bins].sum())
+
+    # the coarsest resolution of a multi-resolution file with more bins than pixels is plotted
+    outfile = NamedTemporaryFile(suffix='.png', prefix='hicexplorer_test', delete=False)
+    outfile_resolution = NamedTemporaryFile(suffix='.png', prefix='hicexplorer_test', delete=False)
+    args = "--matrix {0}/matrix.mcool --outFileName {1} --log1p".format(ROOT, outfile.name).split()
+    hicexplorer.hicPlotMatrix.main(args)
+    args = "--matrix {0}/matrix.mcool::/2 --outFileName {1} --log1p --displayResolution".format(
+        ROOT, outfile_resolution.name).split()
+    hicexplorer.hicPlotMatrix.main(args)
+    res = compare_images(outfile_resolution.name, outfile.name, 0.001)
+    assert res is None, res
+
+    os.remove(outfile.name)
+    os.remove(outfile_resolution.name)
@@ -83,3 +83,27 @@ def test_hic_transfer_covariance():
     new = hm.hiCMatrix(outfile.name)
     nt.assert_array_almost_equal(test.matrix.data, new.matrix.data, decimal=DELTA_DECIMAL)
     os.unlink(outfile.name)
+
+
+def test_hic_transfer_pearson_max_distance():
+    outfile = NamedTemporaryFile(suffix='pearson.h5', delete=False)
+    outfile.close()
+    outfile_band = NamedTemporaryFile(suffix='pearson_band.h5', delete=False)
+    outfile_band.close()
+
+    args = "--matrix {} --outFileName {} --method pearson --blockSize 100".format(
+        original_matrix, outfile.name).split()
+    hicTransform.main(args)
+    args = "--matrix {} --outFileName {} --method pearson --maxDistance 1000000".format(
+        original_matrix, outfile_band.name).split()
+    hicTransform.main(args)
+
+    full = hm.hiCMatrix(outfile.name).matrix.tocoo()
+    band = hm.hiCMatrix(outfile_band.name).matrix.tocoo()
+    # 1 Mb are 20 bins of 50 kb
+    assert abs(band.row - band.col).max() <= 20
+    mask = abs(full.row - full.col) <= 20
+    nt.assert_array_almost_equal(band.toarray()[full.row[mask], full.col[mask]], full.data[mask])
+    assert band.nnz <= mask.sum()
+    os.unlink(outfile.name)
+    os.unlink(outfile_band.name)
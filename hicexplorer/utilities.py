@@ -2,6 +2,9 @@ from __future__ import division
 import sys
 import numpy as np
 import argparse
+import ctypes
+from multiprocessing.sharedctypes import RawArray
+from scipy.sparse import issparse, coo_matrix, csr_matrix
 from matplotlib import use as mplt_use
 mplt_use('Agg')
 from unidecode import unidecode
@@ -213,29 +216,37 @@ def getUserRegion(chromSizes, regionString, max_chunk_size=1e6):
     return (chromSizes, regionStart, regionEnd, int(chunkSize))
 
 
+def _nonzero_distance_and_data(pSubmatrix):
+    """
+        Returns the distance to the diagonal (in bins) and the
+        value of each non-zero element of the sparse matrix.
+    """
+    submatrix = pSubmatrix.tocoo()
+    nonzero = submatrix.data != 0
+    distance = np.absolute(submatrix.row[nonzero] - submatrix.col[nonzero])
+    return distance, submatrix.data[nonzero]
+
+
 def expected_interactions_in_distance(pLength_chromosome, pChromosome_count, pSubmatrix):
     """
         Computes the function I_chrom(s) for a given chromosome.
     """
-    expected_interactions = np.zeros(pSubmatrix.shape[0])
-    row, col = pSubmatrix.nonzero()
-    distance = np.absolute(row - col)
-
-    for i, distance_ in enumerate(distance):
-        expected_interactions[distance_] += pSubmatrix.data[i]
+    distance, data = _nonzero_distance_and_data(pSubmatrix)
+    expected_interactions = np.bincount(distance, weights=data, minlength=pSubmatrix.shape[0]).astype(float)
 
     count_times_i = np.arange(float(len(expected_interactions)))
-    pChromosome_count = np.int(pChromosome_count)
-    pLength_chromosome = np.int(pLength_chromosome)
+    pChromosome_count = int(pChromosome_count)
+    pLength_chromosome = int(pLength_chromosome)
     count_times_i *= pChromosome_count
     count_times_i -= pLength_chromosome
-    count_times_i *= np.int(-1)
+    count_times_i *= -1
 
     expected_interactions /= count_times_i
     log.debug('exp_obs_matrix_lieberman {}'.format(expected_interactions))
 
     return expected_interactions
 
+
 def expected_interactions_norm(pLength_chromosome, pChromosome_count, pSubmatrix):
     """
         Computes the function I_chrom(s) for a given chromosome.
@@ -243,17 +254,14 @@ def expected_interactions_norm(pLength_chromosome, pChromosome_count, pSubmatrix
     log.debug('pLength_chromosome {}'.format(pLength_chromosome))
     log.debug('pChromosome_count {}'.format(pChromosome_count))
 
-    expected_interactions = np.zeros(pSubmatrix.shape[0])
-    row, col = pSubmatrix.nonzero()
-    distance = np.absolute(row - col)
+    distance, data = _nonzero_distance_and_data(pSubmatrix)
+    expected_interactions = np.bincount(distance, weights=data, minlength=pSubmatrix.shape[0]).astype(float)
+    occurences = np.bincount(distance, minlength=pSubmatrix.shape[0])
 
-    occurences = np.zeros(pSubmatrix.shape[0])
-    for i, distance_ in enumerate(distance):
-        expected_interactions[distance_] += pSubmatrix.data[i]
-        occurences[distance_] += 1
     expected_interactions /= occurences
     return expected_interactions
 
+
 def exp_obs_matrix_lieberman(pSubmatrix, pLength_chromosome, pChromosome_count):
     """
         Creates normalized contact matrix M* by
@@ -285,18 +293,176 @@ def exp_obs_matrix_norm(pSubmatrix, pLength_chromosome, pChromosome_count):
     """
 
     expected_interactions_in_distance = expected_interactions_norm(pLength_chromosome, pChromosome_count, pSubmatrix)
-    
+
     row_sums = np.array(pSubmatrix.sum(axis=1).T).flatten()
     total_interactions = pSubmatrix.sum()
 
-    row, col = pSubmatrix.nonzero()
-    # data = pSubmatrix.data.tolist()
-    for i in range(len(row)):
-        expected = expected_interactions_in_distance[np.absolute(row[i]-col[i])] 
-        expected *= row_sums[row[i]] * row_sums[col[i]] / total_interactions
-        pSubmatrix.data[i] /= expected
+    submatrix = pSubmatrix.tocoo()
+    row, col = submatrix.row, submatrix.col
+    expected = expected_interactions_in_distance[np.absolute(row - col)]
+    expected *= row_sums[row] * row_sums[col] / total_interactions
+    # the values are assigned to keep the data type of the matrix
+    pSubmatrix.data[:] = submatrix.data / expected
     return pSubmatrix
 
+
+def pearson_correlation_tiles(pMatrix, pBlockSize=1000, pMaxDistance=None):
+    """
+        Computes the Pearson correlation of the rows of a matrix, as np.corrcoef,
+        tile by tile. The row means and norms are computed once and each tile of
+        pBlockSize x pBlockSize correlations is the product of two blocks of rows.
+        For a sparse matrix, the product of the sparse rows is corrected by the
+        row means. Thus, the memory is bounded by the tile size and not by the
+        size of the correlation matrix. As with convertNansToZeros, rows without
+        variance have a correlation of 0.
+
+        Only the tiles of the upper triangle are computed. If pMaxDistance is given,
+        the tiles further than pMaxDistance bins from the diagonal are skipped.
+
+        Yields the first row, the first column and the values of each tile.
+
+        >>> matrix = np.array([[1., 2., 3., 5.], [2., 1., 0., 1.], [1., 1., 1., 1.], [0., 1., 0., 3.]])
+        >>> tiles = list(pearson_correlation_tiles(matrix, pBlockSize=3))
+        >>> [(row, col, values.shape) for row, col, values in tiles]
+        [(0, 0, (3, 3)), (0, 3, (3, 1)), (3, 3, (1, 1))]
+        >>> np.allclose(tiles[0][2][:2, :2], np.corrcoef(matrix[:2]))
+        True
+        >>> sparse_tiles = list(pearson_correlation_tiles(csr_matrix(matrix), pBlockSize=3))
+        >>> all([np.allclose(tile[2], sparse_tile[2]) for tile, sparse_tile in zip(tiles, sparse_tiles)])
+        True
+        >>> matrix[2] = 0.1
+        >>> [list(pearson_correlation_tiles(m, pBlockSize=3))[0][2][2] for m in [matrix, csr_matrix(matrix)]]
+        [array([0., 0., 0.]), array([0., 0., 0.])]
+    """
+    num_rows = pMatrix.shape[0]
+    num_cols = pMatrix.shape[1]
+    if issparse(pMatrix):
+        pMatrix = csr_matrix(pMatrix, dtype=float)
+        row_mean = np.asarray(pMatrix.sum(axis=1)).flatten() / num_cols
+        row_sum_of_squares = np.asarray(pMatrix.multiply(pMatrix).sum(axis=1)).flatten()
+        # the rounding errors can make the sum of squares of constant rows slightly negative
+        row_norm = np.sqrt(np.maximum(row_sum_of_squares - num_cols * row_mean ** 2, 0))
+    else:
+        pMatrix = np.asarray(pMatrix, dtype=float)
+        row_mean = pMatrix.mean(axis=1)
+        row_sum_of_squares = np.zeros(num_rows)
+        row_norm = np.zeros(num_rows)
+        for start in range(0, num_rows, pBlockSize):
+            rows = pMatrix[start:start + pBlockSize]
+            row_sum_of_squares[start:start + pBlockSize] = np.einsum('ij,ij->i', rows, rows)
+            rows = rows - row_mean[start:start + pBlockSize, np.newaxis]
+            row_norm[start:start + pBlockSize] = np.sqrt(np.einsum('ij,ij->i', rows, rows))
+    # rows without variance give zero correlations instead of nans. The variance of
+    # constant rows is not exactly zero because of the rounding errors of the mean
+    # (and of the sum of squares of sparse rows), which are relative to the sum of squares.
+    row_norm[row_norm ** 2 <= num_cols * np.finfo(float).eps * row_sum_of_squares] = np.inf
+
+    def get_rows(start, end):
+        if issparse(pMatrix):
+            return pMatrix[start:end]
+        return (pMatrix[start:end] - row_mean[start:end, np.newaxis]) / row_norm[start:end, np.newaxis]
+
+    for row_start in range(0, num_rows, pBlockSize):
+        row_end = min(row_start + pBlockSize, num_rows)
+        rows = get_rows(row_start, row_end)
+        for col_start in range(row_start, num_rows, pBlockSize):
+            if pMaxDistance is not None and col_start - (row_end - 1) > pMaxDistance:
+                break
+            col_end = min(col_start + pBlockSize, num_rows)
+            cols = rows if col_start == row_start else get_rows(col_start, col_end)
+            if issparse(pMatrix):
+                # (X_i - m_i) * (X_j - m_j).T = X_i * X_j.T - n * m_i * m_j.T
+                tile = rows.dot(cols.T).toarray()
+                tile -= num_cols * np.outer(row_mean[row_start:row_end], row_mean[col_start:col_end])
+                tile /= row_norm[row_start:row_end, np.newaxis]
+                tile /= row_norm[np.newaxis, col_start:col_end]
+            else:
+                tile = rows.dot(cols.T)
+            # as np.corrcoef, the values are clipped to the valid range
+            np.clip(tile, -1, 1, out=tile)
+            yield row_start, col_start, tile
+
+
+def pearson_correlation(pMatrix, pBlockSize=1000, pMaxDistance=None, pOut=None):
+    """
+        Computes the Pearson correlation of the rows of a matrix with
+        pearson_correlation_tiles.
+
+        If pMaxDistance is None, the correlation matrix is returned as a dense
+        array. It is written into pOut if given, which can be a memory-mapped
+        array (np.memmap) to keep the matrix on disk. Otherwise, only the
+        correlations of rows at most pMaxDistance bins apart are computed and
+        they are returned as a csr matrix.
+
+        >>> matrix = np.array([[1., 2., 3., 5.], [2., 1., 0., 1.], [1., 1., 1., 1.], [0., 1., 0., 3.]])
+        >>> expected = np.nan_to_num(np.corrcoef(matrix))
+        >>> np.allclose(pearson_correlation(matrix, pBlockSize=3), expected)
+        True
+        >>> band = pearson_correlation(matrix, pBlockSize=3, pMaxDistance=1).toarray()
+        >>> np.allclose(band, np.triu(np.tril(expected, 1), -1))
+        True
+    """
+    num_rows = pMatrix.shape[0]
+    if pMaxDistance is None:
+        if pOut is None:
+            pOut = np.empty((num_rows, num_rows))
+        for row_start, col_start, tile in pearson_correlation_tiles(pMatrix, pBlockSize):
+            pOut[row_start:row_start + tile.shape[0], col_start:col_start + tile.shape[1]] = tile
+            pOut[col_start:col_start + tile.shape[1], row_start:row_start + tile.shape[0]] = tile.T
+        return pOut
+
+    rows = [np.array([], dtype=int)]
+    cols = [np.array([], dtype=int)]
+    data = [np.array([])]
+    for row_start, col_start, tile in pearson_correlation_tiles(pMatrix, pBlockSize, pMaxDistance):
+        row, col = np.nonzero(tile)
+        row += row_start
+        col += col_start
+        # only the upper triangle of the tiles on the diagonal is used
+        in_band = (col >= row) & (col - row <= pMaxDistance)
+        rows.append(row[in_band])
+        cols.append(col[in_band])
+        data.append(tile[row[in_band] - row_start, col[in_band] - col_start])
+    rows, cols, data = np.concatenate(rows), np.concatenate(cols), np.concatenate(data)
+
+    # the lower triangle is the transposed upper triangle
+    off_diagonal = rows != cols
+    return coo_matrix((np.concatenate([data, data[off_diagonal]]),
+                       (np.concatenate([rows, cols[off_diagonal]]), np.concatenate([cols, rows[off_diagonal]]))),
+                      shape=(num_rows, num_rows)).tocsr()
+
+
+def share_arrays(pArrays):
+    """
+    Copies the arrays into shared memory, such that the worker processes
+    of a pool access the same memory instead of a copy of them. The returned
+    list is meant to be given to the initializer of the worker processes,
+    which gets the arrays back with `get_shared_arrays`.
+
+    Returns
+    -------
+    list of the (shared array, dtype, length) triplets
+
+    >>> get_shared_arrays(share_arrays([np.array([1, 2, 3]), np.array([], dtype=float)]))
+    [array([1, 2, 3]), array([], dtype=float64)]
+    """
+    shared = []
+    for array in pArrays:
+        array = np.asarray(array)
+        raw_array = RawArray(ctypes.c_char, max(1, array.nbytes))
+        np.frombuffer(raw_array, dtype=array.dtype, count=len(array))[:] = array
+        shared.append((raw_array, array.dtype.str, len(array)))
+
+    return shared
+
+
+def get_shared_arrays(pShared):
+    """
+    Returns the arrays given to `share_arrays` as views of the shared memory.
+    """
+    return [np.frombuffer(raw_array, dtype=dtype, count=length) for raw_array, dtype, length in pShared]
+
+
 def toString(s):
     """
     This takes care of python2/3 differences
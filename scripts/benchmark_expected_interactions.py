@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares the running time and the results of the expected interactions and
+obs/exp kernels of hicexplorer.utilities with the former per element loops,
+for each chromosome of the given matrices (by default the test matrices).
+"""
+from __future__ import division, print_function
+import argparse
+import os
+import time
+
+import numpy as np
+from hicmatrix import HiCMatrix as hm
+
+from hicexplorer import utilities
+
+TEST_DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         "hicexplorer", "test", "test_data")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark of the expected interactions and obs/exp kernels '
+                                     'used by hicPCA and hicTransform.')
+
+    parser.add_argument('--matrices', '-m',
+                        help='Hi-C matrices to use.',
+                        nargs='+',
+                        default=[os.path.join(TEST_DATA, name) for name in
+                                 ["small_test_matrix_50kb_res.h5", "small_test_matrix.h5", "Li_et_al_2015.cool"]])
+
+    return parser
+
+
+def loop_expected_interactions_in_distance(pLength_chromosome, pChromosome_count, pSubmatrix):
+    expected_interactions = np.zeros(pSubmatrix.shape[0])
+    row, col = pSubmatrix.nonzero()
+    distance = np.absolute(row - col)
+
+    for i, distance_ in enumerate(distance):
+        expected_interactions[distance_] += pSubmatrix.data[i]
+
+    count_times_i = np.arange(float(len(expected_interactions)))
+    count_times_i *= int(pChromosome_count)
+    count_times_i -= int(pLength_chromosome)
+    count_times_i *= -1
+
+    expected_interactions /= count_times_i
+    return expected_interactions
+
+
+def loop_expected_interactions_norm(pLength_chromosome, pChromosome_count, pSubmatrix):
+    expected_interactions = np.zeros(pSubmatrix.shape[0])
+    row, col = pSubmatrix.nonzero()
+    distance = np.absolute(row - col)
+
+    occurences = np.zeros(pSubmatrix.shape[0])
+    for i, distance_ in enumerate(distance):
+        expected_interactions[distance_] += pSubmatrix.data[i]
+        occurences[distance_] += 1
+    expected_interactions /= occurences
+    return expected_interactions
+
+
+def loop_exp_obs_matrix_norm(pSubmatrix, pLength_chromosome, pChromosome_count):
+    expected_interactions_in_distance = loop_expected_interactions_norm(pLength_chromosome, pChromosome_count,
+                                                                        pSubmatrix)
+    row_sums = np.array(pSubmatrix.sum(axis=1).T).flatten()
+    total_interactions = pSubmatrix.sum()
+
+    row, col = pSubmatrix.nonzero()
+    for i in range(len(row)):
+        expected = expected_interactions_in_distance[np.absolute(row[i] - col[i])]
+        expected *= row_sums[row[i]] * row_sums[col[i]] / total_interactions
+        pSubmatrix.data[i] /= expected
+    return pSubmatrix
+
+
+def run(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def main(args=None):
+    args = parse_arguments().parse_args(args)
+
+    print("matrix\tkernel\tnon-zero elements\tloop (s)\tvectorised (s)\tspeed-up\tidentical")
+    for matrix_file in args.matrices:
+        ma = hm.hiCMatrix(matrix_file)
+        chromosome_count = len(ma.getChrNames())
+        length_chromosome = ma.matrix.shape[0]
+        timings = {}
+        identical = {}
+        nonzero = 0
+        for chrname in ma.getChrNames():
+            chr_range = ma.getChrBinRange(chrname)
+            submatrix = ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
+            nonzero += submatrix.nnz
+            for name, loop_func, func, matrix_first in [
+                    ('expected_interactions_in_distance', loop_expected_interactions_in_distance,
+                     utilities.expected_interactions_in_distance, False),
+                    ('expected_interactions_norm', loop_expected_interactions_norm,
+                     utilities.expected_interactions_norm, False),
+                    ('exp_obs_matrix_norm', loop_exp_obs_matrix_norm, utilities.exp_obs_matrix_norm, True)]:
+                # the obs/exp kernels modify the given matrix
+                loop_args = [submatrix.copy(), length_chromosome, chromosome_count]
+                new_args = [submatrix.copy(), length_chromosome, chromosome_count]
+                if not matrix_first:
+                    loop_args, new_args = loop_args[1:] + loop_args[:1], new_args[1:] + new_args[:1]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    loop_result, loop_time = run(loop_func, *loop_args)
+                    new_result, new_time = run(func, *new_args)
+                if matrix_first:
+                    loop_result, new_result = loop_result.data, new_result.data
+                timings.setdefault(name, [0, 0])
+                timings[name][0] += loop_time
+                timings[name][1] += new_time
+                identical[name] = identical.get(name, True) and \
+                    np.array_equal(loop_result, new_result, equal_nan=True)
+
+        for name, (loop_time, new_time) in timings.items():
+            print("{}\t{}\t{}\t{:.3f}\t{:.3f}\t{:.1f}\t{}".format(
+                os.path.basename(matrix_file), name, nonzero, loop_time, new_time,
+                loop_time / max(new_time, 1e-6), identical[name]))
+
+
+if __name__ == "__main__":
+    main()